@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from deepseek_llm import DeepSeekLLM
+from telemetry import telemetry
+
+class AnswerCache:
+
+  def __init__(self,
+               cache_path: str = None,
+               similarity_threshold: float = 0.95,
+               ttl_seconds: float = 7 * 24 * 3600,
+               max_entries: int = 10000):
+    self.cache_path = cache_path
+    self.similarity_threshold = similarity_threshold
+    self.ttl_seconds = ttl_seconds
+    self.max_entries = max_entries
+
+    self.entries = {}         # entry id -> {"embedding", "fingerprint", "answer", "doc_ids", "created", "last_used", "llm_seconds"}
+    self.by_fingerprint = {}  # context fingerprint -> set of entry ids
+    self.next_id = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.latency_saved = 0.0
+
+    if cache_path and os.path.exists(cache_path + ".json"):
+      self.load()
+
+  # fingerprint of the reranked context; chunk ids are content hashes, so any edit to those chunks changes it
+  @staticmethod
+  def context_fingerprint(context_chunks: List[Dict]) -> str:
+    keys = sorted(str(chunk.get("id", hashlib.sha256(chunk["chunk"].encode("utf-8")).hexdigest())) for chunk in context_chunks)
+    return hashlib.sha256("\0".join(keys).encode("utf-8")).hexdigest()
+
+  @staticmethod
+  def _normalize(embedding: np.ndarray) -> np.ndarray:
+    embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
+
+  # function to find a cached answer for a similar question over the same context
+  def lookup(self, query_embedding: np.ndarray, context_chunks: List[Dict]) -> Optional[str]:
+    now = time.time()
+    fingerprint = self.context_fingerprint(context_chunks)
+    query = self._normalize(query_embedding)
+
+    best_id, best_similarity = None, self.similarity_threshold
+    for entry_id in list(self.by_fingerprint.get(fingerprint, ())):
+      entry = self.entries[entry_id]
+      if now - entry["created"] > self.ttl_seconds:
+        self._remove(entry_id)
+        continue
+      similarity = float(entry["embedding"] @ query)
+      if similarity >= best_similarity:
+        best_id, best_similarity = entry_id, similarity
+
+    if best_id is None:
+      self.misses += 1
+      telemetry.count("cache_misses_total", cache="answer")
+      return None
+
+    entry = self.entries[best_id]
+    entry["last_used"] = now
+    self.hits += 1
+    self.latency_saved += entry["llm_seconds"]
+    telemetry.count("cache_hits_total", cache="answer")
+    return entry["answer"]
+
+  # function to remember an answer; llm_seconds is what a later hit saves
+  def store(self, query_embedding: np.ndarray, context_chunks: List[Dict], answer: str, llm_seconds: float = 0.0):
+    now = time.time()
+    fingerprint = self.context_fingerprint(context_chunks)
+    entry_id = self.next_id
+    self.next_id += 1
+
+    self.entries[entry_id] = {
+        "embedding": self._normalize(query_embedding),
+        "fingerprint": fingerprint,
+        "answer": answer,
+        "doc_ids": sorted({str(chunk["doc_id"]) for chunk in context_chunks if "doc_id" in chunk}),
+        "created": now,
+        "last_used": now,
+        "llm_seconds": llm_seconds
+    }
+    self.by_fingerprint.setdefault(fingerprint, set()).add(entry_id)
+    self._evict(now)
+
+  # function to drop every answer that used a document, e.g. after it was deleted from the vector store
+  def invalidate_document(self, doc_id: str) -> int:
+    stale = [entry_id for entry_id, entry in self.entries.items() if str(doc_id) in entry["doc_ids"]]
+    for entry_id in stale:
+      self._remove(entry_id)
+    return len(stale)
+
+  def clear(self):
+    self.entries = {}
+    self.by_fingerprint = {}
+
+  def _remove(self, entry_id: int):
+    entry = self.entries.pop(entry_id)
+    ids = self.by_fingerprint.get(entry["fingerprint"])
+    if ids is not None:
+      ids.discard(entry_id)
+      if not ids:
+        del self.by_fingerprint[entry["fingerprint"]]
+
+  # expired entries go first, then the least recently used ones
+  def _evict(self, now: float):
+    if len(self.entries) <= self.max_entries:
+      return
+    for entry_id in [entry_id for entry_id, entry in self.entries.items() if now - entry["created"] > self.ttl_seconds]:
+      self._remove(entry_id)
+    overflow = len(self.entries) - self.max_entries
+    if overflow > 0:
+      for entry_id in sorted(self.entries, key=lambda i: self.entries[i]["last_used"])[:overflow]:
+        self._remove(entry_id)
+
+  # function to persist the cache as <path>.json (answers) and <path>.npy (query embeddings)
+  def save(self, path: str = None):
+    path = path or self.cache_path
+    if not path:
+      raise ValueError("No path specified for saving answer cache")
+
+    entry_ids = list(self.entries.keys())
+    records = [{key: value for key, value in self.entries[entry_id].items() if key != "embedding"} for entry_id in entry_ids]
+    embeddings = np.array([self.entries[entry_id]["embedding"] for entry_id in entry_ids], dtype=np.float32)
+
+    np.save(path + ".npy", embeddings)
+    with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+      json.dump(records, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+  def load(self, path: str = None):
+    path = path or self.cache_path
+    with open(path + ".json", "r", encoding="utf-8") as f:
+      records = json.load(f)
+    embeddings = np.load(path + ".npy") if records else []
+
+    self.clear()
+    now = time.time()
+    for record, embedding in zip(records, embeddings):
+      if now - record["created"] > self.ttl_seconds:
+        continue
+      record["embedding"] = embedding
+      self.entries[self.next_id] = record
+      self.by_fingerprint.setdefault(record["fingerprint"], set()).add(self.next_id)
+      self.next_id += 1
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  def get_stats(self) -> Dict:
+    return {
+        "entries": len(self.entries),
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hit_rate,
+        "latency_saved_seconds": self.latency_saved
+    }
+
+class CachedAnswerer:
+
+  def __init__(self, llm: DeepSeekLLM, cache: AnswerCache):
+    self.llm = llm
+    self.cache = cache
+
+  # function to answer from the cache when possible, otherwise call the LLM and cache the result
+  def answer(self, prompt: str, query_embedding: np.ndarray, context_chunks: List[Dict]) -> str:
+    cached = self.cache.lookup(query_embedding, context_chunks)
+    if cached is not None:
+      return cached
+
+    start = time.time()
+    answer = self.llm.answer_query(prompt)
+    self.cache.store(query_embedding, context_chunks, answer, llm_seconds=time.time() - start)
+    return answer
+
+  # same as answer() for AsyncDeepSeekLLM
+  async def aanswer(self, prompt: str, query_embedding: np.ndarray, context_chunks: List[Dict]) -> str:
+    cached = self.cache.lookup(query_embedding, context_chunks)
+    if cached is not None:
+      return cached
+
+    start = time.time()
+    answer = await self.llm.aanswer_query(prompt)
+    self.cache.store(query_embedding, context_chunks, answer, llm_seconds=time.time() - start)
+    return answer
@@ -0,0 +1,141 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, List
+from deepseek_llm import DeepSeekLLM
+from telemetry import telemetry
+from lazy_imports import lazy_module
+
+aiohttp = lazy_module("aiohttp")
+
+class AsyncDeepSeekLLM(DeepSeekLLM):
+
+  def __init__(self,
+               api_key: str,
+               model: str = "deepseek/deepseek-r1-0528:free",
+               base_url: str = "https://openrouter.ai/api/v1",
+               max_retries: int = 3,
+               timeout: int = 120,
+               backoff_base: float = 1.0,
+               backoff_max: float = 30.0,
+               max_concurrency: int = 4):
+    super().__init__(api_key, model=model, base_url=base_url, max_retries=max_retries,
+                     timeout=timeout, backoff_base=backoff_base, backoff_max=backoff_max)
+    self.max_concurrency = max_concurrency
+    self._client = None
+    self._semaphore = None
+
+    self.retries = 0
+
+  # one pooled keep-alive session, created inside the running event loop
+  def _get_client(self) -> "aiohttp.ClientSession":
+    if self._client is None or self._client.closed:
+      self._client = aiohttp.ClientSession(
+          headers=self.headers,
+          timeout=aiohttp.ClientTimeout(total=self.timeout),
+          connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+      )
+      self._semaphore = asyncio.Semaphore(self.max_concurrency)
+    return self._client
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.close()
+      self._client = None
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
+
+  # opens a chat completion request, retrying 429/5xx and connection errors without blocking other requests
+  async def _post(self, payload: Dict[str, Any]) -> "aiohttp.ClientResponse":
+    client = self._get_client()
+    for attempt in range(self.max_retries):
+      retry_after = None
+      try:
+        response = await client.post(f"{self.base_url}/chat/completions", json=payload)
+        if response.status < 400:
+          return response
+        retry_after = response.headers.get("Retry-After")
+        error = f"HTTP {response.status}: {await response.text()}"
+        response.release()
+        if response.status not in self.RETRYABLE_STATUS:
+          raise RuntimeError(f"API request failed with status {response.status}: {error}")
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        error = str(e) or type(e).__name__
+
+      if attempt < self.max_retries - 1:
+        wait_time = self.retry_delay(attempt, retry_after)
+        self.retries += 1
+        telemetry.count("llm_retries_total")
+        print(f"Error: {error}. Retrying in {wait_time:.1f} seconds...")
+        await asyncio.sleep(wait_time)
+      else:
+        raise RuntimeError(f"API request failed after {self.max_retries} attempts: {error}")
+
+  # async version of generate()
+  async def agenerate(self,
+                      prompt: str,
+                      max_tokens: int = 160000,
+                      temperature: float = 0.7,
+                      top_p: float = 0.9,
+                      stop: list = None) -> Dict[str, Any]:
+    payload = self.build_payload(prompt, max_tokens, temperature, top_p, stop)
+    self._get_client()
+    async with self._semaphore:
+      with telemetry.span("llm", model=self.model) as span:
+        response = await self._post(payload)
+        async with response:
+          result = await response.json()
+        self.record_usage(result, span)
+        return result
+
+  # streams content tokens as the server sends them (server-sent events), so callers see time-to-first-token
+  # retries only happen before the stream starts; a stream that breaks midway raises
+  async def stream(self,
+                   prompt: str,
+                   max_tokens: int = 160000,
+                   temperature: float = 0.7,
+                   top_p: float = 0.9,
+                   stop: list = None) -> AsyncIterator[str]:
+    payload = self.build_payload(prompt, max_tokens, temperature, top_p, stop, stream=True)
+    self._get_client()
+    async with self._semaphore:
+      response = await self._post(payload)
+      async with response:
+        async for raw_line in response.content:
+          line = raw_line.decode("utf-8").strip()
+          # blank lines separate events; lines starting with ':' are keep-alive comments
+          if not line.startswith("data:"):
+            continue
+          data = line[len("data:"):].strip()
+          if data == "[DONE]":
+            break
+          try:
+            delta = json.loads(data)["choices"][0].get("delta", {})
+          except (json.JSONDecodeError, KeyError, IndexError):
+            continue
+          if delta.get("content"):
+            yield delta["content"]
+
+  # async version of answer_query()
+  async def aanswer_query(self, prompt: str, max_tokens: int = 160000) -> str:
+    response = await self.agenerate(
+        prompt=prompt,
+        max_tokens=max_tokens,
+        temperature=self.ANSWER_TEMPERATURE,
+        top_p=0.9,
+        stop=self.ANSWER_STOP
+    )
+    return self.format_answer(self.extract_answer(response))
+
+  # streaming version of answer_query(): yields raw tokens, then the caller can format_answer() the joined text
+  async def stream_answer(self, prompt: str, max_tokens: int = 160000) -> AsyncIterator[str]:
+    async for token in self.stream(prompt, max_tokens=max_tokens, temperature=self.ANSWER_TEMPERATURE,
+                                   top_p=0.9, stop=self.ANSWER_STOP):
+      yield token
+
+  # function to answer several prompts concurrently, bounded by max_concurrency
+  async def answer_queries(self, prompts: List[str], max_tokens: int = 160000) -> List[str]:
+    return await asyncio.gather(*(self.aanswer_query(prompt, max_tokens=max_tokens) for prompt in prompts))
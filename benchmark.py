@@ -0,0 +1,250 @@
+import argparse
+import json
+import resource
+import sys
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+from squad_parser import SquadParser
+from query_preprocessor import QueryPreprocessor
+from text_chunker import TextChunker
+from embedding_generator import EmbeddingGenerator
+from vector_store import VectorStore
+from reranker import Reranker
+from prompt_engineer import PromptEngineer
+from inference_backends import BACKENDS
+
+STAGES = ("preprocess", "embed", "search", "rerank", "prompt", "llm", "total")
+
+# stands in for DeepSeekLLM so runs are free, offline and repeatable; latency_ms simulates the API round trip
+class StubLLM:
+
+  def __init__(self, latency_ms: float = 0.0):
+    self.latency = latency_ms / 1000
+
+  def answer_query(self, prompt: str) -> str:
+    if self.latency:
+      time.sleep(self.latency)
+    return "Stub answer."
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+  values = np.array(samples, dtype=np.float64) * 1000
+  if len(values) == 0:
+    return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+  p50, p95, p99 = np.percentile(values, [50, 95, 99])
+  return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(values.mean())}
+
+# peak resident set size of this process; ru_maxrss is in KB on linux and bytes on macos
+def peak_rss_mb() -> float:
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# function to turn sampled SQuAD paragraphs into documents and (question, gold doc id) pairs
+def build_corpus(parser: SquadParser, num_contexts: int, questions_per_context: int, seed: int) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+  documents, queries = [], []
+  for i, (context, qas) in enumerate(parser.get_random_pairs(n=num_contexts, filter_by="answerable", seed=seed)):
+    doc_id = f"squad-{i}"
+    documents.append((doc_id, context))
+    queries.extend((qa["question"], doc_id) for qa in qas[:questions_per_context])
+  return documents, queries
+
+# 1-based rank of the first result from the gold document, or None if it was not retrieved
+def gold_rank(results: List[Dict], gold_doc_id: str):
+  for rank, result in enumerate(results, start=1):
+    if result["doc_id"] == gold_doc_id:
+      return rank
+  return None
+
+class Benchmark:
+
+  def __init__(self,
+               preprocessor: QueryPreprocessor,
+               chunker: TextChunker,
+               embedder: EmbeddingGenerator,
+               vector_store: VectorStore,
+               reranker: Reranker,
+               prompt_engineer: PromptEngineer,
+               llm,
+               top_k: int = 30,
+               final_k: int = 5,
+               hybrid: bool = False):
+    self.preprocessor = preprocessor
+    self.chunker = chunker
+    self.embedder = embedder
+    self.vector_store = vector_store
+    self.reranker = reranker
+    self.prompt_engineer = prompt_engineer
+    self.llm = llm
+    self.top_k = top_k
+    self.final_k = final_k
+    self.hybrid = hybrid
+
+  # function to chunk, embed and store every document
+  def ingest(self, documents: List[Tuple[str, str]]) -> Dict:
+    start = time.time()
+    chunk_count = 0
+    for doc_id, context in documents:
+      chunks = self.chunker.chunk_text(context, {"source": doc_id})
+      if not chunks:
+        continue
+      self.vector_store.upsert_document(doc_id, self.embedder.embed_text(chunks), chunks)
+      chunk_count += len(chunks)
+    elapsed = time.time() - start
+    return {
+        "documents": len(documents),
+        "chunks": chunk_count,
+        "seconds": elapsed,
+        "chunks_per_second": chunk_count / elapsed if elapsed > 0 else 0.0
+    }
+
+  # function to run every query through the pipeline one at a time, timing each stage
+  def run(self, queries: List[Tuple[str, str]]) -> Dict:
+    timings = {stage: [] for stage in STAGES}
+    search_ranks, rerank_ranks = [], []
+
+    start = time.time()
+    for question, gold_doc_id in queries:
+      query_start = t = time.perf_counter()
+      processed = [q for q in self.preprocessor.preprocess(question) if q]
+      query = processed[0] if processed else question
+      t = self._lap(timings, "preprocess", t)
+
+      query_embedding = self.embedder.embed_text(query)
+      t = self._lap(timings, "embed", t)
+
+      if self.hybrid:
+        candidates = self.vector_store.hybrid_search(query, query_embedding, k=self.top_k)
+      else:
+        candidates = self.vector_store.search(query_embedding.copy(), k=self.top_k)
+      t = self._lap(timings, "search", t)
+
+      reranked = self.reranker.rerank(query, candidates, top_k=self.final_k)
+      t = self._lap(timings, "rerank", t)
+
+      prompt = self.prompt_engineer.format_prompt(processed_query=query, context_chunks=reranked)
+      t = self._lap(timings, "prompt", t)
+
+      self.llm.answer_query(prompt)
+      self._lap(timings, "llm", t)
+      timings["total"].append(time.perf_counter() - query_start)
+
+      search_ranks.append(gold_rank(candidates, gold_doc_id))
+      rerank_ranks.append(gold_rank(reranked, gold_doc_id))
+    elapsed = time.time() - start
+
+    return {
+        "queries": len(queries),
+        "latency_ms": {stage: percentiles(samples) for stage, samples in timings.items()},
+        "throughput_qps": len(queries) / elapsed if elapsed > 0 else 0.0,
+        "quality": {
+            f"search_recall@{self.top_k}": self._recall(search_ranks),
+            "search_mrr": self._mrr(search_ranks),
+            f"rerank_recall@{self.final_k}": self._recall(rerank_ranks),
+            "rerank_mrr": self._mrr(rerank_ranks)
+        }
+    }
+
+  @staticmethod
+  def _lap(timings: Dict[str, List[float]], stage: str, since: float) -> float:
+    now = time.perf_counter()
+    timings[stage].append(now - since)
+    return now
+
+  @staticmethod
+  def _recall(ranks: List) -> float:
+    return sum(rank is not None for rank in ranks) / len(ranks) if ranks else 0.0
+
+  @staticmethod
+  def _mrr(ranks: List) -> float:
+    return sum(1 / rank for rank in ranks if rank is not None) / len(ranks) if ranks else 0.0
+
+# function to compare a run against a stored baseline; latencies may grow by `tolerance` (relative),
+# quality metrics may drop by `quality_tolerance` (absolute); returns one line per regression
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.1, quality_tolerance: float = 0.01) -> List[str]:
+  regressions = []
+  for stage, stats in results["latency_ms"].items():
+    old = baseline.get("latency_ms", {}).get(stage)
+    if not old:
+      continue
+    for key in ("p50", "p95", "p99"):
+      if old[key] > 0 and stats[key] > old[key] * (1 + tolerance):
+        regressions.append(f"{stage} {key}: {old[key]:.2f}ms -> {stats[key]:.2f}ms")
+
+  old_qps = baseline.get("throughput_qps")
+  if old_qps and results["throughput_qps"] < old_qps * (1 - tolerance):
+    regressions.append(f"throughput: {old_qps:.2f} -> {results['throughput_qps']:.2f} queries/sec")
+
+  for metric, value in results["quality"].items():
+    old = baseline.get("quality", {}).get(metric)
+    if old is not None and value < old - quality_tolerance:
+      regressions.append(f"{metric}: {old:.4f} -> {value:.4f}")
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description="End-to-end latency and retrieval-quality benchmark on SQuAD")
+  parser.add_argument("squad", help="path to a SQuAD json file, e.g. train-v2.0.json")
+  parser.add_argument("--output", default="benchmark.json", help="where to write the results")
+  parser.add_argument("--baseline", default=None, help="results file to compare against; exits with 1 on regressions")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative latency/throughput regression")
+  parser.add_argument("--contexts", type=int, default=500, help="SQuAD paragraphs in the corpus")
+  parser.add_argument("--questions-per-context", type=int, default=2)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--model", default="mpnet", choices=list(EmbeddingGenerator.MODEL_MAP.keys()))
+  parser.add_argument("--backend", default="torch", choices=list(BACKENDS))
+  parser.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+  parser.add_argument("--index-type", default="flat", choices=list(VectorStore.INDEX_TYPES))
+  parser.add_argument("--hybrid", action="store_true", help="use BM25 + dense hybrid search")
+  parser.add_argument("--chunk-size", type=int, default=512)
+  parser.add_argument("--chunk-overlap", type=int, default=128)
+  parser.add_argument("--top-k", type=int, default=30)
+  parser.add_argument("--final-k", type=int, default=5)
+  parser.add_argument("--spell-check", action="store_true")
+  parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated LLM latency of the stub")
+  args = parser.parse_args()
+
+  documents, queries = build_corpus(SquadParser(args.squad), args.contexts, args.questions_per_context, args.seed)
+
+  embedder = EmbeddingGenerator(model_name=args.model, backend=args.backend)
+  benchmark = Benchmark(
+      QueryPreprocessor(enable_spell_check=args.spell_check),
+      TextChunker(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap),
+      embedder,
+      VectorStore(dimension=embedder.embedding_size, index_type=args.index_type),
+      Reranker(model_name=args.reranker, backend=args.backend),
+      PromptEngineer(),
+      StubLLM(latency_ms=args.llm_latency_ms),
+      top_k=args.top_k,
+      final_k=args.final_k,
+      hybrid=args.hybrid
+  )
+
+  ingest_stats = benchmark.ingest(documents)
+  results = benchmark.run(queries)
+  results["ingest"] = ingest_stats
+  results["peak_rss_mb"] = peak_rss_mb()
+  results["config"] = vars(args)
+
+  with open(args.output, "w", encoding="utf-8") as f:
+    json.dump(results, f, indent=2)
+
+  print(f"{results['queries']} queries over {ingest_stats['chunks']} chunks, {results['throughput_qps']:.2f} queries/sec, peak RSS {results['peak_rss_mb']:.0f} MB")
+  for stage, stats in results["latency_ms"].items():
+    print(f"  {stage:<10} p50 {stats['p50']:8.2f}ms  p95 {stats['p95']:8.2f}ms  p99 {stats['p99']:8.2f}ms")
+  for metric, value in results["quality"].items():
+    print(f"  {metric}: {value:.4f}")
+  print(f"Results written to {args.output}")
+
+  if args.baseline:
+    with open(args.baseline, "r", encoding="utf-8") as f:
+      regressions = compare(results, json.load(f), tolerance=args.tolerance)
+    if regressions:
+      print("Regressions against baseline:")
+      for line in regressions:
+        print(f"  {line}")
+      sys.exit(1)
+    print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+  main()
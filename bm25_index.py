@@ -0,0 +1,149 @@
+import json
+import math
+import re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+class BM25Index:
+
+  TOKEN_PATTERN = re.compile(r"\w+")
+
+  def __init__(self, k1: float = 1.5, b: float = 0.75):
+    self.k1 = k1
+    self.b = b
+
+    # postings are compact typed arrays: term -> (rows as int32, term frequencies as uint16)
+    self.postings = {}
+    self.row_ids = array('q')       # row -> chunk id
+    self.doc_lengths = array('i')   # row -> number of tokens
+    self.live = bytearray()         # row -> 1 while the chunk is stored
+    self.rows = {}                  # chunk id -> row
+    self.total_length = 0
+
+  @classmethod
+  def tokenize(cls, text: str) -> List[str]:
+    return cls.TOKEN_PATTERN.findall(text.lower())
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+  def __contains__(self, chunk_id: int) -> bool:
+    return chunk_id in self.rows
+
+  # function to index one chunk
+  def add(self, chunk_id: int, text: str):
+    if chunk_id in self.rows:
+      return
+    row = len(self.row_ids)
+    tokens = self.tokenize(text)
+
+    self.rows[chunk_id] = row
+    self.row_ids.append(chunk_id)
+    self.doc_lengths.append(len(tokens))
+    self.live.append(1)
+    self.total_length += len(tokens)
+
+    for term, tf in Counter(tokens).items():
+      rows, tfs = self.postings.get(term) or self.postings.setdefault(term, (array('i'), array('H')))
+      rows.append(row)
+      tfs.append(min(tf, 65535))
+
+  # deleted rows are only flagged here; save() drops them from the postings
+  def remove(self, chunk_id: int):
+    row = self.rows.pop(chunk_id, None)
+    if row is not None:
+      self.live[row] = 0
+      self.total_length -= self.doc_lengths[row]
+
+  # function to score chunks with Okapi BM25; returns up to k (chunk_id, score) pairs, best first
+  # chunk_ids, if given, restricts the results to those chunks
+  def search(self, query: str, k: int = 10, chunk_ids: Iterable[int] = None) -> List[Tuple[int, float]]:
+    num_docs = len(self.rows)
+    if num_docs == 0:
+      return []
+
+    doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.int32) if len(self.doc_lengths) else np.zeros(0, dtype=np.int32)
+    live = np.frombuffer(bytes(self.live), dtype=np.uint8).astype(bool)
+    avg_length = self.total_length / num_docs or 1.0
+    norms = self.k1 * (1 - self.b + self.b * doc_lengths / avg_length)
+
+    scores = np.zeros(len(self.row_ids), dtype=np.float32)
+    for term in set(self.tokenize(query)):
+      posting = self.postings.get(term)
+      if posting is None:
+        continue
+      rows = np.frombuffer(posting[0], dtype=np.int32)
+      tfs = np.frombuffer(posting[1], dtype=np.uint16).astype(np.float32)
+      df = int(live[rows].sum())
+      if df == 0:
+        continue
+      idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+      scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + norms[rows])
+
+    scores[~live] = 0
+    if chunk_ids is not None:
+      allowed = np.zeros(len(scores), dtype=bool)
+      allowed[[self.rows[chunk_id] for chunk_id in np.asarray(chunk_ids).tolist() if chunk_id in self.rows]] = True
+      scores[~allowed] = 0
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > k:
+      candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return [(int(self.row_ids[row]), float(scores[row])) for row in candidates]
+
+  # function to persist as one .npz: vocabulary, concatenated postings with offsets, and per-row arrays
+  def save(self, path: str):
+    # renumber live rows so deleted chunks do not survive on disk
+    live = np.frombuffer(bytes(self.live), dtype=np.uint8).astype(bool)
+    new_rows = np.cumsum(live) - 1
+
+    terms, offsets, all_rows, all_tfs = [], [0], [], []
+    for term, (rows, tfs) in self.postings.items():
+      rows = np.frombuffer(rows, dtype=np.int32)
+      keep = live[rows]
+      if not keep.any():
+        continue
+      terms.append(term)
+      all_rows.append(new_rows[rows[keep]].astype(np.int32))
+      all_tfs.append(np.frombuffer(tfs, dtype=np.uint16)[keep])
+      offsets.append(offsets[-1] + int(keep.sum()))
+
+    np.savez(
+        path,
+        params=np.array([self.k1, self.b], dtype=np.float64),
+        vocabulary=np.array(json.dumps(terms)),
+        offsets=np.array(offsets, dtype=np.int64),
+        posting_rows=np.concatenate(all_rows) if all_rows else np.zeros(0, dtype=np.int32),
+        posting_tfs=np.concatenate(all_tfs) if all_tfs else np.zeros(0, dtype=np.uint16),
+        row_ids=np.frombuffer(self.row_ids, dtype=np.int64)[live] if len(self.row_ids) else np.zeros(0, dtype=np.int64),
+        doc_lengths=np.frombuffer(self.doc_lengths, dtype=np.int32)[live] if len(self.doc_lengths) else np.zeros(0, dtype=np.int32)
+    )
+
+  @classmethod
+  def load(cls, path: str) -> "BM25Index":
+    stored = np.load(path)
+    k1, b = stored["params"].tolist()
+    index = cls(k1=k1, b=b)
+
+    index.row_ids = array('q', stored["row_ids"].tobytes())
+    index.doc_lengths = array('i', stored["doc_lengths"].tobytes())
+    index.live = bytearray(b"\x01" * len(index.row_ids))
+    index.rows = {int(chunk_id): row for row, chunk_id in enumerate(stored["row_ids"])}
+    index.total_length = int(stored["doc_lengths"].sum())
+
+    offsets = stored["offsets"]
+    posting_rows = stored["posting_rows"]
+    posting_tfs = stored["posting_tfs"]
+    for i, term in enumerate(json.loads(str(stored["vocabulary"]))):
+      start, end = offsets[i], offsets[i + 1]
+      index.postings[term] = (array('i', posting_rows[start:end].tobytes()), array('H', posting_tfs[start:end].tobytes()))
+    return index
+
+  def get_stats(self) -> Dict:
+    return {
+        "chunks": len(self.rows),
+        "terms": len(self.postings),
+        "postings": sum(len(rows) for rows, _ in self.postings.values())
+    }
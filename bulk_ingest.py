@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List
+from document_loader import DocumentLoader
+from text_chunker import TextChunker
+from embedding_generator import EmbeddingGenerator
+from inference_backends import BACKENDS
+from vector_store import VectorStore
+from parse_cache import file_sha256
+
+# worker-process job: parse and chunk one PDF; the chunks come back to the main process for embedding
+def _parse_and_chunk(file_path: str, chunk_size: int, chunk_overlap: int) -> Dict:
+  loader = DocumentLoader(workers=1)
+  chunker = TextChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+  start = time.time()
+  metadata = loader.load_metadata(file_path)
+  pages = list(loader.iter_pages(file_path))
+  parse_seconds = time.time() - start
+
+  start = time.time()
+  chunks = list(chunker.chunk_pages(pages, metadata))
+  chunk_seconds = time.time() - start
+
+  return {
+      "path": file_path,
+      "sha256": file_sha256(file_path),
+      "chunks": chunks,
+      "parse_seconds": parse_seconds,
+      "chunk_seconds": chunk_seconds
+  }
+
+class BulkIngestor:
+
+  def __init__(self,
+               embedder: EmbeddingGenerator,
+               vector_store: VectorStore,
+               manifest_path: str,
+               workers: int = None,
+               chunk_size: int = 512,
+               chunk_overlap: int = 128,
+               batch_size: int = 1024,
+               save_every: int = 100):
+    self.embedder = embedder
+    self.vector_store = vector_store
+    self.manifest_path = manifest_path
+    self.workers = workers or os.cpu_count() or 1
+    self.chunk_size = chunk_size
+    self.chunk_overlap = chunk_overlap
+    self.batch_size = batch_size    # chunks per embedding call
+    self.save_every = save_every    # documents between checkpoints of the index and manifest
+
+    self.manifest = self._load_manifest()
+
+  # manifest: relative path -> {"mtime", "size", "sha256", "chunks"}; only written together with the index
+  def _load_manifest(self) -> Dict:
+    if os.path.exists(self.manifest_path):
+      with open(self.manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+    return {}
+
+  def _save_manifest(self):
+    tmp_path = self.manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump(self.manifest, f)
+    os.replace(tmp_path, self.manifest_path)
+
+  # function to checkpoint: the manifest is only advanced once the documents it lists are saved in the index
+  def _checkpoint(self):
+    if self.vector_store.index is not None:
+      self.vector_store.save_index()
+    self._save_manifest()
+
+  @staticmethod
+  def find_pdfs(root: str) -> List[str]:
+    pdfs = []
+    for dir_path, _, file_names in os.walk(root):
+      for file_name in file_names:
+        if file_name.lower().endswith(".pdf"):
+          pdfs.append(os.path.join(dir_path, file_name))
+    return sorted(pdfs)
+
+  # a file is unchanged if size and mtime match, or if only its mtime changed but the content hash did not
+  def _is_unchanged(self, doc_id: str, file_path: str) -> bool:
+    entry = self.manifest.get(doc_id)
+    if entry is None:
+      return False
+    stat = os.stat(file_path)
+    if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+      return True
+    if entry["size"] == stat.st_size and entry["sha256"] == file_sha256(file_path):
+      entry["mtime"] = stat.st_mtime
+      return True
+    return False
+
+  # main function: ingest every PDF under root, skipping files already in the manifest
+  # doc ids are paths relative to root, so an archive can be moved without re-ingesting it
+  def ingest_directory(self, root: str, prune: bool = False) -> Dict:
+    start = time.time()
+    stats = {
+        "docs": 0, "skipped": 0, "failed": 0, "removed_docs": 0,
+        "chunks": 0, "chunks_added": 0, "chunks_removed": 0,
+        "parse_seconds": 0.0, "chunk_seconds": 0.0, "embed_seconds": 0.0, "store_seconds": 0.0,
+        "index_trained": False
+    }
+
+    todo = deque()
+    seen_doc_ids = set()
+    for file_path in self.find_pdfs(root):
+      doc_id = os.path.relpath(file_path, root)
+      seen_doc_ids.add(doc_id)
+      if self._is_unchanged(doc_id, file_path):
+        stats["skipped"] += 1
+      else:
+        todo.append(file_path)
+
+    if prune:
+      for doc_id in [doc_id for doc_id in self.manifest if doc_id not in seen_doc_ids]:
+        stats["chunks_removed"] += self.vector_store.delete_document(doc_id)
+        del self.manifest[doc_id]
+        stats["removed_docs"] += 1
+
+    # an ivf index is trained once, after the whole run, on a sample drawn from every file; until then new chunks
+    # are staged (or go into the index a previous run trained), instead of training on the first file's chunks
+    auto_train = self.vector_store.auto_train
+    self.vector_store.auto_train = False
+
+    # parsing and chunking run in the pool while this process embeds the results as they arrive
+    since_checkpoint = 0
+    try:
+      with ProcessPoolExecutor(max_workers=self.workers) as pool:
+        pending = set()
+        while todo or pending:
+          while todo and len(pending) < 2 * self.workers:
+            pending.add(pool.submit(_parse_and_chunk, todo.popleft(), self.chunk_size, self.chunk_overlap))
+          done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+          for future in done:
+            try:
+              result = future.result()
+            except Exception as e:
+              print(f"Skipping document: {str(e)}")
+              stats["failed"] += 1
+              continue
+
+            self._store(root, result, stats)
+            since_checkpoint += 1
+            if since_checkpoint >= self.save_every:
+              self._checkpoint()
+              since_checkpoint = 0
+    finally:
+      self.vector_store.auto_train = auto_train
+    stats["index_trained"] = self.vector_store.maybe_train()
+
+    if since_checkpoint or stats["removed_docs"] or stats["index_trained"]:
+      self._checkpoint()
+    else:
+      self._save_manifest()    # skipped files may have had their mtime refreshed
+
+    elapsed = time.time() - start
+    stats["seconds"] = elapsed
+    stats["docs_per_second"] = stats["docs"] / elapsed if elapsed > 0 else 0.0
+    stats["chunks_per_second"] = stats["chunks"] / elapsed if elapsed > 0 else 0.0
+    return stats
+
+  def _store(self, root: str, result: Dict, stats: Dict):
+    file_path = result["path"]
+    doc_id = os.path.relpath(file_path, root)
+    chunks = result["chunks"]
+
+    embed_time = [0.0]
+    def embed(texts):
+      embed_start = time.time()
+      embeddings = self.embedder.embed_text(texts)
+      embed_time[0] += time.time() - embed_start
+      return embeddings
+
+    batches = (chunks[i:i + self.batch_size] for i in range(0, len(chunks), self.batch_size))
+    store_start = time.time()
+    upsert = self.vector_store.upsert_document_stream(doc_id, batches, embed)
+    store_seconds = time.time() - store_start - embed_time[0]
+
+    stat = os.stat(file_path)
+    self.manifest[doc_id] = {
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "sha256": result["sha256"],
+        "chunks": len(chunks)
+    }
+
+    stats["docs"] += 1
+    stats["chunks"] += len(chunks)
+    stats["chunks_added"] += upsert["added"]
+    stats["chunks_removed"] += upsert["removed"]
+    stats["parse_seconds"] += result["parse_seconds"]
+    stats["chunk_seconds"] += result["chunk_seconds"]
+    stats["embed_seconds"] += embed_time[0]
+    stats["store_seconds"] += store_seconds
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Ingest a directory tree of PDFs into a vector store")
+  parser.add_argument("root", help="directory to scan for PDFs")
+  parser.add_argument("--index", default="my_index", help="index path prefix (writes <index>.index, <index>.chunks and <index>.meta)")
+  parser.add_argument("--manifest", default=None, help="manifest file used to resume and skip unchanged files (default: <index>.manifest.json)")
+  parser.add_argument("--model", default="mpnet", choices=list(EmbeddingGenerator.MODEL_MAP.keys()))
+  parser.add_argument("--cache-dir", default=None, help="optional embedding cache directory")
+  parser.add_argument("--backend", default="torch", choices=list(BACKENDS), help="embedding inference backend; the int8 ones are for cpu-only nodes")
+  parser.add_argument("--index-type", default="flat", choices=list(VectorStore.INDEX_TYPES))
+  parser.add_argument("--workers", type=int, default=None, help="parse/chunk processes (default: all cores)")
+  parser.add_argument("--chunk-size", type=int, default=512)
+  parser.add_argument("--chunk-overlap", type=int, default=128)
+  parser.add_argument("--batch-size", type=int, default=1024, help="chunks per embedding call")
+  parser.add_argument("--save-every", type=int, default=100, help="documents between checkpoints")
+  parser.add_argument("--prune", action="store_true", help="delete documents whose files no longer exist")
+  parser.add_argument("--dedup-threshold", type=float, default=None, help="collapse chunks at least this similar (word-shingle Jaccard) to a stored one, e.g. 0.8")
+  args = parser.parse_args()
+
+  embedder = EmbeddingGenerator(model_name=args.model, cache_dir=args.cache_dir, backend=args.backend)
+  vector_store = VectorStore(dimension=embedder.embedding_size, index_path=args.index, index_type=args.index_type,
+                             dedup_threshold=args.dedup_threshold)
+  ingestor = BulkIngestor(
+      embedder,
+      vector_store,
+      manifest_path=args.manifest or args.index + ".manifest.json",
+      workers=args.workers,
+      chunk_size=args.chunk_size,
+      chunk_overlap=args.chunk_overlap,
+      batch_size=args.batch_size,
+      save_every=args.save_every
+  )
+
+  stats = ingestor.ingest_directory(args.root, prune=args.prune)
+  print(f"Ingested {stats['docs']} documents ({stats['skipped']} unchanged, {stats['failed']} failed, {stats['removed_docs']} removed)")
+  print(f"{stats['chunks']} chunks: {stats['chunks_added']} added, {stats['chunks_removed']} removed")
+  print(f"{stats['docs_per_second']:.2f} docs/sec, {stats['chunks_per_second']:.1f} chunks/sec over {stats['seconds']:.1f}s")
+  if stats["index_trained"]:
+    print(f"Trained the {vector_store.index_type} index on {vector_store.get_index_size()} vectors ({vector_store.trained_nlist} lists)")
+  print(f"Stage time: parse {stats['parse_seconds']:.1f}s, chunk {stats['chunk_seconds']:.1f}s, "
+        f"embed {stats['embed_seconds']:.1f}s, store {stats['store_seconds']:.1f}s")
+  if vector_store.dedup is not None:
+    dedup = vector_store.dedup.get_stats()
+    print(f"Near-duplicates: {dedup['collapsed_since_load']} chunks collapsed this run; {dedup['collapsed_chunks']} collapsed into "
+          f"{dedup['chunks_with_duplicates']} stored chunks overall ({100 * dedup['vectors_saved_ratio']:.1f}% fewer vectors)")
+
+
+if __name__ == "__main__":
+  main()
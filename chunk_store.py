@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Optional
+import numpy as np
+
+class ChunkStore:
+
+  # on-disk layout (one directory):
+  #   texts.bin / offsets.npy          chunk texts as one utf-8 blob, row i is texts[offsets[i]:offsets[i+1]]
+  #   extras.bin / extra_offsets.npy   per-chunk metadata that differs from its document's metadata (json, usually tiny)
+  #   ids.npy                          chunk id of each row; rows are grouped by document
+  #   sorted_ids.npy / id_order.npy    sorted chunk ids and their rows, for O(log n) id lookups
+  #   doc_starts.npy                   first row of each document, plus a final end row
+  #   documents.json                   doc ids and their metadata, stored once per document
+  DROPPED_KEYS = "__dropped__"
+
+  def __init__(self, path: str = None):
+    self.path = path
+
+    # memory-mapped base written by the last save()
+    self._ids = np.zeros(0, dtype=np.int64)
+    self._sorted_ids = np.zeros(0, dtype=np.int64)
+    self._id_order = np.zeros(0, dtype=np.int64)
+    self._offsets = np.zeros(1, dtype=np.int64)
+    self._texts = np.zeros(0, dtype=np.uint8)
+    self._extra_offsets = np.zeros(1, dtype=np.int64)
+    self._extras = np.zeros(0, dtype=np.uint8)
+    self._doc_starts = np.zeros(1, dtype=np.int64)
+    self._documents = []      # [{"doc_id", "metadata"}], row order of the base
+    self._doc_rows = {}       # doc id -> index into self._documents
+
+    # in-memory changes since the last save()
+    self._added = {}          # chunk id -> (doc_id, text, metadata)
+    self._added_by_doc = {}   # doc id -> added chunk ids, as an insertion-ordered dict so removal is O(1)
+    self._removed = set()     # base chunk ids that were deleted
+
+    if path and os.path.exists(os.path.join(path, "documents.json")):
+      self._open(path)
+
+  def _open(self, path: str):
+    self._ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+    self._sorted_ids = np.load(os.path.join(path, "sorted_ids.npy"), mmap_mode="r")
+    self._id_order = np.load(os.path.join(path, "id_order.npy"), mmap_mode="r")
+    self._offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+    self._extra_offsets = np.load(os.path.join(path, "extra_offsets.npy"), mmap_mode="r")
+    self._doc_starts = np.load(os.path.join(path, "doc_starts.npy"), mmap_mode="r")
+    self._texts = self._map_blob(os.path.join(path, "texts.bin"))
+    self._extras = self._map_blob(os.path.join(path, "extras.bin"))
+
+    with open(os.path.join(path, "documents.json"), "r", encoding="utf-8") as f:
+      self._documents = json.load(f)
+    self._doc_rows = {doc["doc_id"]: i for i, doc in enumerate(self._documents)}
+
+  @staticmethod
+  def _map_blob(path: str) -> np.ndarray:
+    # numpy cannot memory-map an empty file
+    if os.path.getsize(path) == 0:
+      return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+  def _base_row(self, chunk_id: int) -> Optional[int]:
+    pos = int(np.searchsorted(self._sorted_ids, chunk_id))
+    if pos < len(self._sorted_ids) and self._sorted_ids[pos] == chunk_id:
+      return int(self._id_order[pos])
+    return None
+
+  def __contains__(self, chunk_id: int) -> bool:
+    if chunk_id in self._added:
+      return True
+    return chunk_id not in self._removed and self._base_row(chunk_id) is not None
+
+  def __len__(self) -> int:
+    # re-added base chunks are counted once in _removed and once in _added
+    return len(self._ids) - len(self._removed) + len(self._added)
+
+  # function to add a chunk; document-level metadata is kept once and only the per-chunk differences are stored
+  def add(self, chunk_id: int, doc_id: str, text: str, metadata: Dict):
+    if doc_id not in self._doc_rows:
+      self._doc_rows[doc_id] = len(self._documents)
+      self._documents.append({"doc_id": doc_id, "metadata": dict(metadata)})
+    self._added[chunk_id] = (doc_id, text, self._residual(doc_id, metadata))
+    self._added_by_doc.setdefault(doc_id, {})[chunk_id] = None
+
+  # function to delete a chunk; returns its document id, or None if it was not stored
+  def remove(self, chunk_id: int) -> Optional[str]:
+    added = self._added.pop(chunk_id, None)
+    if added is not None:
+      del self._added_by_doc[added[0]][chunk_id]
+      if chunk_id not in self._removed and self._base_row(chunk_id) is not None:
+        self._removed.add(chunk_id)
+      return added[0]
+
+    if chunk_id in self._removed:
+      return None
+    row = self._base_row(chunk_id)
+    if row is None:
+      return None
+    self._removed.add(chunk_id)
+    return self._documents[self._row_document(row)]["doc_id"]
+
+  # function to decode one chunk into the {"text", "metadata", "doc_id"} form used by VectorStore
+  def get(self, chunk_id: int) -> Optional[Dict]:
+    added = self._added.get(chunk_id)
+    if added is not None:
+      doc_id, text, residual = added
+      return {"text": text, "metadata": self._merge(doc_id, residual), "doc_id": doc_id}
+
+    if chunk_id in self._removed:
+      return None
+    row = self._base_row(chunk_id)
+    if row is None:
+      return None
+
+    doc_id = self._documents[self._row_document(row)]["doc_id"]
+    text = bytes(self._texts[self._offsets[row]:self._offsets[row + 1]]).decode("utf-8")
+    raw_extras = bytes(self._extras[self._extra_offsets[row]:self._extra_offsets[row + 1]])
+    residual = json.loads(raw_extras) if raw_extras else {}
+    return {"text": text, "metadata": self._merge(doc_id, residual), "doc_id": doc_id}
+
+  def _row_document(self, row: int) -> int:
+    return int(np.searchsorted(self._doc_starts, row, side="right")) - 1
+
+  def _residual(self, doc_id: str, metadata: Dict) -> Dict:
+    doc_metadata = self._documents[self._doc_rows[doc_id]]["metadata"]
+    residual = {key: value for key, value in metadata.items() if key not in doc_metadata or doc_metadata[key] != value}
+    dropped = [key for key in doc_metadata if key not in metadata]
+    if dropped:
+      residual[self.DROPPED_KEYS] = dropped
+    return residual
+
+  def _merge(self, doc_id: str, residual: Dict) -> Dict:
+    metadata = dict(self._documents[self._doc_rows[doc_id]]["metadata"])
+    for key in residual.get(self.DROPPED_KEYS, ()):
+      metadata.pop(key, None)
+    metadata.update((key, value) for key, value in residual.items() if key != self.DROPPED_KEYS)
+    return metadata
+
+  # function to list the ids of every live chunk
+  def ids(self) -> np.ndarray:
+    base = np.asarray(self._ids)
+    if self._removed:
+      base = base[~np.isin(base, np.fromiter(self._removed, dtype=np.int64))]
+    added = np.fromiter(self._added.keys(), dtype=np.int64, count=len(self._added))
+    return np.concatenate([base, added])
+
+  def document_ids(self) -> List[str]:
+    return [doc_id for doc_id in self._doc_rows if self.document_chunk_ids(doc_id)]
+
+  # function to list the live chunk ids of one document
+  def document_chunk_ids(self, doc_id: str) -> List[int]:
+    chunk_ids = []
+    doc_row = self._doc_rows.get(doc_id)
+    if doc_row is not None and doc_row + 1 < len(self._doc_starts):
+      rows = self._ids[self._doc_starts[doc_row]:self._doc_starts[doc_row + 1]]
+      chunk_ids = [int(chunk_id) for chunk_id in rows if int(chunk_id) not in self._removed]
+    chunk_ids.extend(self._added_by_doc.get(doc_id, ()))
+    return chunk_ids
+
+  def document_metadata(self, doc_id: str) -> Optional[Dict]:
+    doc_row = self._doc_rows.get(doc_id)
+    return None if doc_row is None else dict(self._documents[doc_row]["metadata"])
+
+  # function to write the store to disk, folding in every add and delete since the last save
+  def save(self, path: str = None):
+    path = path or self.path
+    if not path:
+      raise ValueError("No path specified for saving chunk store")
+
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+      shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    ids, offsets, extra_offsets, doc_starts, documents = [], [0], [0], [], []
+    with open(os.path.join(tmp_path, "texts.bin"), "wb") as texts, open(os.path.join(tmp_path, "extras.bin"), "wb") as extras:
+      for doc_row, document in enumerate(self._documents):
+        start = len(ids)
+
+        # base rows are copied as raw bytes, without decoding
+        if doc_row + 1 < len(self._doc_starts):
+          for row in range(int(self._doc_starts[doc_row]), int(self._doc_starts[doc_row + 1])):
+            chunk_id = int(self._ids[row])
+            if chunk_id in self._removed:
+              continue
+            ids.append(chunk_id)
+            offsets.append(offsets[-1] + texts.write(self._texts[self._offsets[row]:self._offsets[row + 1]].tobytes()))
+            extra_offsets.append(extra_offsets[-1] + extras.write(self._extras[self._extra_offsets[row]:self._extra_offsets[row + 1]].tobytes()))
+
+        for chunk_id in self._added_by_doc.get(document["doc_id"], ()):
+          _, text, residual = self._added[chunk_id]
+          ids.append(chunk_id)
+          offsets.append(offsets[-1] + texts.write(text.encode("utf-8")))
+          raw_extras = json.dumps(residual).encode("utf-8") if residual else b""
+          extra_offsets.append(extra_offsets[-1] + extras.write(raw_extras))
+
+        # documents without live chunks are dropped
+        if len(ids) > start:
+          doc_starts.append(start)
+          documents.append(document)
+    doc_starts.append(len(ids))
+
+    ids = np.array(ids, dtype=np.int64)
+    id_order = np.argsort(ids, kind="stable")
+    np.save(os.path.join(tmp_path, "ids.npy"), ids)
+    np.save(os.path.join(tmp_path, "sorted_ids.npy"), ids[id_order])
+    np.save(os.path.join(tmp_path, "id_order.npy"), id_order.astype(np.int64))
+    np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "extra_offsets.npy"), np.array(extra_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "doc_starts.npy"), np.array(doc_starts, dtype=np.int64))
+    with open(os.path.join(tmp_path, "documents.json"), "w", encoding="utf-8") as f:
+      json.dump(documents, f)
+
+    # swap directories; open memory maps of the old files stay valid until released
+    old_path = path + ".old"
+    if os.path.exists(old_path):
+      shutil.rmtree(old_path)
+    if os.path.exists(path):
+      os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if os.path.exists(old_path):
+      shutil.rmtree(old_path)
+
+    self.path = path
+    self._added = {}
+    self._added_by_doc = {}
+    self._removed = set()
+    self._open(path)
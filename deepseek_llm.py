@@ -1,56 +1,122 @@
-import requests
+import random
 import time
+from email.utils import parsedate_to_datetime
 from typing import Dict, Any
+from telemetry import telemetry
+from lazy_imports import lazy_module
+
+requests = lazy_module("requests")
 
 class DeepSeekLLM:
 
+  RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+  ANSWER_TEMPERATURE = 0.6    # 0.6 recommended for deepseek-r1 model
+  ANSWER_STOP = ["<|im_end|>", "###", "SOURCES:"]
+
   def __init__(self,
                api_key: str,
                model: str = "deepseek/deepseek-r1-0528:free",       # deepseek-reasoner for deepseek direct
                base_url: str = "https://openrouter.ai/api/v1",      # https://api.deepseek.com for deepseek direct
                max_retries: int = 3,
-               timeout: int = 120):
+               timeout: int = 120,
+               backoff_base: float = 1.0,
+               backoff_max: float = 30.0):
     self.api_key = api_key
     self.model = model
     self.base_url = base_url
     self.max_retries = max_retries
     self.timeout = timeout
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
     self.headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
 
-  # function to generate a response
-  def generate(self,
-               prompt: str,
-               max_tokens: int = 160000,    #164K token output for deepseek-r1
-               temperature: float = 0.7,
-               top_p: float = 0.9,
-               stop: list = None) -> Dict[str, Any]:
-    payload = {
+    self._session = None
+
+  # a session keeps the https connection alive between questions; it is made on first use, so a subclass that
+  # talks over another client (AsyncDeepSeekLLM) never imports requests
+  @property
+  def session(self) -> "requests.Session":
+    if self._session is None:
+      self._session = requests.Session()
+      self._session.headers.update(self.headers)
+    return self._session
+
+  def build_payload(self,
+                    prompt: str,
+                    max_tokens: int,
+                    temperature: float,
+                    top_p: float,
+                    stop: list = None,
+                    stream: bool = False) -> Dict[str, Any]:
+    return {
       "model": self.model,
       "messages": [{"role": "user", "content": prompt}],
       "max_tokens": max_tokens,
       "temperature": temperature,
       "top_p": top_p,
       "stop": stop or [],
-      "stream": False
+      "stream": stream
     }
 
+  # seconds to wait before the next attempt: the server's Retry-After if it sent one, otherwise jittered exponential backoff
+  # either way the wait is capped at backoff_max, so a server asking for minutes or hours cannot stall the caller
+  def retry_delay(self, attempt: int, retry_after: str = None) -> float:
+    if retry_after:
+      try:
+        return min(self.backoff_max, max(0.0, float(retry_after)))
+      except ValueError:
+        try:
+          return min(self.backoff_max, max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+        except (TypeError, ValueError):
+          pass
+    return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+  # function to generate a response
+  def generate(self,
+               prompt: str,
+               max_tokens: int = 160000,    #164K token output for deepseek-r1
+               temperature: float = 0.7,
+               top_p: float = 0.9,
+               stop: list = None) -> Dict[str, Any]:
+    payload = self.build_payload(prompt, max_tokens, temperature, top_p, stop)
+    with telemetry.span("llm", model=self.model) as span:
+      response = self._request(payload)
+      self.record_usage(response, span)
+      return response
+
+  # tokens in/out as reported by the API; OpenRouter and DeepSeek both return an OpenAI-style "usage" block
+  def record_usage(self, response: Dict, span):
+    usage = response.get("usage") if isinstance(response, dict) else None
+    if not usage:
+      return
+    span.set("tokens_in", usage.get("prompt_tokens", 0))
+    span.set("tokens_out", usage.get("completion_tokens", 0))
+    telemetry.count("llm_tokens_total", usage.get("prompt_tokens", 0), direction="in")
+    telemetry.count("llm_tokens_total", usage.get("completion_tokens", 0), direction="out")
+
+  def _request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
     for attempt in range(self.max_retries):
+      retry_after = None
       try:
-        response = requests.post(
+        response = self.session.post(
             f"{self.base_url}/chat/completions",
-            headers=self.headers,
             json=payload,
             timeout=self.timeout
         )
+        retry_after = response.headers.get("Retry-After")
         response.raise_for_status()
         return response.json()
       except requests.exceptions.RequestException as e:
+        status = e.response.status_code if e.response is not None else None
+        if status is not None and status not in self.RETRYABLE_STATUS:
+          raise RuntimeError(f"API request failed with status {status}: {str(e)}")
         if attempt < self.max_retries - 1:
-          wait_time = 2 ** attempt
-          print(f"Error: {str(e)}. Retrying in {wait_time} seconds...")
+          wait_time = self.retry_delay(attempt, retry_after)
+          telemetry.count("llm_retries_total")
+          print(f"Error: {str(e)}. Retrying in {wait_time:.1f} seconds...")
           time.sleep(wait_time)
         else:
           raise RuntimeError(f"API request failed after {self.max_retries} attempts: {str(e)}")
@@ -87,9 +153,9 @@ class DeepSeekLLM:
     response = self.generate(
         prompt=prompt,
         max_tokens=max_tokens,
-        temperature=0.6,    # 0.6 recommended for deepseek-r1 model
+        temperature=self.ANSWER_TEMPERATURE,
         top_p=0.9,
-        stop=["<|im_end|>", "###", "SOURCES:"]
+        stop=self.ANSWER_STOP
     )
 
     raw_answer = self.extract_answer(response)
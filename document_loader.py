@@ -1,39 +1,233 @@
+import hashlib
 import os
-import fitz
 import re
 import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple
+from telemetry import telemetry
+from lazy_imports import lazy_module
+from parse_cache import ParseCache
+
+# PyMuPDF is imported on first use, so modules that only import the loader stay cheap
+fitz = lazy_module("fitz")
+
+# extract raw text for pages [start, end); runs in worker processes, which need their own document handle
+def _extract_page_range(file_path: str, start: int, end: int) -> List[str]:
+  with fitz.open(file_path) as doc:
+    return [doc[i].get_text() for i in range(start, end)]
 
 class DocumentLoader:
 
+  def __init__(self, workers: int = None, pages_per_task: int = 16, min_pages_for_pool: int = 64, cache_dir: str = None):
+    self.workers = workers or os.cpu_count() or 1
+    self.pages_per_task = pages_per_task
+    self.min_pages_for_pool = min_pages_for_pool    # smaller documents are not worth the process start-up cost
+
+    # optional persistent parse cache: re-opening an unchanged file skips PDF parsing, and a changed file only
+    # has its changed pages parsed
+    self.cache = ParseCache(cache_dir) if cache_dir else None
+    self.last_changes = None    # which pages changed, as found by the last cached parse
+
   # main function
   def load_document(self, file_path):
-    if not os.path.exists(file_path):
-      raise FileNotFoundError(f"File not found: {file_path}")
+    self._validate_path(file_path)
 
-    if not file_path.lower().endswith('.pdf'):
-      raise ValueError("Only PDF files are supported in this model")
+    # cached pages are cleaned one at a time, so the text is the pages joined like iter_pages yields them
+    if self.cache is not None:
+      parsed = self.parse(file_path)
+      text = "\n\n".join(page_text for _, page_text in self._join_pages(parsed["pages"]) if page_text)
+      return text, parsed["metadata"]
 
     try:
-      doc = fitz.open(file_path)
-      full_text = ""
-      metadata = {
-          "page_count": len(doc),
-          "author": doc.metadata.get("author", ""),
-          "title": doc.metadata.get("title", "")
-      }
+      with telemetry.span("load_document") as span:
+        doc = fitz.open(file_path)
+        metadata = self._extract_metadata(doc)
+        pages = [page.get_text() + "\n\n" for page in doc]
+        span.set("pages", len(pages))
+        telemetry.count("pages_total", len(pages))
+        return self.clean_text("".join(pages)), metadata
+
+    except Exception as e:
+      raise self._processing_error(file_path, e)
+
+  # function to read only the document metadata
+  def load_metadata(self, file_path: str) -> Dict:
+    self._validate_path(file_path)
+    if self.cache is not None:
+      parsed = self.cache.get(self.cache.file_hash(file_path))
+      if parsed is not None:
+        return parsed["metadata"]
+    try:
+      with fitz.open(file_path) as doc:
+        return self._extract_metadata(doc)
+    except Exception as e:
+      raise self._processing_error(file_path, e)
+
+  # streaming alternative to load_document: yields (page_number, cleaned_text) one page at a time
+  # large documents are extracted across a process pool, with at most 2 * workers page ranges in flight
+  # with a cache the document is parsed (or read from the cache) as a whole first
+  def iter_pages(self, file_path: str) -> Iterator[Tuple[int, str]]:
+    self._validate_path(file_path)
+
+    if self.cache is not None:
+      yield from self._join_pages(self.parse(file_path)["pages"])
+      return
+
+    try:
+      with fitz.open(file_path) as doc:
+        page_count = len(doc)
+        if self.workers <= 1 or page_count < self.min_pages_for_pool:
+          raw_pages = (page.get_text() for page in doc)
+          yield from self._clean_pages(raw_pages)
+          return
+    except Exception as e:
+      raise self._processing_error(file_path, e)
+
+    yield from self._clean_pages(self._iter_pages_parallel(file_path, page_count))
 
-      for page in doc:
-        full_text += page.get_text() + "\n\n"
+  def _iter_pages_parallel(self, file_path: str, page_count: int) -> Iterator[str]:
+    ranges = deque((start, min(start + self.pages_per_task, page_count)) for start in range(0, page_count, self.pages_per_task))
+    with ProcessPoolExecutor(max_workers=self.workers) as pool:
+      pending = deque()
+      while ranges or pending:
+        while ranges and len(pending) < 2 * self.workers:
+          start, end = ranges.popleft()
+          pending.append(pool.submit(_extract_page_range, file_path, start, end))
+        try:
+          yield from pending.popleft().result()
+        except Exception as e:
+          raise self._processing_error(file_path, e)
 
-      return self.clean_text(full_text), metadata
+  # function to get a document's cleaned pages through the parse cache, with the pages that changed since this
+  # path was last parsed: changed_pages are 1-based page numbers whose content differs (all of them the first time
+  # a path is seen), removed_pages the numbers past the new page count. an unchanged file is read from the cache
+  # without opening the pdf; in a changed one only the pages with content not seen in the last version are parsed
+  def parse(self, file_path: str) -> Dict:
+    self._validate_path(file_path)
+    if self.cache is None:
+      raise ValueError("parse() needs a DocumentLoader created with a cache_dir")
 
+    with telemetry.span("parse", path=file_path) as span:
+      sha256 = self.cache.file_hash(file_path)
+      previous_sha256 = self.cache.version_of(file_path)
+      previous = None
+      if previous_sha256 is not None and previous_sha256 != sha256:
+        previous = self.cache.get(previous_sha256)
+
+      parsed = self.cache.get(sha256)
+      parsed_pages = 0
+      if parsed is None:
+        parsed, parsed_pages = self._parse_pages(file_path, previous)
+        self.cache.put(sha256, parsed["pages"], parsed["page_hashes"], parsed["metadata"])
+      self.cache.remember(file_path, sha256)
+
+      page_hashes = parsed["page_hashes"]
+      previous_hashes = page_hashes if previous_sha256 == sha256 else previous["page_hashes"] if previous else []
+      changed = [i + 1 for i, page_hash in enumerate(page_hashes) if i >= len(previous_hashes) or previous_hashes[i] != page_hash]
+      removed = list(range(len(page_hashes) + 1, len(previous_hashes) + 1))
+
+      span.set("pages", len(page_hashes))
+      span.set("parsed_pages", parsed_pages)
+      span.set("changed_pages", len(changed))
+      telemetry.count("cache_hits_total", len(page_hashes) - parsed_pages, cache="parse")
+      telemetry.count("cache_misses_total", parsed_pages, cache="parse")
+
+    self.last_changes = {"sha256": sha256, "changed_pages": changed, "removed_pages": removed, "parsed_pages": parsed_pages}
+    return dict(parsed, **self.last_changes)
+
+  # extracts and cleans only the pages whose content hash is not among the previous version's pages; returns the
+  # parsed version and the number of pages parsed
+  def _parse_pages(self, file_path: str, previous: Dict = None) -> Tuple[Dict, int]:
+    reusable = {} if previous is None else dict(zip(previous["page_hashes"], previous["pages"]))
+    try:
+      with fitz.open(file_path) as doc:
+        metadata = self._extract_metadata(doc)
+        page_hashes = [self._page_hash(page) for page in doc]
+        missing = [i for i, page_hash in enumerate(page_hashes) if page_hash not in reusable]
+        use_pool = len(missing) == len(page_hashes) and self.workers > 1 and len(page_hashes) >= self.min_pages_for_pool
+        raw_pages = {} if use_pool else {i: doc[i].get_text() for i in missing}
     except Exception as e:
-      if "password" in str(e).lower():
-        raise RuntimeError("Password-protected PDFs not supported")
-      elif "invalid format" in str(e).lower():
-        raise RuntimeError("File is not a valid PDF")
-      else:
-        raise RuntimeError(f"PDF \'{file_path}\' processing failed: {str(e)}")
+      raise self._processing_error(file_path, e)
+
+    if use_pool:
+      raw_pages = dict(enumerate(self._iter_pages_parallel(file_path, len(page_hashes))))
+    pages = [self.clean_text(raw_pages[i]) if i in raw_pages else reusable[page_hash] for i, page_hash in enumerate(page_hashes)]
+    return {"pages": pages, "page_hashes": page_hashes, "metadata": metadata}, len(missing)
+
+  # a page's content stream, the form xobjects it draws and the fonts it names: what its extracted text depends on.
+  # hashing them is several times cheaper than extracting the text
+  @staticmethod
+  def _page_hash(page) -> int:
+    doc = page.parent
+    digest = hashlib.blake2b(page.read_contents(), digest_size=8)
+    # forms can draw further forms from their own resources, so the whole xobject tree is walked, each object once;
+    # a form's dictionary and resources are hashed with its stream, since they carry its fonts and matrix
+    pending, seen = deque(xobject[0] for xobject in page.get_xobjects()), set()
+    while pending:
+      xref = pending.popleft()
+      if xref <= 0 or xref in seen:
+        continue
+      seen.add(xref)
+      digest.update(doc.xref_object(xref, compressed=True).encode("utf-8"))
+      digest.update(DocumentLoader._resolved_key(doc, xref, "Resources").encode("utf-8"))
+      digest.update(doc.xref_stream(xref) or b"")
+      pending.extend(int(ref) for ref in re.findall(r"(\d+) 0 R", DocumentLoader._resolved_key(doc, xref, "Resources/XObject")))
+    digest.update(repr([font[3:6] for font in page.get_fonts()]).encode("utf-8"))
+    return int.from_bytes(digest.digest(), "little")
+
+  # value of a dictionary key of an object, with an indirect value replaced by the object it points to
+  @staticmethod
+  def _resolved_key(doc, xref: int, key: str) -> str:
+    kind, value = doc.xref_get_key(xref, key)
+    if kind == "xref":
+      return doc.xref_object(int(value.split()[0]), compressed=True)
+    return value
+
+  def _clean_pages(self, raw_pages) -> Iterator[Tuple[int, str]]:
+    return self._join_pages(self.clean_text(raw_text) for raw_text in raw_pages)
+
+  # joins cleaned pages; a word hyphenated across a page break is re-joined onto the earlier page
+  # pages are counted one by one because a span cannot stay open across the caller's work between pages
+  def _join_pages(self, pages: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    previous = None
+    for page_number, text in enumerate(pages, start=1):
+      telemetry.count("pages_total")
+      if previous is not None:
+        prev_number, prev_text = previous
+        head = re.match(r'(\w+)\s*', text) if re.search(r'\w-$', prev_text) else None
+        if head:
+          prev_text = prev_text[:-1] + head.group(1)
+          text = text[head.end():]
+        yield prev_number, prev_text
+      previous = (page_number, text)
+    if previous is not None:
+      yield previous
+
+  @staticmethod
+  def _validate_path(file_path):
+    if not os.path.exists(file_path):
+      raise FileNotFoundError(f"File not found: {file_path}")
+
+    if not file_path.lower().endswith('.pdf'):
+      raise ValueError("Only PDF files are supported in this model")
+
+  @staticmethod
+  def _extract_metadata(doc) -> Dict:
+    return {
+        "page_count": len(doc),
+        "author": doc.metadata.get("author", ""),
+        "title": doc.metadata.get("title", "")
+    }
+
+  @staticmethod
+  def _processing_error(file_path, e) -> RuntimeError:
+    if "password" in str(e).lower():
+      return RuntimeError("Password-protected PDFs not supported")
+    elif "invalid format" in str(e).lower():
+      return RuntimeError("File is not a valid PDF")
+    else:
+      return RuntimeError(f"PDF \'{file_path}\' processing failed: {str(e)}")
 
   # function to clean up pdf-extracted text
   def clean_text(self, text):
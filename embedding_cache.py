@@ -0,0 +1,251 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import unicodedata
+import weakref
+from collections import OrderedDict
+from typing import List
+import numpy as np
+
+# caches still open at exit flush their last batch of keys then; held weakly, so a dropped cache is not kept alive
+_open_caches = weakref.WeakSet()
+
+@atexit.register
+def _flush_open_caches():
+  for cache in list(_open_caches):
+    cache.flush()
+
+class EmbeddingCache:
+
+  INDEX_FILE = "index.json"
+  VALUES_FILE = "vectors.f32"
+  # row -> tag of the key whose vector it holds. the index is only written every flush_interval puts, so after a
+  # killed process it can still map an evicted key to a row that was reused since; reads check the tag instead
+  TAGS_FILE = "tags.u64"
+
+  def __init__(self,
+               cache_dir: str,
+               model_name: str,
+               dimension: int,
+               max_entries: int = 200000,
+               flush_interval: int = 1024):
+    if max_entries <= 0:
+      raise ValueError("max_entries must be positive")
+
+    self.cache_dir = cache_dir
+    self.model_name = model_name
+    self.dimension = dimension
+    self.max_entries = max_entries
+    self.flush_interval = flush_interval
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.stale = 0
+
+    # key -> row in the value store, ordered from least to most recently used
+    self.slots = OrderedDict()
+    self._stored_entries = None
+    self._dirty = False
+    self._pending_writes = 0
+
+    os.makedirs(cache_dir, exist_ok=True)
+    self._load_index()
+    self.values, self.tags = self._open_values()
+    # rows no entry uses, lowest last so they are filled in order
+    used = set(self.slots.values())
+    self._free = [row for row in range(max_entries - 1, -1, -1) if row not in used]
+
+    # the key index is written in batches, so make sure the last batch lands on disk
+    _open_caches.add(self)
+
+  # normalize chunk text so whitespace/unicode-only differences share an entry
+  @staticmethod
+  def normalize_text(text: str) -> str:
+    text = unicodedata.normalize('NFC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+  # content-addressed key: (model name, normalized text hash)
+  def make_key(self, text: str) -> str:
+    digest = hashlib.sha256(self.normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{self.model_name}:{digest}"
+
+  # 64 bits of the key's hash; never 0, which marks a row that is being written
+  @staticmethod
+  def _tag(key: str) -> int:
+    return int(key[-16:], 16) | 1
+
+  # function to look up cached vectors; returns the vectors found and the positions still missing
+  def get_many(self, texts: List[str]):
+    keys = [self.make_key(text) for text in texts]
+    found = np.zeros((len(texts), self.dimension), dtype=np.float32)
+    missing = []
+
+    for i, key in enumerate(keys):
+      slot = self.slots.get(key)
+      if slot is not None and int(self.tags[slot]) != self._tag(key):
+        # the row was reused for another entry after the index was last written
+        del self.slots[key]
+        self._free.append(slot)
+        self._dirty = True
+        self.stale += 1
+        slot = None
+      if slot is None:
+        self.misses += 1
+        missing.append(i)
+      else:
+        self.slots.move_to_end(key)
+        found[i] = self.values[slot]
+        self.hits += 1
+
+    return found, missing, keys
+
+  # function to store freshly computed vectors, evicting least recently used entries when full
+  def put_many(self, keys: List[str], vectors: np.ndarray):
+    if len(keys) != len(vectors):
+      raise ValueError("Mismatch between keys and vectors count")
+
+    for key, vector in zip(keys, vectors):
+      slot = self.slots.get(key)
+      if slot is None:
+        slot = self._allocate_slot()
+      # the row is untagged while it is rewritten, so a process killed halfway leaves a miss, not a wrong vector
+      self.tags[slot] = 0
+      self.values[slot] = vector
+      self.tags[slot] = self._tag(key)
+      self.slots[key] = slot
+      self.slots.move_to_end(key)
+    self._dirty = True
+
+    self._pending_writes += len(keys)
+    if self._pending_writes >= self.flush_interval:
+      self.flush()
+
+  # a full cache reuses the row of its least recently used entry
+  def _allocate_slot(self) -> int:
+    if self._free:
+      return self._free.pop()
+    _, slot = self.slots.popitem(last=False)
+    self.evictions += 1
+    return slot
+
+  # function to persist the key index; values are already written through the memory map
+  def flush(self):
+    if not self._dirty:
+      return
+    self.values.flush()
+    self.tags.flush()
+    index = {
+        "model_name": self.model_name,
+        "dimension": self.dimension,
+        "max_entries": self.max_entries,
+        "keys": list(self.slots.keys()),
+        "slots": list(self.slots.values())
+    }
+    tmp_path = os.path.join(self.cache_dir, self.INDEX_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump(index, f)
+    os.replace(tmp_path, os.path.join(self.cache_dir, self.INDEX_FILE))
+    self._dirty = False
+    self._pending_writes = 0
+
+  # function to write the key index and stop flushing this cache at exit
+  def close(self):
+    self.flush()
+    _open_caches.discard(self)
+
+  def clear(self):
+    self.slots.clear()
+    self._free = list(range(self.max_entries - 1, -1, -1))
+    self._dirty = True
+    self.flush()
+
+  def _load_index(self):
+    index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+    if not os.path.exists(index_path):
+      return
+
+    with open(index_path, "r", encoding="utf-8") as f:
+      index = json.load(f)
+
+    if index["dimension"] != self.dimension or index["model_name"] != self.model_name:
+      raise ValueError(
+          f"Embedding cache at {self.cache_dir} was built for {index['model_name']} "
+          f"({index['dimension']} dims), not {self.model_name} ({self.dimension} dims)"
+      )
+
+    self.slots = OrderedDict(zip(index["keys"], index["slots"]))
+    self._stored_entries = index["max_entries"]
+
+  # function to map the vectors and their row tags
+  def _open_values(self):
+    values_path = os.path.join(self.cache_dir, self.VALUES_FILE)
+    tags_path = os.path.join(self.cache_dir, self.TAGS_FILE)
+    shape = (self.max_entries, self.dimension)
+    stored_entries = self._stored_entries
+
+    if not os.path.exists(values_path):
+      self.slots.clear()
+      return (np.memmap(values_path, dtype=np.float32, mode="w+", shape=shape),
+              np.memmap(tags_path, dtype=np.uint64, mode="w+", shape=(self.max_entries,)))
+
+    old_tags = None
+    if os.path.exists(tags_path):
+      old_tags = np.memmap(tags_path, dtype=np.uint64, mode="r")
+    if old_tags is not None and len(old_tags) != (stored_entries or self.max_entries):
+      old_tags = None
+
+    if stored_entries is None or stored_entries == self.max_entries:
+      if old_tags is None:
+        # caches written before rows were tagged trust their index once
+        self._write_tags(tags_path, self.slots.items())
+      del old_tags
+      return (np.memmap(values_path, dtype=np.float32, mode="r+", shape=shape),
+              np.memmap(tags_path, dtype=np.uint64, mode="r+", shape=(self.max_entries,)))
+
+    # capacity changed: keep the most recently used entries that still own their rows and copy them into a resized store
+    survivors = [(key, slot) for key, slot in self.slots.items() if old_tags is None or int(old_tags[slot]) == self._tag(key)]
+    survivors = survivors[-self.max_entries:]
+    del old_tags
+    old = np.memmap(values_path, dtype=np.float32, mode="r", shape=(stored_entries, self.dimension))
+    values = np.memmap(values_path + ".tmp", dtype=np.float32, mode="w+", shape=shape)
+    for new_slot, (_, old_slot) in enumerate(survivors):
+      values[new_slot] = old[old_slot]
+    values.flush()
+    del old, values
+    os.replace(values_path + ".tmp", values_path)
+
+    self.slots = OrderedDict((key, i) for i, (key, _) in enumerate(survivors))
+    self._write_tags(tags_path, self.slots.items())
+    self._dirty = True
+    return (np.memmap(values_path, dtype=np.float32, mode="r+", shape=shape),
+            np.memmap(tags_path, dtype=np.uint64, mode="r+", shape=(self.max_entries,)))
+
+  def _write_tags(self, tags_path: str, slots):
+    tags = np.memmap(tags_path + ".tmp", dtype=np.uint64, mode="w+", shape=(self.max_entries,))
+    for key, slot in slots:
+      tags[slot] = self._tag(key)
+    tags.flush()
+    del tags
+    os.replace(tags_path + ".tmp", tags_path)
+
+  def __len__(self) -> int:
+    return len(self.slots)
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  def get_stats(self) -> dict:
+    return {
+        "entries": len(self.slots),
+        "max_entries": self.max_entries,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "stale": self.stale,
+        "hit_rate": self.hit_rate
+    }
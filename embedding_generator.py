@@ -1,7 +1,8 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import Union, List
-import torch
+from typing import Union, List, Dict
+from embedding_cache import EmbeddingCache
+from inference_backends import BACKENDS, load_sentence_transformer
+from telemetry import telemetry
 
 class EmbeddingGenerator:
 
@@ -11,30 +12,76 @@ class EmbeddingGenerator:
         "mpnet": "sentence-transformers/all-mpnet-base-v2"    # note: cosine similarity tests found that mpnet is best
     }
     
-    def __init__(self, model_name: str = "mpnet", device: str = "auto"):
+    def __init__(self,
+                 model_name: str = "mpnet",
+                 device: str = "auto",
+                 cache_dir: str = None,
+                 cache_max_entries: int = 200000,
+                 backend: str = "torch",
+                 onnx_dir: str = None):
       if model_name not in self.MODEL_MAP:
         raise ValueError(f"Invalid model name. Choose from: {list(self.MODEL_MAP.keys())}")
+      if backend not in BACKENDS:
+        raise ValueError(f"Invalid backend. Choose from: {list(BACKENDS)}")
       
       self.model_name = model_name
+      self.backend = backend      # torch, torch_int8, onnx or onnx_int8; the int8 backends are for cpu-only nodes
+      self.onnx_dir = onnx_dir    # where the quantized onnx export is kept
       self.model = self._load_model(device)
+
+      # optional on-disk cache so re-ingested chunks skip the forward pass
+      self.cache = None
+      if cache_dir:
+        # quantized embeddings drift slightly, so each backend gets its own cache entries
+        self.cache = EmbeddingCache(
+          cache_dir,
+          model_name=self.MODEL_MAP[model_name] + ("" if backend == "torch" else f"@{backend}"),
+          dimension=self.embedding_size,
+          max_entries=cache_max_entries
+        )
         
     # function to load in selected model
-    def _load_model(self, device: str) -> SentenceTransformer:
+    def _load_model(self, device: str):
       # use cpu vs gpu
       # change in google colab via runtime type
-      if device == "auto":
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-      
-      return SentenceTransformer(
+      return load_sentence_transformer(
         self.MODEL_MAP[self.model_name],
-        device=device
+        backend=self.backend,
+        device=device,
+        onnx_dir=self.onnx_dir
       )
     
     # function that embeds the chunks using the chosen embedding model
-    def embed_text(self, texts: Union[str, List[str]], batch_size: int = 32) -> np.ndarray:
+    def embed_text(self, texts: Union[str, List[str], List[Dict]], batch_size: int = 32) -> np.ndarray:
       if isinstance(texts, str):
         texts = [texts]
-          
+      # accept chunk dicts straight from TextChunker
+      texts = [t["text"] if isinstance(t, dict) else t for t in texts]
+
+      with telemetry.span("embed", texts=len(texts), backend=self.backend) as span:
+        telemetry.observe("batch_size", len(texts), stage="embed")
+        if self.cache is None:
+          return self._encode(texts, batch_size)
+
+        # only chunks missing from the cache go to the model
+        embeddings, missing, keys = self.cache.get_many(texts)
+        span.set("cache_misses", len(missing))
+        telemetry.count("cache_hits_total", len(texts) - len(missing), cache="embedding")
+        telemetry.count("cache_misses_total", len(missing), cache="embedding")
+        if missing:
+          unique_missing = {}
+          for i in missing:
+            unique_missing.setdefault(keys[i], i)
+          new_embeddings = self._encode([texts[i] for i in unique_missing.values()], batch_size)
+          self.cache.put_many(list(unique_missing.keys()), new_embeddings)
+
+          rows = {key: row for row, key in enumerate(unique_missing.keys())}
+          for i in missing:
+            embeddings[i] = new_embeddings[rows[keys[i]]]
+
+        return embeddings
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
       return self.model.encode(
         texts,
         batch_size=batch_size,
@@ -43,6 +90,12 @@ class EmbeddingGenerator:
         normalize_embeddings=True
       )
     
+    # function to run one dummy batch, so kernel selection and allocator growth happen before the first real query;
+    # it bypasses the cache, which would otherwise keep the dummy text
+    def warmup(self):
+      with telemetry.span("warmup", component="embedder", backend=self.backend):
+        self._encode(["warmup"], batch_size=1)
+
     # for displaying specs of the model used; mini-LM has 384 dimensions, the other 2 have 768
     @property
     def embedding_size(self) -> int:
@@ -53,5 +106,7 @@ class EmbeddingGenerator:
         "name": self.model_name,
         "dimensions": self.embedding_size,
         "max_sequence_length": self.model.max_seq_length,
-        "device": str(self.model.device)
+        "device": str(self.model.device),
+        "backend": self.backend,
+        "cache": self.cache.get_stats() if self.cache else None
       }
\ No newline at end of file
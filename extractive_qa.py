@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import json
+import re
+import string
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from squad_parser import SquadParser
+from reranker import Reranker
+from inference_backends import BACKENDS
+from telemetry import telemetry
+
+# SQuAD answer normalization: lowercase, no punctuation or articles, single spaces
+def normalize_answer(text: str) -> str:
+  text = "".join(ch for ch in text.lower() if ch not in string.punctuation)
+  text = re.sub(r"\b(a|an|the)\b", " ", text)
+  return " ".join(text.split())
+
+# function to score a prediction against the gold answers as SQuAD does: (exact match, token F1), best over the golds
+# an unanswerable question has no golds, so any prediction scores 0
+def answer_scores(prediction: str, golds: List[str]) -> Tuple[float, float]:
+  predicted = normalize_answer(prediction).split()
+  exact, f1 = 0.0, 0.0
+  for gold in golds:
+    expected = normalize_answer(gold).split()
+    exact = max(exact, float(predicted == expected))
+    common = sum((Counter(predicted) & Counter(expected)).values())
+    if common:
+      precision, recall = common / len(predicted), common / len(expected)
+      f1 = max(f1, 2 * precision * recall / (precision + recall))
+  return exact, f1
+
+class ExtractiveQA:
+
+  # a small SQuAD 2.0 reader run on the CPU over the top reranked chunks. it either points at an answer span or
+  # abstains, and a span is only accepted when the reader's confidence and the cross-encoder relevance of its chunk
+  # both reach the thresholds written by this module's calibration CLI; everything else is left to the LLM.
+  # reranker_name is the cross-encoder that scores the chunks, since min_relevance is calibrated on its scale
+  def __init__(self,
+               model_name: str = "deepset/tinyroberta-squad2",
+               reranker_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+               device: str = "cpu",
+               min_span_score: float = 0.5,
+               min_relevance: float = 0.0,
+               max_chunks: int = 3,
+               max_answer_len: int = 30,
+               batch_size: int = 16,
+               thresholds_path: str = None):
+    self.model_name = model_name
+    self.reranker_name = reranker_name
+    self.device = device
+    self.min_span_score = min_span_score
+    self.min_relevance = min_relevance
+    self.max_chunks = max_chunks
+    self.max_answer_len = max_answer_len
+    self.batch_size = batch_size
+    self._pipeline = None
+
+    if thresholds_path:
+      self.load_thresholds(thresholds_path)
+
+  # the transformers pipeline is only built on first use
+  @property
+  def pipeline(self):
+    if self._pipeline is None:
+      from transformers import pipeline
+      self._pipeline = pipeline("question-answering", model=self.model_name, tokenizer=self.model_name, device=self.device)
+    return self._pipeline
+
+  # function to take the thresholds from a file written by the calibration CLI
+  def load_thresholds(self, path: str):
+    with open(path, "r", encoding="utf-8") as f:
+      calibration = json.load(f)
+    if calibration.get("model", self.model_name) != self.model_name:
+      raise ValueError(f"Thresholds in {path} were calibrated for {calibration['model']}, not {self.model_name}")
+    if calibration.get("reranker", self.reranker_name) != self.reranker_name:
+      raise ValueError(f"Thresholds in {path} were calibrated on {calibration['reranker']} relevance scores, "
+                       f"not {self.reranker_name}")
+    self.min_span_score = calibration["min_span_score"]
+    self.min_relevance = calibration["min_relevance"]
+
+  # function to find the best answer span for each question in its top chunks; None where the reader abstains
+  # on every chunk. all (question, chunk) pairs go through the reader in one batched call
+  def extract_batch(self, questions: List[str], chunk_lists: List[List[Dict]]) -> List[Optional[Dict]]:
+    if len(questions) != len(chunk_lists):
+      raise ValueError("Mismatch between questions and chunk lists count")
+
+    pairs = [(row, chunk) for row, chunks in enumerate(chunk_lists) for chunk in chunks[:self.max_chunks]]
+    best = [None] * len(questions)
+    if not pairs:
+      return best
+
+    with telemetry.span("extract", questions=len(questions), pairs=len(pairs)):
+      outputs = self.pipeline(
+          question=[questions[row] for row, _ in pairs],
+          context=[chunk["chunk"] for _, chunk in pairs],
+          top_k=1,
+          max_answer_len=self.max_answer_len,
+          handle_impossible_answer=True,
+          batch_size=self.batch_size
+      )
+    if isinstance(outputs, dict):
+      outputs = [outputs]
+
+    for (row, chunk), output in zip(pairs, outputs):
+      # an empty answer is the reader's no-answer prediction
+      if not output["answer"].strip():
+        continue
+      if best[row] is None or output["score"] > best[row]["score"]:
+        best[row] = {
+            "answer": output["answer"].strip(),
+            "score": float(output["score"]),
+            "relevance": chunk.get("relevance"),
+            "source": {
+                "id": chunk.get("id"),
+                "doc_id": chunk.get("doc_id"),
+                "metadata": chunk.get("metadata", {}),
+                "start": int(output["start"]),
+                "end": int(output["end"])
+            }
+        }
+    return best
+
+  # a span without a cross-encoder relevance (chunks that were not reranked) is never accepted
+  def accept(self, span: Optional[Dict]) -> bool:
+    return (span is not None
+            and span["relevance"] is not None
+            and span["score"] >= self.min_span_score
+            and span["relevance"] >= self.min_relevance)
+
+  # function to answer from the reranked chunks; returns the accepted span with its source, or None
+  def answer(self, question: str, context_chunks: List[Dict]) -> Optional[Dict]:
+    span = self.extract_batch([question], [context_chunks])[0]
+    return span if self.accept(span) else None
+
+  def warmup(self):
+    with telemetry.span("warmup", component="extractive_qa"):
+      self.extract_batch(["warmup"], [[{"chunk": "warmup"}]])
+
+class FastPathAnswerer:
+
+  # answers locally when the extractive reader is confident and falls back to prompt + LLM otherwise
+  def __init__(self, extractor: ExtractiveQA, llm, prompt_engineer):
+    self.extractor = extractor
+    self.llm = llm
+    self.prompt_engineer = prompt_engineer
+
+    self.local_answers = 0
+    self.llm_calls = 0
+    self.local_seconds = 0.0
+    self.llm_seconds = 0.0
+
+  # function to answer a question from its reranked chunks: {"answer", "source", "path"}; source is None for LLM answers
+  def answer(self, question: str, context_chunks: List[Dict]) -> Dict:
+    start = time.time()
+    span = self.extractor.answer(question, context_chunks)
+    self.local_seconds += time.time() - start
+    if span is not None:
+      return self._local(span)
+
+    start = time.time()
+    answer = self.llm.answer_query(self.prompt_engineer.format_prompt(question, context_chunks))
+    return self._from_llm(answer, time.time() - start)
+
+  # same as answer() for AsyncDeepSeekLLM; the reader runs in a worker thread so the event loop is not blocked
+  async def aanswer(self, question: str, context_chunks: List[Dict]) -> Dict:
+    start = time.time()
+    span = await asyncio.to_thread(self.extractor.answer, question, context_chunks)
+    self.local_seconds += time.time() - start
+    if span is not None:
+      return self._local(span)
+
+    start = time.time()
+    answer = await self.llm.aanswer_query(self.prompt_engineer.format_prompt(question, context_chunks))
+    return self._from_llm(answer, time.time() - start)
+
+  def _local(self, span: Dict) -> Dict:
+    self.local_answers += 1
+    telemetry.count("answers_total", path="extractive")
+    return {"answer": span["answer"], "source": span["source"], "path": "extractive", "score": span["score"], "relevance": span["relevance"]}
+
+  def _from_llm(self, answer: str, seconds: float) -> Dict:
+    self.llm_calls += 1
+    self.llm_seconds += seconds
+    telemetry.count("answers_total", path="llm")
+    return {"answer": answer, "source": None, "path": "llm"}
+
+  def get_stats(self) -> Dict:
+    total = self.local_answers + self.llm_calls
+    return {
+        "questions": total,
+        "answered_locally": self.local_answers,
+        "llm_calls": self.llm_calls,
+        "llm_calls_avoided": self.local_answers / total if total else 0.0,
+        "extractive_seconds": self.local_seconds,
+        "llm_seconds": self.llm_seconds
+    }
+
+# function to run reranker + reader over SQuAD questions the way the fast path sees them: each question's own
+# paragraph and `distractors` random other paragraphs are reranked, and the reader's best span in the top chunks is
+# scored against the gold answers. unanswerable (SQuAD 2.0) questions are wrong whenever a span comes back
+def squad_records(extractor: ExtractiveQA, reranker: Reranker, parser: SquadParser, questions: List[Dict],
+                  distractors: int = 4, seed: int = 0, batch_size: int = 32) -> List[Dict]:
+  rng = np.random.default_rng(seed)
+  records = []
+  for start in range(0, len(questions), batch_size):
+    batch = questions[start:start + batch_size]
+    candidate_lists = []
+    for qa in batch:
+      candidates = [{"chunk": qa["context"], "id": f"{qa.get('id')}-gold", "doc_id": "gold", "metadata": {}}]
+      for row in rng.choice(len(parser), size=min(distractors, len(parser)), replace=False).tolist():
+        context = parser.get_context(row)
+        if context != qa["context"]:
+          candidates.append({"chunk": context, "doc_id": f"squad-{row}", "metadata": {}})
+      candidate_lists.append(candidates)
+
+    reranked = reranker.rerank_batch([qa["question"] for qa in batch], candidate_lists, top_k=extractor.max_chunks)
+    spans = extractor.extract_batch([qa["question"] for qa in batch], reranked)
+    for qa, span in zip(batch, spans):
+      golds = [answer["text"] for answer in qa.get("answers", [])]
+      exact, f1 = answer_scores(span["answer"], golds) if span is not None else (0.0, 0.0)
+      records.append({
+          "span_score": np.nan if span is None else span["score"],
+          "relevance": np.nan if span is None else span["relevance"],
+          "exact": exact,
+          "f1": f1,
+          "answerable": bool(golds)
+      })
+  return records
+
+def _columns(records: List[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+  return tuple(np.array([record[key] for record in records], dtype=np.float64) for key in ("span_score", "relevance", "exact", "f1"))
+
+# function to pick the thresholds that answer the most questions locally while the exact-match accuracy of those
+# answers stays at or above target_accuracy; candidate thresholds are quantiles of the observed scores
+def calibrate(records: List[Dict], target_accuracy: float = 0.9, min_answered: int = 20, grid: int = 41) -> Dict:
+  scores, relevances, exact, _ = _columns(records)
+  has_span = ~np.isnan(scores)
+  if not has_span.any():
+    raise ValueError("The reader returned no spans to calibrate on")
+
+  quantiles = np.linspace(0, 1, grid)
+  score_grid = np.unique(np.quantile(scores[has_span], quantiles))
+  relevance_grid = np.unique(np.quantile(relevances[has_span], quantiles))
+
+  with np.errstate(invalid="ignore"):
+    answered = (scores[None, None, :] >= score_grid[:, None, None]) & (relevances[None, None, :] >= relevance_grid[None, :, None])
+  counts = answered.sum(axis=2)
+  accuracy = (answered * exact).sum(axis=2) / np.maximum(counts, 1)
+
+  feasible = (accuracy >= target_accuracy) & (counts >= min_answered)
+  if not feasible.any():
+    # nothing reaches the target, so the fast path is switched off: no span score reaches infinity
+    return {"min_span_score": float("inf"), "min_relevance": float("inf"), "target_accuracy": target_accuracy, "target_met": False}
+
+  # most questions answered first, then the more accurate of equally large choices
+  ranking = np.where(feasible, counts + accuracy / 2, -1.0)
+  i, j = np.unravel_index(np.argmax(ranking), ranking.shape)
+  return {
+      "min_span_score": float(score_grid[i]),
+      "min_relevance": float(relevance_grid[j]),
+      "target_accuracy": target_accuracy,
+      "target_met": True
+  }
+
+# function to report answer accuracy on the locally answered questions against the share of LLM calls avoided
+def evaluate(records: List[Dict], min_span_score: float, min_relevance: float) -> Dict:
+  scores, relevances, exact, f1 = _columns(records)
+  with np.errstate(invalid="ignore"):
+    answered = (scores >= min_span_score) & (relevances >= min_relevance)
+  answerable = np.array([record["answerable"] for record in records], dtype=bool)
+  count = int(answered.sum())
+  return {
+      "questions": len(records),
+      "answered_locally": count,
+      "llm_calls_avoided": count / len(records) if records else 0.0,
+      "exact_match": float(exact[answered].mean()) if count else 0.0,
+      "f1": float(f1[answered].mean()) if count else 0.0,
+      "unanswerable_answered": int((answered & ~answerable).sum()),
+      "reader_exact_match_all": float(exact[answerable].mean()) if answerable.any() else 0.0
+  }
+
+def main():
+  parser = argparse.ArgumentParser(description="Calibrate and evaluate the extractive fast path's thresholds on SQuAD")
+  parser.add_argument("squad", help="path to a SQuAD json file, e.g. dev-v2.0.json")
+  parser.add_argument("--output", default="extractive_thresholds.json", help="where to write the thresholds")
+  parser.add_argument("--model", default="deepset/tinyroberta-squad2", help="extractive QA model")
+  parser.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+  parser.add_argument("--backend", default="torch", choices=list(BACKENDS), help="reranker backend")
+  parser.add_argument("--calibration-questions", type=int, default=1000)
+  parser.add_argument("--eval-questions", type=int, default=1000, help="held-out questions the thresholds are evaluated on")
+  parser.add_argument("--answerable-fraction", type=float, default=0.8)
+  parser.add_argument("--distractors", type=int, default=4, help="random other paragraphs reranked with each question's own")
+  parser.add_argument("--max-chunks", type=int, default=3, help="top reranked chunks the reader looks at")
+  parser.add_argument("--target-accuracy", type=float, default=0.9, help="exact-match accuracy required of local answers")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+
+  squad = SquadParser(args.squad)
+  questions = squad.sample_questions(args.calibration_questions + args.eval_questions, args.answerable_fraction, seed=args.seed)
+  extractor = ExtractiveQA(model_name=args.model, reranker_name=args.reranker, max_chunks=args.max_chunks)
+  reranker = Reranker(model_name=args.reranker, backend=args.backend)
+
+  start = time.time()
+  records = squad_records(extractor, reranker, squad, questions, distractors=args.distractors, seed=args.seed)
+  print(f"Scored {len(records)} questions in {time.time() - start:.1f}s")
+  calibration_records, eval_records = records[:args.calibration_questions], records[args.calibration_questions:]
+
+  # accuracy against LLM calls avoided on the held-out questions, for a few accuracy targets
+  print(f"{'target':>8} {'min score':>10} {'min relevance':>14} {'exact match':>12} {'f1':>7} {'llm calls avoided':>18}")
+  chosen = None
+  for target in sorted({0.8, 0.85, 0.9, 0.95, args.target_accuracy}):
+    thresholds = calibrate(calibration_records, target_accuracy=target)
+    report = evaluate(eval_records, thresholds["min_span_score"], thresholds["min_relevance"])
+    flag = "" if thresholds["target_met"] else "  (target not reached on calibration set; fast path off)"
+    print(f"{target:>8.2f} {thresholds['min_span_score']:>10.3f} {thresholds['min_relevance']:>14.3f} "
+          f"{report['exact_match']:>12.3f} {report['f1']:>7.3f} {report['llm_calls_avoided']:>18.1%}{flag}")
+    if target == args.target_accuracy:
+      chosen = dict(thresholds, evaluation=report)
+
+  chosen.update(model=args.model, reranker=args.reranker, max_chunks=args.max_chunks, config=vars(args))
+  with open(args.output, "w", encoding="utf-8") as f:
+    json.dump(chosen, f, indent=2)
+  print(f"Thresholds for target {args.target_accuracy:.2f} written to {args.output}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,167 @@
+import argparse
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+
+# torch fp32, dynamic int8 torch (cpu only), onnx runtime, and onnx runtime with dynamic int8 weights
+BACKENDS = ("torch", "torch_int8", "onnx", "onnx_int8")
+
+def resolve_device(device: str) -> str:
+  if device != "auto":
+    return device
+  import torch
+  return "cuda" if torch.cuda.is_available() else "cpu"
+
+def _check_backend(backend: str):
+  if backend not in BACKENDS:
+    raise ValueError(f"Invalid backend. Choose from: {list(BACKENDS)}")
+
+# dynamic quantization: Linear weights are stored as int8 and activations are quantized on the fly
+def _quantize_torch(module):
+  import torch
+  torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+# quantized onnx models are exported once into onnx_dir and reused on later loads
+def _onnx_int8_dir(model_id: str, onnx_dir: str = None) -> str:
+  return onnx_dir or os.path.join("onnx_models", model_id.replace("/", "__"))
+
+ONNX_INT8_FILE = "onnx/model_qint8.onnx"
+
+def _has_onnx_int8(export_dir: str) -> bool:
+  return os.path.exists(os.path.join(export_dir, ONNX_INT8_FILE))
+
+def _export_onnx_int8(model, export_dir: str, quantization: str):
+  from sentence_transformers import export_dynamic_quantized_onnx_model
+  model.save_pretrained(export_dir)
+  export_dynamic_quantized_onnx_model(model, quantization, export_dir, file_suffix="qint8")
+
+# function to load a bi-encoder with the chosen backend; quantization is the onnx int8 target ("avx2", "avx512", "avx512_vnni", "arm64")
+def load_sentence_transformer(model_id: str, backend: str = "torch", device: str = "auto", onnx_dir: str = None, quantization: str = "avx2"):
+  from sentence_transformers import SentenceTransformer
+  _check_backend(backend)
+  device = resolve_device(device)
+
+  if backend == "torch":
+    return SentenceTransformer(model_id, device=device)
+  if backend == "torch_int8":
+    model = SentenceTransformer(model_id, device="cpu")
+    _quantize_torch(model[0].auto_model)
+    return model
+
+  if backend == "onnx_int8":
+    # the fp32 onnx model is only loaded to produce the quantized export, so a cached export skips it
+    export_dir = _onnx_int8_dir(model_id, onnx_dir)
+    if not _has_onnx_int8(export_dir):
+      _export_onnx_int8(SentenceTransformer(model_id, device=device, backend="onnx"), export_dir, quantization)
+    return SentenceTransformer(export_dir, device="cpu", backend="onnx", model_kwargs={"file_name": ONNX_INT8_FILE})
+  return SentenceTransformer(model_id, device=device, backend="onnx")
+
+# function to load a cross-encoder with the chosen backend
+def load_cross_encoder(model_id: str, backend: str = "torch", device: str = "auto", onnx_dir: str = None, quantization: str = "avx2"):
+  from sentence_transformers import CrossEncoder
+  _check_backend(backend)
+  device = resolve_device(device)
+
+  if backend == "torch":
+    model = CrossEncoder(model_id)
+    model.model.to(device)
+    return model
+  if backend == "torch_int8":
+    model = CrossEncoder(model_id, device="cpu")
+    _quantize_torch(model.model)
+    return model
+
+  if backend == "onnx_int8":
+    export_dir = _onnx_int8_dir(model_id, onnx_dir)
+    if not _has_onnx_int8(export_dir):
+      _export_onnx_int8(CrossEncoder(model_id, device=device, backend="onnx"), export_dir, quantization)
+    return CrossEncoder(export_dir, device="cpu", backend="onnx", model_kwargs={"file_name": ONNX_INT8_FILE})
+  return CrossEncoder(model_id, device=device, backend="onnx")
+
+def _timed(fn, *args):
+  fn(*(arg[:1] for arg in args))    # warm-up, so lazy initialization is not timed
+  start = time.time()
+  result = fn(*args)
+  return result, time.time() - start
+
+# function to compare a backend's embeddings against the fp32 reference; embeddings are normalized, so the row-wise dot product is the cosine
+def embedding_parity(reference, candidate, texts: List[str], batch_size: int = 32) -> Dict[str, float]:
+  reference_embeddings, reference_seconds = _timed(lambda t: reference._encode(t, batch_size), texts)
+  candidate_embeddings, candidate_seconds = _timed(lambda t: candidate._encode(t, batch_size), texts)
+
+  cosines = np.sum(reference_embeddings * candidate_embeddings, axis=1)
+  return {
+      "mean_cosine": float(cosines.mean()),
+      "min_cosine": float(cosines.min()),
+      "max_cosine_drift": float(1 - cosines.min()),
+      "reference_texts_per_second": len(texts) / reference_seconds if reference_seconds > 0 else 0.0,
+      "candidate_texts_per_second": len(texts) / candidate_seconds if candidate_seconds > 0 else 0.0,
+      "speedup": reference_seconds / candidate_seconds if candidate_seconds > 0 else 0.0
+  }
+
+# function to compare a backend's rerank order against the fp32 reference
+# pairwise_agreement is the share of candidate pairs both models order the same way (1.0 means identical rankings)
+def rerank_parity(reference, candidate, queries: List[str], candidate_lists: List[List[Dict]], top_k: int = 5) -> Dict[str, float]:
+  pairs = [(query, c["chunk"]) for query, candidates in zip(queries, candidate_lists) for c in candidates]
+  # scoring through _predict skips the score caches, which would hide the model difference
+  reference_scores, reference_seconds = _timed(lambda p: reference._predict(reference.model, p), pairs)
+  candidate_scores, candidate_seconds = _timed(lambda p: candidate._predict(candidate.model, p), pairs)
+
+  top1, overlap, agreement = [], [], []
+  start = 0
+  for candidates in candidate_lists:
+    end = start + len(candidates)
+    if end - start < 2:
+      start = end
+      continue
+    ref, cand = reference_scores[start:end], candidate_scores[start:end]
+    ref_order, cand_order = np.argsort(-ref, kind="stable"), np.argsort(-cand, kind="stable")
+    k = min(top_k, len(candidates))
+
+    top1.append(float(ref_order[0] == cand_order[0]))
+    overlap.append(len(set(ref_order[:k].tolist()) & set(cand_order[:k].tolist())) / k)
+    upper = np.triu_indices(len(candidates), 1)
+    agreement.append(float(np.mean(np.sign(ref[:, None] - ref[None, :])[upper] == np.sign(cand[:, None] - cand[None, :])[upper])))
+    start = end
+
+  return {
+      "top1_agreement": float(np.mean(top1)) if top1 else 1.0,
+      f"top{top_k}_overlap": float(np.mean(overlap)) if overlap else 1.0,
+      "pairwise_agreement": float(np.mean(agreement)) if agreement else 1.0,
+      "reference_pairs_per_second": len(pairs) / reference_seconds if reference_seconds > 0 else 0.0,
+      "candidate_pairs_per_second": len(pairs) / candidate_seconds if candidate_seconds > 0 else 0.0,
+      "speedup": reference_seconds / candidate_seconds if candidate_seconds > 0 else 0.0
+  }
+
+
+def main():
+  from embedding_generator import EmbeddingGenerator
+  from reranker import Reranker
+
+  parser = argparse.ArgumentParser(description="Check a quantized/ONNX backend against fp32 PyTorch on CPU")
+  parser.add_argument("texts", help="text file with one passage per line")
+  parser.add_argument("--backend", default="onnx_int8", choices=list(BACKENDS))
+  parser.add_argument("--model", default="mpnet", choices=list(EmbeddingGenerator.MODEL_MAP.keys()))
+  parser.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+  parser.add_argument("--queries", type=int, default=8, help="passages whose first words are reused as rerank queries")
+  parser.add_argument("--top-k", type=int, default=5)
+  args = parser.parse_args()
+
+  with open(args.texts, "r", encoding="utf-8") as f:
+    texts = [line.strip() for line in f if line.strip()]
+
+  reference = EmbeddingGenerator(model_name=args.model, device="cpu")
+  candidate = EmbeddingGenerator(model_name=args.model, device="cpu", backend=args.backend)
+  print("Embeddings:", embedding_parity(reference, candidate, texts))
+
+  queries = [" ".join(text.split()[:10]) for text in texts[:args.queries]]
+  candidate_lists = [[{"chunk": text} for text in texts[:50]] for _ in queries]
+  reference = Reranker(model_name=args.reranker, device="cpu")
+  candidate = Reranker(model_name=args.reranker, device="cpu", backend=args.backend)
+  print("Rerank:", rerank_parity(reference, candidate, queries, candidate_lists, top_k=args.top_k))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,62 @@
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List
+from document_loader import DocumentLoader
+from text_chunker import TextChunker
+from embedding_generator import EmbeddingGenerator
+from vector_store import VectorStore
+from telemetry import telemetry
+
+class IngestionPipeline:
+
+  def __init__(self,
+               loader: DocumentLoader,
+               chunker: TextChunker,
+               embedder: EmbeddingGenerator,
+               vector_store: VectorStore,
+               batch_size: int = 256):
+    self.loader = loader
+    self.chunker = chunker
+    self.embedder = embedder
+    self.vector_store = vector_store
+    self.batch_size = batch_size    # chunks per embedding batch; bounds peak memory
+
+  # function to stream one PDF into the vector store: pages are extracted, cleaned and chunked lazily
+  # and chunks are embedded in fixed-size batches, so memory use depends on batch_size rather than document size
+  def ingest(self, file_path: str, doc_id: str = None) -> Dict:
+    doc_id = doc_id or file_path
+    metadata = self.loader.load_metadata(file_path)
+
+    start = time.time()
+    page_counter = {"pages": 0}
+    pages = self._count_pages(self.loader.iter_pages(file_path), page_counter)
+    chunks = self.chunker.chunk_pages(pages, metadata)
+
+    with telemetry.span("ingest", doc_id=doc_id) as span:
+      stats = self.vector_store.upsert_document_stream(doc_id, self._batches(chunks), self.embedder.embed_text)
+      span.set("pages", page_counter["pages"])
+      span.set("chunks_added", stats["added"])
+
+    elapsed = time.time() - start
+    stats["pages"] = page_counter["pages"]
+    stats["seconds"] = elapsed
+    stats["pages_per_second"] = page_counter["pages"] / elapsed if elapsed > 0 else 0.0
+    # with a parse cache, only chunks touching these pages can be new, so only they were embedded
+    if self.loader.cache is not None:
+      stats["changed_pages"] = self.loader.last_changes["changed_pages"]
+      stats["removed_pages"] = self.loader.last_changes["removed_pages"]
+    return stats
+
+  @staticmethod
+  def _count_pages(pages: Iterable, counter: Dict) -> Iterator:
+    for page in pages:
+      counter["pages"] += 1
+      yield page
+
+  def _batches(self, chunks: Iterable[Dict]) -> Iterator[List[Dict]]:
+    chunks = iter(chunks)
+    while True:
+      batch = list(islice(chunks, self.batch_size))
+      if not batch:
+        return
+      yield batch
@@ -0,0 +1,32 @@
+import importlib
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+
+  # stands in for a heavy module (faiss, fitz, requests, aiohttp) until one of its attributes is first used, so
+  # importing a component costs nothing for tasks that never reach that code path. after the real import its
+  # attributes are copied onto the proxy, so later lookups are plain attribute hits
+  def __init__(self, name: str):
+    super().__init__(name)
+
+  def __getattr__(self, attribute: str):
+    # python's own import lock makes concurrent first uses safe; the module is only imported once
+    module = importlib.import_module(self.__name__)
+    self.__dict__.update(module.__dict__)
+    return getattr(module, attribute)
+
+  def __dir__(self):
+    return dir(importlib.import_module(self.__name__))
+
+  def __repr__(self) -> str:
+    return f"<lazy module {self.__name__!r}{' (loaded)' if is_loaded(self.__name__) else ''}>"
+
+
+# function to get a module that is only imported on first use: `faiss = lazy_module("faiss")`
+# an already imported module is returned as it is
+def lazy_module(name: str) -> types.ModuleType:
+  return sys.modules.get(name) or LazyModule(name)
+
+def is_loaded(name: str) -> bool:
+  return name in sys.modules
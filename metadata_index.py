@@ -0,0 +1,191 @@
+import json
+from array import array
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Tuple, Union
+import numpy as np
+
+Timestamp = Union[float, int, str, date, datetime]
+
+# function to turn an epoch timestamp, a datetime/date or an ISO-8601 string into epoch seconds
+def to_timestamp(value: Timestamp) -> float:
+  if isinstance(value, str):
+    value = datetime.fromisoformat(value)
+  if isinstance(value, datetime):
+    return value.timestamp()
+  if isinstance(value, date):
+    return datetime(value.year, value.month, value.day).timestamp()
+  return float(value)
+
+class SearchFilter:
+
+  # every given condition must hold (AND); list values match any of their items (OR)
+  #   doc_ids          documents to search in
+  #   pages            (first, last) page range, inclusive; either end may be None. chunks overlapping it match
+  #   author, title    exact document author / title
+  #   ingested_after, ingested_before   ingest time range, inclusive; epoch seconds, datetime or ISO string
+  def __init__(self,
+               doc_ids: Iterable[str] = None,
+               pages: Tuple[int, int] = None,
+               author: Union[str, List[str]] = None,
+               title: Union[str, List[str]] = None,
+               ingested_after: Timestamp = None,
+               ingested_before: Timestamp = None):
+    self.doc_ids = None if doc_ids is None else set(doc_ids)
+    self.pages = pages
+    self.author = [author] if isinstance(author, str) else author
+    self.title = [title] if isinstance(title, str) else title
+    self.ingested_after = None if ingested_after is None else to_timestamp(ingested_after)
+    self.ingested_before = None if ingested_before is None else to_timestamp(ingested_before)
+
+  # function to combine the doc_ids shorthand of the search methods with an optional filter
+  @classmethod
+  def combine(cls, search_filter: "SearchFilter" = None, doc_ids: Iterable[str] = None) -> "SearchFilter":
+    if doc_ids is None:
+      return search_filter
+    if search_filter is None:
+      return cls(doc_ids=doc_ids)
+    combined = cls(pages=search_filter.pages, author=search_filter.author, title=search_filter.title,
+                   ingested_after=search_filter.ingested_after, ingested_before=search_filter.ingested_before)
+    combined.doc_ids = set(doc_ids) if search_filter.doc_ids is None else search_filter.doc_ids & set(doc_ids)
+    return combined
+
+  def __repr__(self) -> str:
+    conditions = {key: value for key, value in vars(self).items() if value is not None}
+    return f"SearchFilter({conditions})"
+
+class MetadataIndex:
+
+  # the filterable attributes of every chunk, one row per chunk in compact typed columns; a filter is evaluated
+  # as a few vectorized comparisons into one boolean mask over the rows, and only the matching chunk ids are
+  # handed to the vector index. string attributes are dictionary-encoded, so equality tests compare int codes
+  CATEGORICAL = ("doc_id", "author", "title")
+  NO_PAGE = -1
+
+  def __init__(self):
+    self.row_ids = array('q')       # row -> chunk id
+    self.vector_ids = array('q')    # row -> id of the vector that answers for the chunk; a collapsed near-duplicate's is its stored copy
+    self.pages = array('i')         # row -> first page, NO_PAGE if unknown
+    self.page_ends = array('i')     # row -> last page
+    self.ingested_at = array('d')   # row -> epoch seconds, nan if unknown
+    self.codes = {name: array('i') for name in self.CATEGORICAL}   # row -> code of the value
+    self.values = {name: {} for name in self.CATEGORICAL}          # value -> code
+    self.live = bytearray()         # row -> 1 while the chunk is stored
+    self.rows = {}                  # chunk id -> row
+    self.redirected = False         # whether any row's vector id differs from its chunk id
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+  # function to index one chunk's doc id and metadata; vector_id is the stored chunk a duplicate was collapsed into
+  def add(self, chunk_id: int, doc_id: str, metadata: Dict, vector_id: int = None):
+    if chunk_id in self.rows:
+      return
+    self.rows[chunk_id] = len(self.row_ids)
+    self.row_ids.append(chunk_id)
+    self.vector_ids.append(chunk_id if vector_id is None else vector_id)
+    self.redirected = self.redirected or (vector_id is not None and vector_id != chunk_id)
+
+    page = metadata.get("page")
+    page = self.NO_PAGE if page is None else int(page)
+    self.pages.append(page)
+    self.page_ends.append(int(metadata.get("page_end", page)) if page != self.NO_PAGE else self.NO_PAGE)
+    ingested_at = metadata.get("ingested_at")
+    self.ingested_at.append(float("nan") if ingested_at is None else float(ingested_at))
+
+    attributes = {"doc_id": doc_id, "author": metadata.get("author", ""), "title": metadata.get("title", "")}
+    for name, value in attributes.items():
+      codes = self.values[name]
+      self.codes[name].append(codes.setdefault(str(value), len(codes)))
+    self.live.append(1)
+
+  # deleted rows are only flagged here; save() drops them
+  def remove(self, chunk_id: int):
+    row = self.rows.pop(chunk_id, None)
+    if row is not None:
+      self.live[row] = 0
+
+  def _column(self, values: array, dtype) -> np.ndarray:
+    return np.frombuffer(values, dtype=dtype) if len(values) else np.zeros(0, dtype=dtype)
+
+  # function to evaluate a filter; returns the vector ids of the live chunks that match it
+  def select(self, search_filter: SearchFilter) -> np.ndarray:
+    # several duplicates can answer through one vector
+    selected = self._column(self.vector_ids, np.int64)[self._mask(search_filter)]
+    return np.unique(selected) if self.redirected else selected
+
+  # function to evaluate a filter row by row: (chunk ids, vector ids) of the live chunks that match it
+  def match(self, search_filter: SearchFilter) -> Tuple[np.ndarray, np.ndarray]:
+    mask = self._mask(search_filter)
+    return self._column(self.row_ids, np.int64)[mask], self._column(self.vector_ids, np.int64)[mask]
+
+  def _mask(self, search_filter: SearchFilter) -> np.ndarray:
+    mask = np.frombuffer(bytes(self.live), dtype=np.uint8).astype(bool)
+
+    for name, wanted in (("doc_id", search_filter.doc_ids), ("author", search_filter.author), ("title", search_filter.title)):
+      if wanted is None:
+        continue
+      wanted_codes = [self.values[name][value] for value in wanted if value in self.values[name]]
+      mask &= np.isin(self._column(self.codes[name], np.int32), wanted_codes)
+
+    if search_filter.pages is not None:
+      first, last = search_filter.pages
+      pages = self._column(self.pages, np.int32)
+      mask &= pages != self.NO_PAGE
+      if last is not None:
+        mask &= pages <= last
+      if first is not None:
+        mask &= self._column(self.page_ends, np.int32) >= first
+
+    if search_filter.ingested_after is not None or search_filter.ingested_before is not None:
+      # nan (unknown ingest time) fails every comparison, so those chunks never match a date range
+      ingested_at = self._column(self.ingested_at, np.float64)
+      with np.errstate(invalid="ignore"):
+        if search_filter.ingested_after is not None:
+          mask &= ingested_at >= search_filter.ingested_after
+        if search_filter.ingested_before is not None:
+          mask &= ingested_at <= search_filter.ingested_before
+    return mask
+
+  # function to persist the live rows as one .npz
+  def save(self, path: str):
+    live = np.frombuffer(bytes(self.live), dtype=np.uint8).astype(bool)
+    arrays = {
+        "row_ids": self._column(self.row_ids, np.int64)[live],
+        "vector_ids": self._column(self.vector_ids, np.int64)[live],
+        "pages": self._column(self.pages, np.int32)[live],
+        "page_ends": self._column(self.page_ends, np.int32)[live],
+        "ingested_at": self._column(self.ingested_at, np.float64)[live]
+    }
+    for name in self.CATEGORICAL:
+      arrays[name + "_codes"] = self._column(self.codes[name], np.int32)[live]
+    # values are stored in code order, so the codes stay valid
+    arrays["values"] = np.array(json.dumps({name: list(self.values[name]) for name in self.CATEGORICAL}))
+    np.savez(path, **arrays)
+
+  @classmethod
+  def load(cls, path: str) -> "MetadataIndex":
+    stored = np.load(path)
+    index = cls()
+    index.row_ids = array('q', stored["row_ids"].tobytes())
+    # files written before duplicates were collapsed have no vector ids; every chunk is its own vector there
+    vector_ids = stored["vector_ids"] if "vector_ids" in stored.files else stored["row_ids"]
+    index.vector_ids = array('q', vector_ids.tobytes())
+    index.redirected = bool(np.any(vector_ids != stored["row_ids"]))
+    index.pages = array('i', stored["pages"].tobytes())
+    index.page_ends = array('i', stored["page_ends"].tobytes())
+    index.ingested_at = array('d', stored["ingested_at"].tobytes())
+    values = json.loads(str(stored["values"]))
+    for name in cls.CATEGORICAL:
+      index.codes[name] = array('i', stored[name + "_codes"].tobytes())
+      index.values[name] = {value: code for code, value in enumerate(values[name])}
+    index.live = bytearray(b"\x01" * len(index.row_ids))
+    index.rows = {int(chunk_id): row for row, chunk_id in enumerate(stored["row_ids"])}
+    return index
+
+  def get_stats(self) -> Dict:
+    return {
+        "chunks": len(self.rows),
+        "documents": len(self.values["doc_id"]),
+        "authors": len(self.values["author"]),
+        "titles": len(self.values["title"])
+    }
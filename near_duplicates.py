@@ -0,0 +1,174 @@
+import json
+import re
+import zlib
+from typing import Dict, List, Optional
+import numpy as np
+
+# prime just above 2^32; with 32-bit multipliers and shingle hashes a*h + b never overflows uint64
+_PRIME = np.uint64(4294967311)
+
+class NearDuplicateIndex:
+
+  # MinHash signatures of the stored ("canonical") chunks, bucketed by LSH bands, plus the chunks that were
+  # collapsed into them ("aliases"). a new chunk whose estimated Jaccard similarity of word shingles to a canonical
+  # chunk reaches threshold is not embedded or stored; it only becomes an alias keeping its own document id and
+  # metadata, so every source of a collapsed chunk can still be listed, filtered on and re-homed when the
+  # canonical chunk's document is deleted
+  def __init__(self, threshold: float = 0.8, num_perm: int = 64, shingle_size: int = 3, seed: int = 1):
+    if not 0.0 < threshold <= 1.0:
+      raise ValueError("threshold must be in (0, 1]")
+
+    self.threshold = threshold
+    self.num_perm = num_perm
+    self.shingle_size = shingle_size
+    self.seed = seed
+
+    rng = np.random.default_rng(seed)
+    self._a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    self.bands, self.rows = self._lsh_shape(threshold, num_perm)
+
+    self.signatures = {}    # canonical chunk id -> signature
+    self.buckets = [{} for _ in range(self.bands)]    # band -> band bytes -> set of canonical chunk ids
+    self.aliases = {}       # alias chunk id -> (canonical chunk id, doc id, metadata)
+    self.alias_ids = {}     # canonical chunk id -> its alias chunk ids
+    self.doc_aliases = {}   # doc id -> its alias chunk ids
+    self.collapsed = 0      # chunks collapsed since this index was created or loaded
+
+  # bands x rows with the LSH threshold (1/bands)^(1/rows) closest to the requested one; pairs above it become
+  # candidates with high probability, and each candidate is then checked against the threshold itself
+  @staticmethod
+  def _lsh_shape(threshold: float, num_perm: int):
+    shapes = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+    return min(shapes, key=lambda shape: abs((1 / shape[0]) ** (1 / shape[1]) - threshold))
+
+  # function to compute the MinHash signature of a text's lowercased word shingles; None for a text without words
+  def signature(self, text: str) -> Optional[np.ndarray]:
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+      return None
+    size = min(self.shingle_size, len(words))
+    shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    return ((np.outer(self._a, hashes) + self._b[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+  def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+    return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+  # function to find the stored chunk a signature is a near-duplicate of, or None
+  def find(self, signature: np.ndarray) -> Optional[int]:
+    candidates = set()
+    for band, key in enumerate(self._band_keys(signature)):
+      candidates.update(self.buckets[band].get(key, ()))
+    best, best_similarity = None, self.threshold
+    for chunk_id in candidates:
+      similarity = float(np.mean(self.signatures[chunk_id] == signature))
+      if similarity >= best_similarity:
+        best, best_similarity = chunk_id, similarity
+    return best
+
+  def is_canonical(self, chunk_id: int) -> bool:
+    return chunk_id in self.signatures
+
+  def add_canonical(self, chunk_id: int, signature: np.ndarray):
+    if chunk_id in self.signatures:
+      return
+    self.signatures[chunk_id] = signature
+    for band, key in enumerate(self._band_keys(signature)):
+      self.buckets[band].setdefault(key, set()).add(chunk_id)
+
+  # function to forget a canonical chunk; returns its aliases as (alias id, doc id, metadata), which the caller has
+  # to re-home, since they lost their stored vector
+  def remove_canonical(self, chunk_id: int) -> List[tuple]:
+    signature = self.signatures.pop(chunk_id, None)
+    if signature is None:
+      return []
+    for band, key in enumerate(self._band_keys(signature)):
+      bucket = self.buckets[band].get(key)
+      if bucket is not None:
+        bucket.discard(chunk_id)
+        if not bucket:
+          del self.buckets[band][key]
+    orphans = []
+    for alias_id in self.alias_ids.pop(chunk_id, []):
+      _, doc_id, metadata = self.aliases.pop(alias_id)
+      self.doc_aliases[doc_id].remove(alias_id)
+      orphans.append((alias_id, doc_id, metadata))
+    return orphans
+
+  def has_duplicates(self, chunk_id: int) -> bool:
+    return bool(self.alias_ids.get(chunk_id))
+
+  def add_alias(self, alias_id: int, canonical_id: int, doc_id: str, metadata: Dict):
+    if alias_id in self.aliases:
+      return
+    self.aliases[alias_id] = (canonical_id, doc_id, metadata)
+    self.alias_ids.setdefault(canonical_id, []).append(alias_id)
+    self.doc_aliases.setdefault(doc_id, []).append(alias_id)
+    self.collapsed += 1
+
+  # function to drop an alias; returns its canonical chunk id, or None if it was not an alias
+  def remove_alias(self, alias_id: int) -> Optional[int]:
+    entry = self.aliases.pop(alias_id, None)
+    if entry is None:
+      return None
+    canonical_id, doc_id, _ = entry
+    self.alias_ids[canonical_id].remove(alias_id)
+    self.doc_aliases[doc_id].remove(alias_id)
+    return canonical_id
+
+  def __contains__(self, alias_id: int) -> bool:
+    return alias_id in self.aliases
+
+  def document_aliases(self, doc_id: str) -> List[int]:
+    return list(self.doc_aliases.get(doc_id, ()))
+
+  # back-references of a stored chunk: the document and location of every chunk collapsed into it
+  def duplicates_of(self, chunk_id: int) -> List[Dict]:
+    references = []
+    for alias_id in self.alias_ids.get(chunk_id, ()):
+      _, doc_id, metadata = self.aliases[alias_id]
+      reference = {"id": alias_id, "doc_id": doc_id}
+      reference.update((key, metadata[key]) for key in ("page", "page_end", "chunk_index") if key in metadata)
+      references.append(reference)
+    return references
+
+  def save(self, path: str):
+    canonical_ids = np.fromiter(self.signatures.keys(), dtype=np.int64, count=len(self.signatures))
+    signatures = np.stack(list(self.signatures.values())) if self.signatures else np.zeros((0, self.num_perm), dtype=np.uint32)
+    alias_ids = np.fromiter(self.aliases.keys(), dtype=np.int64, count=len(self.aliases))
+    np.savez(
+        path,
+        canonical_ids=canonical_ids,
+        signatures=signatures,
+        alias_ids=alias_ids,
+        alias_canonical_ids=np.array([entry[0] for entry in self.aliases.values()], dtype=np.int64),
+        alias_sources=np.array(json.dumps([[entry[1], entry[2]] for entry in self.aliases.values()])),
+        config=np.array(json.dumps({"threshold": self.threshold, "num_perm": self.num_perm,
+                                    "shingle_size": self.shingle_size, "seed": self.seed}))
+    )
+
+  @classmethod
+  def load(cls, path: str) -> "NearDuplicateIndex":
+    stored = np.load(path)
+    index = cls(**json.loads(str(stored["config"])))
+    for chunk_id, signature in zip(stored["canonical_ids"].tolist(), stored["signatures"]):
+      index.add_canonical(chunk_id, signature)
+    sources = json.loads(str(stored["alias_sources"]))
+    for alias_id, canonical_id, (doc_id, metadata) in zip(stored["alias_ids"].tolist(), stored["alias_canonical_ids"].tolist(), sources):
+      index.add_alias(alias_id, canonical_id, doc_id, metadata)
+    index.collapsed = 0
+    return index
+
+  def get_stats(self) -> Dict:
+    canonical_with_duplicates = sum(1 for aliases in self.alias_ids.values() if aliases)
+    return {
+        "threshold": self.threshold,
+        "lsh_bands": self.bands,
+        "lsh_rows": self.rows,
+        "stored_chunks": len(self.signatures),
+        "collapsed_chunks": len(self.aliases),
+        "chunks_with_duplicates": canonical_with_duplicates,
+        "vectors_saved_ratio": len(self.aliases) / (len(self.aliases) + len(self.signatures)) if self.signatures else 0.0,
+        "collapsed_since_load": self.collapsed
+    }
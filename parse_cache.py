@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+import numpy as np
+
+# hash a file in 1 MB blocks so large PDFs are never read into memory at once
+def file_sha256(file_path: str) -> str:
+  digest = hashlib.sha256()
+  with open(file_path, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+class ParseCache:
+
+  # on-disk layout (one directory):
+  #   index.json       file path -> {"sha256", "size", "mtime"} of the version last parsed from that path
+  #   <sha256>.npz     one parsed version of a file: its cleaned page texts as one utf-8 blob, row i is
+  #                    text[offsets[i]:offsets[i+1]], each page's content hash, and the document metadata
+  # a version is dropped once no path refers to it any more, so the cache holds one version per file
+  INDEX_FILE = "index.json"
+
+  def __init__(self, cache_dir: str):
+    self.cache_dir = cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+
+    self.files = {}
+    index_path = os.path.join(cache_dir, self.INDEX_FILE)
+    if os.path.exists(index_path):
+      with open(index_path, "r", encoding="utf-8") as f:
+        self.files = json.load(f)
+
+    self.hits = 0
+    self.misses = 0
+
+  def _version_path(self, sha256: str) -> str:
+    return os.path.join(self.cache_dir, sha256 + ".npz")
+
+  # function to get a file's content hash; a file whose size and mtime match its last parse is not re-read
+  def file_hash(self, file_path: str) -> str:
+    entry = self.files.get(os.path.abspath(file_path))
+    stat = os.stat(file_path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+      return entry["sha256"]
+    return file_sha256(file_path)
+
+  # content hash of the version last parsed from this path, or None
+  def version_of(self, file_path: str) -> Optional[str]:
+    entry = self.files.get(os.path.abspath(file_path))
+    return None if entry is None else entry["sha256"]
+
+  # function to read one parsed version: {"pages", "page_hashes", "metadata"}, or None if it is not cached
+  def get(self, sha256: str) -> Optional[Dict]:
+    path = self._version_path(sha256)
+    if not os.path.exists(path):
+      self.misses += 1
+      return None
+    self.hits += 1
+
+    stored = np.load(path)
+    text, offsets = stored["text"].tobytes(), stored["offsets"].tolist()
+    return {
+        "pages": [text[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)],
+        "page_hashes": stored["page_hashes"].tolist(),
+        "metadata": json.loads(str(stored["metadata"]))
+    }
+
+  def put(self, sha256: str, pages: List[str], page_hashes: List[int], metadata: Dict):
+    encoded = [page.encode("utf-8") for page in pages]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(page) for page in encoded], out=offsets[1:])
+
+    # written under a temporary name, so a reader never sees half a version
+    tmp_path = self._version_path(sha256) + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        text=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        offsets=offsets,
+        page_hashes=np.array(page_hashes, dtype=np.uint64),
+        metadata=np.array(json.dumps(metadata))
+    )
+    os.replace(tmp_path, self._version_path(sha256))
+
+  # function to record that a path now holds the given version; the version it replaces is deleted unless
+  # another path still refers to it
+  def remember(self, file_path: str, sha256: str):
+    key = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    previous = self.files.get(key)
+    entry = {"sha256": sha256, "size": stat.st_size, "mtime": stat.st_mtime}
+    if previous == entry:
+      return
+    self.files[key] = entry
+
+    if previous is not None and previous["sha256"] != sha256:
+      if not any(other["sha256"] == previous["sha256"] for other in self.files.values()):
+        try:
+          os.remove(self._version_path(previous["sha256"]))
+        except FileNotFoundError:
+          pass
+    self._write_index()
+
+  def _write_index(self):
+    tmp_path = os.path.join(self.cache_dir, self.INDEX_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump(self.files, f)
+    os.replace(tmp_path, os.path.join(self.cache_dir, self.INDEX_FILE))
+
+  def get_stats(self) -> Dict:
+    total = self.hits + self.misses
+    return {
+        "files": len(self.files),
+        "versions": len({entry["sha256"] for entry in self.files.values()}),
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / total if total else 0.0
+    }
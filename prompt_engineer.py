@@ -1,13 +1,20 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from telemetry import telemetry
 
 class PromptEngineer:
-  def __init__(self, 
+  def __init__(self,
                system_prompt: str = None,
                max_content_length: int = 160000,    #164K tokens for input deepseek-r1, use 160K
-               include_relevance: bool = True):
+               include_relevance: bool = True,
+               tokenizer_name: str = "deepseek-ai/DeepSeek-R1",
+               min_merge_overlap: int = 8):
     self.system_prompt = system_prompt or self.default_system_prompt()
-    self.max_context_length = max_content_length
+    self.max_context_length = max_content_length    # token budget for the whole prompt
     self.include_relevance = include_relevance
+    self.tokenizer_name = tokenizer_name
+    self.min_merge_overlap = min_merge_overlap      # shorter suffix/prefix matches are treated as coincidence
+    self._tokenizer = None
+    self.last_usage = None    # token usage of the last prompt built
 
   # default prompt for model role
   @staticmethod
@@ -19,25 +26,122 @@ RULES:
 3. Be concise but comprehensive
 4. Never invent information not present in the context"""
 
-  # function to format the retrieved context chunks
-  def format_context(self, context_chunks: List[Dict]) -> str:
-    context_str = ""
-    for i, chunk in enumerate(context_chunks):
-      text = self.truncate_text(chunk['chunk'], self.max_context_length)
+  # the tokenizer is only loaded the first time tokens are counted
+  @property
+  def tokenizer(self):
+    if self._tokenizer is None:
+      from transformers import AutoTokenizer
+      self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+    return self._tokenizer
 
-      metadata = chunk['metadata']
+  # function to load the tokenizer ahead of the first prompt instead of during it
+  def warmup(self):
+    with telemetry.span("warmup", component="prompt_engineer"):
+      self.count_tokens(self.system_prompt)
 
-      relevance_info = ""
-      if self.include_relevance and 'relevance' in chunk:
-        relevance_info = f" [Relevance: {chunk['relevance']:.2f}]"
+  def count_tokens(self, text: str) -> int:
+    return len(self.tokenizer.encode(text, add_special_tokens=False))
 
-      context_str += (
-          f"### CONTEXT {i+1}{relevance_info}\n"
-          f"CONTENT: {text}\n\n"
-      )
-    return context_str.strip()
+  # function to format the retrieved context chunks within a token budget (default: the whole prompt budget)
+  def format_context(self, context_chunks: List[Dict], max_tokens: int = None) -> str:
+    return self.pack_context(context_chunks, max_tokens or self.max_context_length)[0]
 
-  # if text exceeds token limit, truncate it
+  # greedy packing: chunks are taken in relevance order while they fit, and adjacent chunks of a document are
+  # merged so the overlap the chunker adds between them is only paid for once
+  def pack_context(self, context_chunks: List[Dict], max_tokens: int) -> Tuple[str, Dict]:
+    order = list(range(len(context_chunks)))
+    if all('relevance' in chunk for chunk in context_chunks):
+      order.sort(key=lambda i: context_chunks[i]['relevance'], reverse=True)
+
+    token_counts = {}
+    selected, passages, used = [], [], 0
+    for i in order:
+      trial = self._merge_passages(selected + [context_chunks[i]])
+      cost = self._context_tokens(trial, token_counts)
+      if cost <= max_tokens:
+        selected.append(context_chunks[i])
+        passages, used = trial, cost
+
+    # nothing fits whole: keep the most relevant chunk, cut down to the budget
+    if not selected and context_chunks and max_tokens > 0:
+      top = dict(context_chunks[order[0]])
+      header_tokens = self._context_tokens(self._merge_passages([dict(top, chunk="")]), {})
+      top['chunk'] = self.truncate_tokens(top['chunk'], max_tokens - header_tokens - 8)
+      selected = [top]
+      passages = self._merge_passages(selected)
+      used = self._context_tokens(passages, token_counts)
+
+    blocks = [self._format_block(i, passage) for i, passage in enumerate(passages)]
+    usage = {
+        "context_tokens": used,
+        "budget_tokens": max_tokens,
+        "chunks_used": len(selected),
+        "chunks_dropped": len(context_chunks) - len(selected),
+        "passages": len(passages)
+    }
+    return "\n\n".join(blocks), usage
+
+  def _format_block(self, i: int, passage: Dict) -> str:
+    relevance_info = ""
+    if self.include_relevance and passage['relevance'] is not None:
+      relevance_info = f" [Relevance: {passage['relevance']:.2f}]"
+    return f"### CONTEXT {i+1}{relevance_info}\nCONTENT: {passage['text']}"
+
+  # token count of the formatted context; passage texts are counted once and headers are short
+  def _context_tokens(self, passages: List[Dict], token_counts: Dict[str, int]) -> int:
+    total = 0
+    for i, passage in enumerate(passages):
+      for piece in (passage['text'], self._format_block(i, dict(passage, text=""))):
+        if piece not in token_counts:
+          token_counts[piece] = self.count_tokens(piece)
+        total += token_counts[piece]
+      total += 1    # the blank line between blocks
+    return total
+
+  # function to merge chunks that follow each other in the same document into one passage, in relevance order
+  def _merge_passages(self, chunks: List[Dict]) -> List[Dict]:
+    groups = {}
+    for rank, chunk in enumerate(chunks):
+      # a chunk with no doc_id or source gets a group of its own: unrelated documents restart chunk_index at 0
+      key = chunk.get('doc_id') or chunk['metadata'].get('source') or (None, rank)
+      groups.setdefault(key, []).append((rank, chunk))
+
+    passages = []
+    for members in groups.values():
+      members.sort(key=lambda member: member[1]['metadata'].get('chunk_index', -1))
+      current = None
+      for rank, chunk in members:
+        index = chunk['metadata'].get('chunk_index')
+        relevance = chunk.get('relevance')
+        if current is not None and index is not None and current['last_index'] is not None and index == current['last_index'] + 1:
+          current['text'] = self._join_overlapping(current['text'], chunk['chunk'])
+          current['last_index'] = index
+          current['rank'] = min(current['rank'], rank)
+          if relevance is not None:
+            current['relevance'] = relevance if current['relevance'] is None else max(current['relevance'], relevance)
+          continue
+        current = {"text": chunk['chunk'], "last_index": index, "rank": rank, "relevance": relevance}
+        passages.append(current)
+
+    passages.sort(key=lambda passage: passage['rank'])
+    return passages
+
+  # function to join two consecutive chunks, dropping the longest suffix of the first that starts the second
+  def _join_overlapping(self, first: str, second: str) -> str:
+    for size in range(min(len(first), len(second)), self.min_merge_overlap - 1, -1):
+      if first.endswith(second[:size]):
+        return first + second[size:]
+    return first + " " + second
+
+  # if text exceeds the token limit, truncate it at the last sentence end that fits
+  def truncate_tokens(self, text: str, max_tokens: int) -> str:
+    token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+    if len(token_ids) <= max_tokens:
+      return text
+    prefix = self.tokenizer.decode(token_ids[:max(max_tokens, 0)])
+    return self.truncate_text(text, len(prefix))
+
+  # if text exceeds character limit, truncate it
   @staticmethod
   def truncate_text(text: str, max_length: int) -> str:
     if len(text) <= max_length:
@@ -54,15 +158,28 @@ RULES:
 
   # function to format prompt with queries
   def format_prompt(self, processed_query: str, context_chunks: List[Dict]) -> str:
-    context_str = self.format_context(context_chunks)
+    return self.build_prompt(processed_query, context_chunks)[0]
 
-    return f"""
-{self.system_prompt}
+  # function to build the prompt and report its token usage; the context gets whatever the rest of the prompt leaves
+  def build_prompt(self, processed_query: str, context_chunks: List[Dict]) -> Tuple[str, Dict]:
+    with telemetry.span("prompt", chunks=len(context_chunks)) as span:
+      head = f"{self.system_prompt}\n\nCONTEXT DOCUMENTS:\n"
+      tail = f"\n\nQUESTION: {processed_query}\n\nANSWER:"
+      budget = self.max_context_length - self.count_tokens(head) - self.count_tokens(tail)
 
-CONTEXT DOCUMENTS:
-{context_str}
+      # token boundaries between the pieces can shift the exact count by a few tokens, so re-check the final prompt
+      for _ in range(3):
+        context_str, usage = self.pack_context(context_chunks, budget)
+        prompt = (head + context_str + tail).strip()
+        usage["prompt_tokens"] = self.count_tokens(prompt)
+        overshoot = usage["prompt_tokens"] - self.max_context_length
+        if overshoot <= 0:
+          break
+        budget -= overshoot
 
-QUESTION: {processed_query}
+      span.set("prompt_tokens", usage["prompt_tokens"])
+      span.set("chunks_dropped", usage["chunks_dropped"])
+      telemetry.count("prompt_tokens_total", usage["prompt_tokens"])
 
-ANSWER:
-""".strip()
\ No newline at end of file
+    self.last_usage = usage
+    return prompt, usage
\ No newline at end of file
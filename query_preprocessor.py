@@ -1,23 +1,56 @@
+import os
 import re
 import unicodedata
+from functools import lru_cache
 from typing import Optional, List
 from contractions_dict import contractions
-from symspellpy import SymSpell, Verbosity
+from telemetry import telemetry
+
+# patterns are compiled once at import instead of on every call
+CONTRACTIONS_PATTERN = re.compile('(%s)' % '|'.join(map(re.escape, contractions.keys())), flags=re.IGNORECASE)
+SPECIAL_CHARS_PATTERN = re.compile(r'[^\w\s?!\.,\'\"\(\)\[\]\{\}\-]')    # keeps letters, numbers, ?, !, ., ,, ', ", (, ), [, ], {, }
+WHITESPACE_PATTERN = re.compile(r'\s+')
+QUESTION_PATTERN = re.compile(r'[^?]+?\?')
+
+# SymSpell dictionaries already loaded in this process, keyed by dictionary path
+_sym_spell_cache = {}
+
+# function to load the SymSpell dictionary; the first load pickles the prebuilt dictionary so later loads skip building it
+def load_sym_spell(dictionary_path: str = 'frequency_dictionary_en_82_765.txt', pickle_path: str = None):
+  if dictionary_path in _sym_spell_cache:
+    return _sym_spell_cache[dictionary_path]
+
+  from symspellpy import SymSpell
+  pickle_path = pickle_path or dictionary_path + '.pkl'
+  sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
+  if os.path.exists(pickle_path) and (not os.path.exists(dictionary_path) or os.path.getmtime(pickle_path) >= os.path.getmtime(dictionary_path)):
+    sym_spell.load_pickle(pickle_path, compressed=False)
+  else:
+    sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
+    try:
+      sym_spell.save_pickle(pickle_path, compressed=False)
+    except OSError as e:
+      print(f"Could not cache spelling dictionary: {str(e)}")
+
+  _sym_spell_cache[dictionary_path] = sym_spell
+  return sym_spell
 
 class QueryPreprocessor:
 
   def __init__(self,
                min_query_length: int = 2,
                max_query_length: int = 256,
-               enable_spell_check: bool = False):
+               enable_spell_check: bool = False,
+               dictionary_path: str = 'frequency_dictionary_en_82_765.txt',
+               spell_cache_size: int = 65536):
     self.min_query_length = min_query_length
     self.max_query_length = max_query_length
+    self.contractions = contractions
 
     # use symspellpy to load in spelling dictionary for spellcheck
     if enable_spell_check:
       try:
-        self.sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
-        self.sym_spell.load_dictionary('frequency_dictionary_en_82_765.txt', term_index=0, count_index=1)
+        self.sym_spell = load_sym_spell(dictionary_path)
         self.spell_check_enabled = True
       except ImportError:
         print("Spell Check disabled. Install symspellpy for spell checking.")
@@ -25,25 +58,41 @@ class QueryPreprocessor:
     else:
       self.spell_check_enabled = False
 
+    # queries repeat the same words, so each term is only looked up once
+    self._correct_term = lru_cache(maxsize=spell_cache_size)(self._lookup_term)
+
   # main function
   def preprocess(self, query) -> List[str]:
       if not isinstance(query, str):
         raise TypeError(f"Query must be string, got {type(query)}")
       
       # Pipeline of processing steps
-      query = self.normalize_encoding(query)
-      query = self.expand_contractions(query)
-      query = self.clean_special_chars(query)
-      query = self.normalize_whitespace(query)
-      questions = self.split_query(query)
-      corrected_questions = []
-      for question in questions:
-        cq = self.correct_spelling(question)
-        cq = self.validate_query(cq)
-        corrected_questions.append(cq)
+      with telemetry.span("preprocess", spell_check=self.spell_check_enabled):
+        query = self.normalize_encoding(query)
+        query = self.expand_contractions(query)
+        query = self.clean_special_chars(query)
+        query = self.normalize_whitespace(query)
+        questions = self.split_query(query)
+        corrected_questions = []
+        for question in questions:
+          cq = self.correct_spelling(question) if self.spell_check_enabled else question
+          cq = self.validate_query(cq)
+          corrected_questions.append(cq)
 
       return corrected_questions
 
+  # batch version of preprocess for replaying query logs or evaluation sets; repeated queries are processed once
+  def preprocess_batch(self, queries: List[str]) -> List[List[str]]:
+    processed = {}
+    results = []
+    for query in queries:
+      if not isinstance(query, str):
+        raise TypeError(f"Query must be string, got {type(query)}")
+      if query not in processed:
+        processed[query] = self.preprocess(query)
+      results.append(list(processed[query]))
+    return results
+
   # use unicodedata to convert query to NFC
   def normalize_encoding(self, query):
     query = query.replace("’", "'")
@@ -51,39 +100,40 @@ class QueryPreprocessor:
 
   # expand contractions for smoother processing
   def expand_contractions(self, query):
-    self.contractions = contractions
-    pattern = re.compile('(%s)' % '|'.join(map(re.escape, self.contractions.keys())), flags=re.IGNORECASE)
-
     def replace(match):
       match_text = match.group(0).lower()
       return self.contractions.get(match_text, match_text)
 
-    return pattern.sub(replace, query)
+    return CONTRACTIONS_PATTERN.sub(replace, query)
 
   # use re to get rid of problematic special chars
   def clean_special_chars(self, query):
-    return re.sub(r'[^\w\s?!\.,\'\"\(\)\[\]\{\}\-]', '', query)    # keeps letters, numbers, ?, !, ., ,, ', ", (, ), [, ], {, }
+    return SPECIAL_CHARS_PATTERN.sub('', query)
 
   # use re to get rid of extra whitespace
   def normalize_whitespace(self, query):
-    query = re.sub(r'\s+', ' ', query)
+    query = WHITESPACE_PATTERN.sub(' ', query)
     return query.strip()
 
   # use symspellpy to correct spelling
   def correct_spelling(self, query):
     corrected_terms = []
     for term in query.lower().split():
-      if len(term) > 3:
-        suggestions = self.sym_spell.lookup(term, Verbosity.TOP, max_edit_distance=2)
-        corrected_terms.append(suggestions[0].term if suggestions else term)
-      else:
-        corrected_terms.append(term)
+      corrected_terms.append(self._correct_term(term) if len(term) > 3 else term)
             
     return ' '.join(corrected_terms)
 
+  def _lookup_term(self, term: str) -> str:
+    from symspellpy import Verbosity
+    suggestions = self.sym_spell.lookup(term, Verbosity.TOP, max_edit_distance=2)
+    return suggestions[0].term if suggestions else term
+
+  def get_spell_cache_stats(self) -> dict:
+    return self._correct_term.cache_info()._asdict()
+
   # split into array of questions    
   def split_query(self, query: str) -> List[str]:
-    questions = re.findall(r'[^?]+?\?', query)
+    questions = QUESTION_PATTERN.findall(query)
     return [q.strip() for q in questions if q.strip()]
 
   # make sure query is within length bounds and contains question marks for questions
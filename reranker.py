@@ -1,29 +1,149 @@
-from sentence_transformers import CrossEncoder
+from collections import OrderedDict
 from typing import List, Dict
-import torch
+import hashlib
+import os
+import numpy as np
+from inference_backends import BACKENDS, load_cross_encoder, resolve_device
+from telemetry import telemetry
 
 class Reranker:
 
-  def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", device: str = "auto"):
-    self.model = CrossEncoder(model_name)
+  def __init__(self,
+               model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+               device: str = "auto",
+               batch_size: int = 32,
+               cache_size: int = 10000,
+               cascade_keep: int = None,
+               cascade_model_name: str = None,
+               backend: str = "torch",
+               onnx_dir: str = None):
+    if backend not in BACKENDS:
+      raise ValueError(f"Invalid backend. Choose from: {list(BACKENDS)}")
 
-    if device == "auto":
-      self.device = "cuda" if torch.cuda.is_available() else "cpu"
-    else:
-      self.device = device
+    self.device = resolve_device(device)
+    self.backend = backend
+    self.model = load_cross_encoder(model_name, backend=backend, device=self.device, onnx_dir=onnx_dir)
+
+    self.batch_size = batch_size
+    self.cache_size = cache_size
+    self.cache = OrderedDict()    # (query hash, chunk id) -> score, least recently used first
+    self.cache_hits = 0
+    self.cache_misses = 0
 
-    self.model.model.to(self.device)
+    # cascade: a cheap first pass keeps cascade_keep candidates and only those reach the full cross-encoder
+    # the first pass is a tiny cross-encoder if one is given, otherwise the bi-encoder similarity from search
+    self.cascade_keep = cascade_keep
+    self.cascade_model = None
+    if cascade_model_name:
+      self.cascade_model = load_cross_encoder(cascade_model_name, backend=backend, device=self.device,
+                                              onnx_dir=onnx_dir and os.path.join(onnx_dir, "cascade"))
 
-  # reranking function
+  # reranking function; returns reranked copies and leaves the caller's candidates untouched
   def rerank(self, query: str, candidates: List[Dict], top_k: int = 3) -> List[Dict]:
-    chunk_texts = [candidate["chunk"] for candidate in candidates]
-    pairs = [(query, chunk_text) for chunk_text in chunk_texts]
+    return self.rerank_batch([query], [candidates], top_k=top_k)[0]
+
+  # batched reranking: every (question, candidate) pair not in the cache is scored in a single predict call
+  def rerank_batch(self, queries: List[str], candidate_lists: List[List[Dict]], top_k: int = 3) -> List[List[Dict]]:
+    if len(queries) != len(candidate_lists):
+      raise ValueError("Mismatch between queries and candidate lists count")
+
+    with telemetry.span("rerank", queries=len(queries), candidates=sum(len(c) for c in candidate_lists)) as span:
+      return self._rerank_batch(queries, candidate_lists, top_k, span)
+
+  def _rerank_batch(self, queries: List[str], candidate_lists: List[List[Dict]], top_k: int, span) -> List[List[Dict]]:
+    if self.cascade_keep:
+      candidate_lists = self._cascade(queries, candidate_lists, max(self.cascade_keep, top_k))
+
+    keys = [[self._cache_key(query, candidate) for candidate in candidates] for query, candidates in zip(queries, candidate_lists)]
+
+    # identical (question, chunk) pairs are only scored once, e.g. repeated questions or duplicate chunk texts
+    scored = {}
+    pending = {}
+    for query, candidates, candidate_keys in zip(queries, candidate_lists, keys):
+      for candidate, key in zip(candidates, candidate_keys):
+        if key in scored or key in pending:
+          continue
+        if key in self.cache:
+          self.cache.move_to_end(key)
+          scored[key] = self.cache[key]
+          self.cache_hits += 1
+        else:
+          pending[key] = (query, candidate["chunk"])
+          self.cache_misses += 1
+
+    span.set("pairs_scored", len(pending))
+    telemetry.count("cache_hits_total", len(scored), cache="rerank")
+    telemetry.count("cache_misses_total", len(pending), cache="rerank")
+    if pending:
+      telemetry.observe("batch_size", len(pending), stage="rerank")
+      scores = self._predict(self.model, list(pending.values()))
+      for key, score in zip(pending, scores):
+        scored[key] = self.cache[key] = float(score)
+      while len(self.cache) > self.cache_size:
+        self.cache.popitem(last=False)
+
+    results = []
+    for candidates, candidate_keys in zip(candidate_lists, keys):
+      reranked = [dict(candidate, relevance=scored[key]) for candidate, key in zip(candidates, candidate_keys)]
+      reranked.sort(key=lambda x: x["relevance"], reverse=True)
+      results.append(reranked[:top_k])
+    return results
+
+  # first pass of the cascade; candidates without a cheap score are kept rather than dropped blindly
+  def _cascade(self, queries: List[str], candidate_lists: List[List[Dict]], keep: int) -> List[List[Dict]]:
+    if self.cascade_model is not None:
+      pairs = [(query, candidate["chunk"]) for query, candidates in zip(queries, candidate_lists) for candidate in candidates]
+      scores = iter(self._predict(self.cascade_model, pairs) if pairs else [])
+      cheap_lists = [[float(next(scores)) for _ in candidates] for candidates in candidate_lists]
+    else:
+      cheap_lists = [[candidate.get("similarity") for candidate in candidates] for candidates in candidate_lists]
+
+    survivors = []
+    for candidates, cheap in zip(candidate_lists, cheap_lists):
+      if len(candidates) <= keep or any(score is None for score in cheap):
+        survivors.append(candidates)
+        continue
+      order = np.argsort(-np.asarray(cheap, dtype=np.float32), kind="stable")[:keep]
+      survivors.append([candidates[i] for i in order])
+    return survivors
+
+  # pairs are sorted by token length so each predict batch pads to a similar length
+  def _predict(self, model, pairs: List[tuple]) -> np.ndarray:
+    try:
+      lengths = [len(ids) for ids in model.tokenizer([chunk for _, chunk in pairs], add_special_tokens=False)["input_ids"]]
+    except Exception:
+      lengths = [len(chunk) for _, chunk in pairs]
+    order = np.argsort(lengths, kind="stable")
+
+    sorted_scores = model.predict([pairs[i] for i in order], batch_size=self.batch_size)
+    scores = np.empty(len(pairs), dtype=np.float32)
+    scores[order] = np.asarray(sorted_scores, dtype=np.float32).reshape(len(pairs))
+    return scores
 
-    scores = self.model.predict(pairs)
+  # chunk ids from the vector store are content hashes; candidates without one fall back to hashing the text
+  @staticmethod
+  def _cache_key(query: str, candidate: Dict) -> tuple:
+    query_hash = hashlib.blake2b(query.encode("utf-8"), digest_size=8).digest()
+    chunk_key = candidate.get("id")
+    if chunk_key is None:
+      chunk_key = hashlib.blake2b(candidate["chunk"].encode("utf-8"), digest_size=8).digest()
+    return (query_hash, chunk_key)
 
-    for i in range(len(candidates)):
-      candidates[i]["relevance"] = float(scores[i])
+  # function to score one dummy pair with each model, outside the cache and its hit/miss counts
+  def warmup(self):
+    with telemetry.span("warmup", component="reranker", backend=self.backend):
+      for model in (self.cascade_model, self.model):
+        if model is not None:
+          self._predict(model, [("warmup", "warmup")])
 
-    candidates.sort(key=lambda x: x["relevance"], reverse=True)
+  def clear_cache(self):
+    self.cache = OrderedDict()
 
-    return candidates[:top_k]
\ No newline at end of file
+  def get_cache_stats(self) -> Dict:
+    total = self.cache_hits + self.cache_misses
+    return {
+        "entries": len(self.cache),
+        "hits": self.cache_hits,
+        "misses": self.cache_misses,
+        "hit_rate": self.cache_hits / total if total else 0.0
+    }
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List
+from embedding_generator import EmbeddingGenerator
+from inference_backends import BACKENDS
+from vector_store import VectorStore
+from metadata_index import SearchFilter
+from reranker import Reranker
+from retriever import Retriever
+from telemetry import telemetry
+
+class MicroBatcher:
+
+  def __init__(self,
+               batch_fn: Callable[[List[str]], List],
+               max_batch_size: int = 32,
+               max_wait_ms: float = 5.0):
+    self.batch_fn = batch_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    # one worker thread: batches run one at a time and new queries queue up behind them
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.queue = None
+    self.worker = None
+
+    self.batches = 0
+    self.items = 0
+
+  def start(self):
+    self.queue = asyncio.Queue()
+    self.worker = asyncio.get_running_loop().create_task(self._run())
+
+  async def stop(self):
+    if self.worker:
+      self.worker.cancel()
+    self.executor.shutdown(wait=False)
+
+  # function to queue one item and wait for its result
+  async def submit(self, item):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((item, future))
+    return await future
+
+  # collects queued items until the batch is full or max_wait has passed since the first one arrived
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.max_wait
+      while len(batch) < self.max_batch_size:
+        # anything already queued joins without waiting
+        if not self.queue.empty():
+          batch.append(self.queue.get_nowait())
+          continue
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      items = [item for item, _ in batch]
+      try:
+        results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+      except Exception as e:
+        for _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+        continue
+
+      self.batches += 1
+      self.items += len(items)
+      for (_, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
+
+  def get_stats(self) -> Dict:
+    return {
+        "batches": self.batches,
+        "queries": self.items,
+        "mean_batch_size": self.items / self.batches if self.batches else 0.0
+    }
+
+class RetrievalServer:
+
+  def __init__(self,
+               retriever: Retriever,
+               host: str = "127.0.0.1",
+               port: int = 8765,
+               unix_socket: str = None,
+               max_batch_size: int = 32,
+               max_wait_ms: float = 5.0):
+    self.retriever = retriever
+    self.host = host
+    self.port = port
+    self.unix_socket = unix_socket
+    self.batcher = MicroBatcher(retriever.retrieve_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    self.server = None
+
+  async def start(self):
+    self.batcher.start()
+    if self.unix_socket:
+      self.server = await asyncio.start_unix_server(self._handle_connection, path=self.unix_socket)
+      print(f"Retrieval server listening on {self.unix_socket}")
+    else:
+      self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+      print(f"Retrieval server listening on http://{self.host}:{self.port}")
+
+  async def stop(self):
+    if self.server:
+      self.server.close()
+      await self.server.wait_closed()
+    await self.batcher.stop()
+
+  async def serve_forever(self):
+    await self.start()
+    try:
+      async with self.server:
+        await self.server.serve_forever()
+    finally:
+      await self.stop()
+
+  # function to answer {"question": str} or {"questions": [str, ...]}; each question joins the shared micro-batch
+  # an optional "filter" ({"doc_ids": [...], "pages": [1, 5], "author": ..., "title": ..., "ingested_after": ...,
+  # "ingested_before": ...}) scopes the search to the matching chunks
+  async def retrieve(self, body: Dict) -> Dict:
+    start = time.time()
+    if "questions" in body:
+      questions = body["questions"]
+    elif "question" in body:
+      questions = [body["question"]]
+    else:
+      raise ValueError("Request body needs 'question' or 'questions'")
+    if not all(isinstance(q, str) for q in questions):
+      raise ValueError("Questions must be strings")
+
+    if body.get("filter") is not None:
+      if not isinstance(body["filter"], dict):
+        raise ValueError("'filter' must be an object")
+      search_filter = SearchFilter(**body["filter"])
+      # scoped questions cannot share a batch with others, so they run as their own batch on the batcher's thread
+      results = await asyncio.get_running_loop().run_in_executor(
+          self.batcher.executor, partial(self.retriever.retrieve_batch, questions, search_filter=search_filter))
+    else:
+      results = await asyncio.gather(*(self.batcher.submit(q) for q in questions))
+    return {"results": list(results), "latency_ms": 1000 * (time.time() - start)}
+
+  # minimal HTTP/1.1 handling with keep-alive: POST /retrieve, GET /health, GET /stats, GET /metrics (Prometheus text)
+  async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in (b"\r\n", b"\n", b""):
+            break
+          name, _, value = line.decode("latin-1").partition(":")
+          headers[name.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        status, payload = await self._route(method, target, body)
+        await self._respond(writer, status, payload, keep_alive=headers.get("connection", "").lower() != "close")
+        if headers.get("connection", "").lower() == "close":
+          break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  async def _route(self, method: str, target: str, body: bytes):
+    if method == "GET" and target == "/health":
+      return 200, {"status": "ok", "index_size": self.retriever.vector_store.get_index_size()}
+    if method == "GET" and target == "/stats":
+      return 200, self.batcher.get_stats()
+    if method == "GET" and target == "/metrics":
+      return 200, telemetry.export_prometheus()
+    if method == "POST" and target == "/retrieve":
+      try:
+        return 200, await self.retrieve(json.loads(body or b"{}"))
+      except (ValueError, TypeError) as e:
+        return 400, {"error": str(e)}
+      except Exception as e:
+        return 500, {"error": str(e)}
+    return 404, {"error": f"No route for {method} {target}"}
+
+  @staticmethod
+  async def _respond(writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool = True):
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+    # string payloads are sent as plain text (the Prometheus exposition format), everything else as json
+    if isinstance(payload, str):
+      body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+    else:
+      body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+    head = (
+        f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Long-running retrieval server that keeps the models and index loaded")
+  parser.add_argument("--index", default="my_index", help="index path prefix written by VectorStore.save_index")
+  parser.add_argument("--model", default="mpnet", choices=list(EmbeddingGenerator.MODEL_MAP.keys()))
+  parser.add_argument("--reranker", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+  parser.add_argument("--backend", default="torch", choices=list(BACKENDS), help="inference backend for the embedder and reranker")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--unix-socket", default=None, help="serve on a Unix socket instead of TCP")
+  parser.add_argument("--top-k", type=int, default=30)
+  parser.add_argument("--cascade-keep", type=int, default=None, help="candidates kept by the cheap first pass before the cross-encoder")
+  parser.add_argument("--final-k", type=int, default=5)
+  parser.add_argument("--max-batch-size", type=int, default=32)
+  parser.add_argument("--max-wait-ms", type=float, default=5.0, help="how long a query waits for others to join its batch")
+  parser.add_argument("--telemetry", action="store_true", help="record spans and metrics, served on GET /metrics")
+  parser.add_argument("--mmap", action="store_true", help="memory-map the index read-only instead of reading it into memory")
+  parser.add_argument("--warmup", action="store_true", help="run one dummy batch through every stage before serving")
+  args = parser.parse_args()
+
+  if args.telemetry:
+    telemetry.enable()
+
+  # everything heavy is loaded once, before the first request
+  embedder = EmbeddingGenerator(model_name=args.model, backend=args.backend)
+  vector_store = VectorStore(dimension=embedder.embedding_size, index_path=args.index, mmap=args.mmap)
+  reranker = Reranker(model_name=args.reranker, cascade_keep=args.cascade_keep, backend=args.backend)
+  retriever = Retriever(embedder, vector_store, reranker, top_k=args.top_k, final_k=args.final_k)
+  if args.warmup:
+    timings = retriever.warmup()
+    print("Warmed up: " + ", ".join(f"{stage} {1000 * seconds:.0f} ms" for stage, seconds in timings.items()))
+
+  server = RetrievalServer(
+      retriever,
+      host=args.host,
+      port=args.port,
+      unix_socket=args.unix_socket,
+      max_batch_size=args.max_batch_size,
+      max_wait_ms=args.max_wait_ms
+  )
+  asyncio.run(server.serve_forever())
+
+
+if __name__ == "__main__":
+  main()
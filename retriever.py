@@ -0,0 +1,53 @@
+import time
+import numpy as np
+from typing import List, Dict
+from embedding_generator import EmbeddingGenerator
+from vector_store import VectorStore
+from reranker import Reranker
+from telemetry import telemetry
+
+class Retriever:
+
+  def __init__(self,
+               embedder: EmbeddingGenerator,
+               vector_store: VectorStore,
+               reranker: Reranker,
+               top_k: int = 30,
+               final_k: int = 5,
+               hybrid: bool = False):
+    self.embedder = embedder
+    self.vector_store = vector_store
+    self.reranker = reranker
+    self.top_k = top_k      # candidates pulled from the vector store
+    self.final_k = final_k  # chunks kept after reranking
+    self.hybrid = hybrid    # fuse BM25 and dense candidates; better first-stage recall allows a smaller top_k
+
+  # function to warm every stage before the first question, e.g. when a worker starts; returns seconds per stage
+  def warmup(self) -> Dict[str, float]:
+    timings = {}
+    for name, component in (("embedder", self.embedder), ("vector_store", self.vector_store), ("reranker", self.reranker)):
+      start = time.perf_counter()
+      component.warmup()
+      timings[name] = time.perf_counter() - start
+    return timings
+
+  # function to retrieve the reranked context for a single question
+  def retrieve(self, question: str, **search_kwargs) -> List[Dict]:
+    return self.retrieve_batch([question], **search_kwargs)[0]
+
+  # batched retrieval: one encode call, one multi-row index search and one cross-encoder predict for all questions
+  # return_embeddings also returns the (N, d) query embeddings, e.g. for the answer cache
+  # search_kwargs scope the search, e.g. search_filter=SearchFilter(...), doc_ids=[...], or tenants=[...] with a ShardedVectorStore
+  def retrieve_batch(self, questions: List[str], return_embeddings: bool = False, **search_kwargs):
+    if not questions:
+      return ([], np.zeros((0, self.embedder.embedding_size), dtype=np.float32)) if return_embeddings else []
+
+    # parent span, so the embed, search and rerank spans of one batch share a trace
+    with telemetry.span("retrieve", questions=len(questions), hybrid=self.hybrid):
+      query_embeddings = self.embedder.embed_text(list(questions))
+      if self.hybrid:
+        candidate_lists = self.vector_store.hybrid_search_batch(list(questions), query_embeddings, k=self.top_k, **search_kwargs)
+      else:
+        candidate_lists = self.vector_store.search_batch(query_embeddings.copy(), k=self.top_k, **search_kwargs)
+      results = self.reranker.rerank_batch(list(questions), candidate_lists, top_k=self.final_k)
+    return (results, query_embeddings) if return_embeddings else results
@@ -0,0 +1,426 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Tuple
+import numpy as np
+from vector_store import VectorStore
+from metadata_index import SearchFilter
+from telemetry import telemetry
+from lazy_imports import lazy_module
+
+faiss = lazy_module("faiss")
+
+# readers-writer lock of one shard: searches share it, writes and saves hold it alone. a waiting write keeps new
+# searches out, so a steady stream of queries cannot starve it
+class ShardLock:
+
+  def __init__(self):
+    self._cond = threading.Condition()
+    self._readers = 0
+    self._writing = False
+    self._waiting_writers = 0
+
+  @contextmanager
+  def read(self):
+    with self._cond:
+      while self._writing or self._waiting_writers:
+        self._cond.wait()
+      self._readers += 1
+    try:
+      yield
+    finally:
+      with self._cond:
+        self._readers -= 1
+        if not self._readers:
+          self._cond.notify_all()
+
+  @contextmanager
+  def write(self):
+    with self._cond:
+      self._waiting_writers += 1
+      while self._writing or self._readers:
+        self._cond.wait()
+      self._waiting_writers -= 1
+      self._writing = True
+    try:
+      yield
+    finally:
+      with self._cond:
+        self._writing = False
+        self._cond.notify_all()
+
+class ShardedVectorStore:
+
+  # on-disk layout (one directory):
+  #   shards.json                   dimension, VectorStore settings and the sub-shard count of each tenant
+  #   <tenant>/shard-<i>.*          one VectorStore index per (tenant, sub-shard), written by save_index
+  MANIFEST = "shards.json"
+  TENANT_PATTERN = re.compile(r"^[\w.-]+$")
+
+  def __init__(self,
+               dimension: int,
+               root_dir: str = None,
+               default_sub_shards: int = 1,
+               max_loaded_shards: int = None,
+               max_workers: int = None,
+               **store_kwargs):
+    if max_loaded_shards and not root_dir:
+      raise ValueError("max_loaded_shards needs a root_dir to save unloaded shards to")
+
+    self.dimension = dimension
+    self.root_dir = root_dir
+    self.default_sub_shards = default_sub_shards
+    self.max_loaded_shards = max_loaded_shards    # least recently used shards are saved and unloaded past this
+    self.store_kwargs = store_kwargs              # index_type, nprobe, ... for every shard's VectorStore
+
+    self.tenants = {}               # tenant -> number of hash sub-shards
+    self.shards = OrderedDict()     # (tenant, sub_shard) -> loaded VectorStore, least recently used first
+    self._dirty = set()             # loaded shards changed since they were last saved
+    # shards in use by a search or write are pinned and never evicted; an eviction or unload that would hit one is
+    # put off until its last user releases it, so the store can briefly hold more than max_loaded_shards
+    self._pins = {}                 # (tenant, sub_shard) -> number of users
+    self._unload_on_release = {}    # pinned shard -> save flag of an unload_shard call waiting for it
+    # a pinned shard is only used under its ShardLock; lock order is shard lock, then self._lock, and an unpinned
+    # shard's lock is free, so unloading (which needs no pin) can save it under self._lock alone
+    self._shard_locks = {}          # loaded shard -> ShardLock
+    self._file_locks = {}           # shard -> lock held while its files are read or written
+    self._lock = threading.RLock()
+    self._executor = ThreadPoolExecutor(max_workers=max_workers or min(32, (os.cpu_count() or 1) + 4))
+
+    if root_dir and os.path.exists(os.path.join(root_dir, self.MANIFEST)):
+      with open(os.path.join(root_dir, self.MANIFEST), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+      if manifest["dimension"] != dimension:
+        raise ValueError(f"Sharded store at {root_dir} has dimension {manifest['dimension']}, not {dimension}")
+      self.store_kwargs = {**manifest["store"], **store_kwargs}
+      self.tenants = manifest["tenants"]
+
+  # function to register a tenant (customer or collection); large tenants can be hash-partitioned into sub-shards
+  def add_tenant(self, tenant: str, sub_shards: int = None):
+    sub_shards = sub_shards or self.default_sub_shards
+    if not self.TENANT_PATTERN.match(tenant):
+      raise ValueError(f"Invalid tenant name {tenant!r}; use letters, digits, '_', '-' and '.'")
+    if sub_shards < 1:
+      raise ValueError("sub_shards must be at least 1")
+    existing = self.tenants.get(tenant)
+    if existing is not None and existing != sub_shards:
+      raise ValueError(f"Tenant {tenant!r} already has {existing} sub-shards; re-ingest it to change the count")
+    self.tenants[tenant] = sub_shards
+
+  # a document always lives in one sub-shard, so its upserts and deletes touch a single index
+  @staticmethod
+  def sub_shard_of(doc_id: str, sub_shards: int) -> int:
+    if sub_shards == 1:
+      return 0
+    digest = hashlib.blake2b(doc_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % sub_shards
+
+  def _shard_path(self, key: Tuple[str, int]) -> str:
+    return os.path.join(self.root_dir, key[0], f"shard-{key[1]}") if self.root_dir else None
+
+  def _on_disk(self, key: Tuple[str, int]) -> bool:
+    path = self._shard_path(key)
+    return path is not None and os.path.exists(path + ".index")
+
+  # function to get a shard pinned, loading it from disk if needed; create=False returns None for shards with no
+  # data. every shard returned has to be handed back to _release once the caller is done with it
+  def _shard(self, key: Tuple[str, int], create: bool = False) -> VectorStore:
+    with self._lock:
+      store = self.shards.get(key)
+      if store is not None:
+        self.shards.move_to_end(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+        self._shard_locks.setdefault(key, ShardLock())
+        return store
+    if not create and not self._on_disk(key):
+      return None
+
+    # read outside the lock so shards load in parallel; if two threads race, the first one stored wins. the file
+    # lock keeps a save of the same shard from rewriting its files halfway through the read
+    with self._lock:
+      file_lock = self._file_locks.setdefault(key, threading.Lock())
+    with file_lock, telemetry.span("shard_load", tenant=key[0], sub_shard=key[1]):
+      store = VectorStore(dimension=self.dimension, index_path=self._shard_path(key), **self.store_kwargs)
+    telemetry.count("shard_loads_total")
+    with self._lock:
+      store = self.shards.setdefault(key, store)
+      self.shards.move_to_end(key)
+      self._pins[key] = self._pins.get(key, 0) + 1
+      self._shard_locks.setdefault(key, ShardLock())
+      self._evict()
+      return store
+
+  def _release(self, key: Tuple[str, int]):
+    with self._lock:
+      self._pins[key] -= 1
+      if self._pins[key]:
+        return
+      del self._pins[key]
+      if key in self._unload_on_release:
+        self.unload_shard(*key, save=self._unload_on_release.pop(key))
+      self._evict()
+
+  # function to use a shard for the duration of a with-block; it cannot be evicted or unloaded meanwhile
+  # write=False shares the shard with other searches, write=True waits until it has the shard to itself
+  @contextmanager
+  def _pinned(self, key: Tuple[str, int], create: bool = False, write: bool = False):
+    store = self._shard(key, create=create)
+    if store is None:
+      yield None
+      return
+    try:
+      with self._shard_locks[key].write() if write else self._shard_locks[key].read():
+        yield store
+    finally:
+      self._release(key)
+
+  # least recently used unpinned shards go first; pinned ones are skipped until they are released
+  def _evict(self):
+    with self._lock:
+      if not self.max_loaded_shards:
+        return
+      for key in [key for key in self.shards if key not in self._pins]:
+        if len(self.shards) <= self.max_loaded_shards:
+          break
+        self.unload_shard(*key)
+
+  # function to load every sub-shard of a tenant ahead of its queries
+  def load_tenant(self, tenant: str) -> int:
+    loaded = 0
+    for i in range(self.tenants.get(tenant, 0)):
+      with self._pinned((tenant, i)) as store:
+        loaded += store is not None
+    return loaded
+
+  # the returned store is not pinned: with max_loaded_shards it can be unloaded once other shards are loaded
+  def load_shard(self, tenant: str, sub_shard: int = 0) -> VectorStore:
+    with self._pinned((tenant, sub_shard)) as store:
+      return store
+
+  # function to release a shard's memory; unsaved changes are written first when the store has a root_dir
+  # a shard in use is unloaded once its searches and writes finish
+  def unload_shard(self, tenant: str, sub_shard: int = 0, save: bool = True):
+    key = (tenant, sub_shard)
+    with self._lock:
+      if key in self._pins:
+        self._unload_on_release[key] = save
+        return
+      store = self.shards.pop(key, None)
+      self._shard_locks.pop(key, None)
+      if store is None:
+        return
+      if save and key in self._dirty and self.root_dir:
+        self._save_shard(key, store)
+      self._dirty.discard(key)
+      store.close()
+
+  # function to load and warm the shards of the given tenants (default: all) in parallel; with max_loaded_shards
+  # only that many are kept, so a bounded store is not thrashed. returns the number of shards warmed
+  def warmup(self, tenants: Iterable[str] = None) -> int:
+    def warm(key):
+      with self._pinned(key) as store:
+        if store is not None:
+          store.warmup()
+        return store is not None
+
+    keys = [key for key, _ in self._route(tenants)][:self.max_loaded_shards or None]
+    futures = [self._executor.submit(warm, key) for key in keys]
+    return sum(future.result() for future in futures)
+
+  def unload_tenant(self, tenant: str, save: bool = True):
+    for i in range(self.tenants.get(tenant, 0)):
+      self.unload_shard(tenant, i, save=save)
+
+  def loaded_shards(self) -> List[Tuple[str, int]]:
+    with self._lock:
+      return list(self.shards.keys())
+
+  # function to pin the shard a document belongs to for a write, creating the tenant and shard if needed
+  @contextmanager
+  def _writable_shard(self, tenant: str, doc_id: str, create: bool = True):
+    with self._lock:
+      if tenant not in self.tenants and create:
+        self.add_tenant(tenant)
+      sub_shards = self.tenants.get(tenant)
+    if sub_shards is None:
+      yield None
+      return
+    key = (tenant, self.sub_shard_of(doc_id, sub_shards))
+    # marked dirty only once the write has the shard, so a save holding it cannot clear the mark of a later write
+    with self._pinned(key, create=create, write=True) as store:
+      if store is not None:
+        with self._lock:
+          self._dirty.add(key)
+      yield store
+
+  # write path: the same operations as VectorStore, addressed to one tenant
+  def add_chunks(self, tenant: str, embeddings: np.ndarray, chunks: List[Dict], doc_id: str = None) -> int:
+    with self._writable_shard(tenant, doc_id or "") as store:
+      return store.add_chunks(embeddings, chunks, doc_id=doc_id)
+
+  def upsert_document(self, tenant: str, doc_id: str, embeddings: np.ndarray, chunks: List[Dict]) -> Dict[str, int]:
+    with self._writable_shard(tenant, doc_id) as store:
+      return store.upsert_document(doc_id, embeddings, chunks)
+
+  def upsert_document_stream(self,
+                             tenant: str,
+                             doc_id: str,
+                             chunk_batches: Iterable[List[Dict]],
+                             embed_fn: Callable[[List[str]], np.ndarray]) -> Dict[str, int]:
+    with self._writable_shard(tenant, doc_id) as store:
+      return store.upsert_document_stream(doc_id, chunk_batches, embed_fn)
+
+  def delete_document(self, tenant: str, doc_id: str) -> int:
+    with self._writable_shard(tenant, doc_id, create=False) as store:
+      return 0 if store is None else store.delete_document(doc_id)
+
+  # function to pick the shards a search has to visit: only the requested tenants, and with doc_ids only the
+  # sub-shards holding those documents, each searched for its own documents
+  def _route(self, tenants: Iterable[str] = None, doc_ids: Iterable[str] = None) -> List[Tuple[Tuple[str, int], List[str]]]:
+    tenants = list(self.tenants) if tenants is None else [tenant for tenant in tenants if tenant in self.tenants]
+    routes = []
+    for tenant in tenants:
+      sub_shards = self.tenants[tenant]
+      if doc_ids is None:
+        routes.extend(((tenant, i), None) for i in range(sub_shards))
+        continue
+      by_shard = {}
+      for doc_id in set(doc_ids):
+        by_shard.setdefault(self.sub_shard_of(doc_id, sub_shards), []).append(doc_id)
+      routes.extend(((tenant, i), shard_doc_ids) for i, shard_doc_ids in sorted(by_shard.items()))
+    return routes
+
+  # runs search_fn(store, doc_ids) on every routed shard in the thread pool; unloaded shards are loaded there too,
+  # so a cold tenant's shards are read from disk in parallel. each shard stays pinned while it is searched
+  def _fan_out(self, routes: List, search_fn: Callable) -> List[List[List[Dict]]]:
+    def run(key, shard_doc_ids):
+      with self._pinned(key) as store:
+        return None if store is None else search_fn(store, shard_doc_ids)
+
+    futures = [(key, self._executor.submit(run, key, shard_doc_ids)) for key, shard_doc_ids in routes]
+    shard_results = []
+    for (tenant, _), future in futures:
+      result_lists = future.result()
+      if result_lists is None:
+        continue
+      for results in result_lists:
+        for result in results:
+          result["tenant"] = tenant
+      shard_results.append(result_lists)
+    return shard_results
+
+  # every shard returns its rows best first, so a k-way heap merge reads only the top k of all shards
+  @staticmethod
+  def _merge(shard_results: List[List[List[Dict]]], num_queries: int, k: int, score_key: str) -> List[List[Dict]]:
+    return [
+        list(islice(heapq.merge(*(result_lists[row] for result_lists in shard_results), key=lambda r: r[score_key], reverse=True), k))
+        for row in range(num_queries)
+    ]
+
+  def search(self, query_embedding: np.ndarray, k: int = 5, **kwargs) -> List[Dict]:
+    return self.search_batch(np.atleast_2d(query_embedding)[:1], k=k, **kwargs)[0]
+
+  # batched search over the selected tenants (default: all); shards are searched in parallel in the thread pool,
+  # which faiss allows since it releases the GIL, and each result is tagged with its tenant
+  def search_batch(self,
+                   query_embeddings: np.ndarray,
+                   k: int = 5,
+                   tenants: Iterable[str] = None,
+                   search_filter: SearchFilter = None,
+                   doc_ids: Iterable[str] = None,
+                   nprobe: int = None,
+                   ef_search: int = None) -> List[List[Dict]]:
+    query_embeddings = np.array(np.atleast_2d(query_embeddings), dtype=np.float32)
+    faiss.normalize_L2(query_embeddings)
+    search_filter = SearchFilter.combine(search_filter, doc_ids)
+    routes = self._route(tenants, search_filter.doc_ids if search_filter else None)
+
+    # each shard evaluates the rest of the filter against its own metadata index before scoring
+    with telemetry.span("sharded_search", queries=len(query_embeddings), k=k, shards=len(routes)):
+      shard_results = self._fan_out(routes, lambda store, shard_doc_ids: store.search_batch(
+          query_embeddings.copy(), k=k, nprobe=nprobe, ef_search=ef_search, search_filter=search_filter, doc_ids=shard_doc_ids))
+      return self._merge(shard_results, len(query_embeddings), k, "similarity")
+
+  def hybrid_search(self, query_text: str, query_embedding: np.ndarray, k: int = 5, **kwargs) -> List[Dict]:
+    return self.hybrid_search_batch([query_text], np.atleast_2d(query_embedding)[:1], k=k, **kwargs)[0]
+
+  # hybrid search per shard, merged on the fused score; each shard ranks within its own candidates
+  def hybrid_search_batch(self,
+                          query_texts: List[str],
+                          query_embeddings: np.ndarray,
+                          k: int = 5,
+                          tenants: Iterable[str] = None,
+                          search_filter: SearchFilter = None,
+                          doc_ids: Iterable[str] = None,
+                          **kwargs) -> List[List[Dict]]:
+    query_embeddings = np.array(np.atleast_2d(query_embeddings), dtype=np.float32)
+    search_filter = SearchFilter.combine(search_filter, doc_ids)
+    routes = self._route(tenants, search_filter.doc_ids if search_filter else None)
+
+    with telemetry.span("sharded_search", queries=len(query_texts), k=k, shards=len(routes), hybrid=True):
+      shard_results = self._fan_out(routes, lambda store, shard_doc_ids: store.hybrid_search_batch(
+          query_texts, query_embeddings.copy(), k=k, search_filter=search_filter, doc_ids=shard_doc_ids, **kwargs))
+      return self._merge(shard_results, len(query_texts), k, "rrf_score")
+
+  # function to write the manifest and every changed loaded shard; each shard is saved (and compacted) while
+  # it is held exclusively, so searches and writes of other shards go on meanwhile
+  def save(self):
+    if not self.root_dir:
+      raise ValueError("No root_dir specified for saving the sharded store")
+    with self._lock:
+      dirty = [key for key in self._dirty if key in self.shards]
+    for key in dirty:
+      with self._pinned(key, write=True) as store:
+        with self._lock:
+          if key not in self._dirty:
+            continue
+        self._save_shard(key, store)
+        with self._lock:
+          self._dirty.discard(key)
+    with self._lock:
+      self._write_manifest()
+
+  def _save_shard(self, key: Tuple[str, int], store: VectorStore):
+    # the manifest goes first, so a saved shard is never orphaned by a tenant the manifest does not know
+    with self._lock:
+      self._write_manifest()
+      file_lock = self._file_locks.setdefault(key, threading.Lock())
+    if store.index is not None:
+      with file_lock:
+        os.makedirs(os.path.dirname(self._shard_path(key)), exist_ok=True)
+        store.save_index(self._shard_path(key))
+
+  def _write_manifest(self):
+    os.makedirs(self.root_dir, exist_ok=True)
+    tmp_path = os.path.join(self.root_dir, self.MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump({"dimension": self.dimension, "store": self.store_kwargs, "tenants": self.tenants}, f)
+    os.replace(tmp_path, os.path.join(self.root_dir, self.MANIFEST))
+
+  # function to unload every shard and stop the search threads
+  def close(self, save: bool = True):
+    for tenant, sub_shard in self.loaded_shards():
+      self.unload_shard(tenant, sub_shard, save=save)
+    self._executor.shutdown(wait=True)
+
+  # size of the loaded shards only; unloaded shards are not opened just to count them
+  def get_index_size(self) -> int:
+    with self._lock:
+      return sum(store.get_index_size() for store in self.shards.values())
+
+  def get_stats(self) -> Dict:
+    with self._lock:
+      return {
+          "tenants": dict(self.tenants),
+          "loaded_shards": {f"{tenant}/{sub_shard}": store.get_index_size() for (tenant, sub_shard), store in self.shards.items()},
+          "dirty_shards": len(self._dirty),
+          "pinned_shards": len(self._pins),
+          "collapsed_chunks": sum(len(store.dedup.aliases) for store in self.shards.values() if store.dedup is not None)
+      }
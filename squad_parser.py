@@ -1,49 +1,193 @@
 import json
+import os
 import random
-from typing import List, Dict, Tuple, Literal, Optional
+import shutil
+from typing import List, Dict, Tuple, Literal, Optional, Iterator
+import numpy as np
 
 class SquadParser:
-    def __init__(self, json_file: str):
-        with open(json_file, "r", encoding="utf-8") as f:
-            squad_data = json.load(f)
-        self.data = squad_data.get("data", [])
-        self.context_question_pairs = self._extract_context_question_pairs()
-
-    def _extract_context_question_pairs(self) -> List[Tuple[str, List[Dict]]]:
-        pairs = []
-        for article in self.data:
-            for paragraph in article.get("paragraphs", []):
-                context = paragraph.get("context", "")
-                qas = paragraph.get("qas", [])
-                pairs.append((context, qas))
-        return pairs
+    # the parsed dataset is cached in <json_file>.index/ and reused while the source file is unchanged:
+    #   contexts.bin / context_offsets.npy   context texts as one utf-8 blob
+    #   qas.bin / qa_offsets.npy             each qa dict as json, grouped by context
+    #   context_qa_starts.npy                first qa row of each context, plus a final end row
+    #   qa_context.npy / qa_impossible.npy   context row and is_impossible flag of each qa
+    #   {answerable,unanswerable,both}_contexts.npy, {answerable,unanswerable}_qas.npy   precomputed sampling populations
+    INDEX_VERSION = 1
+
+    def __init__(self, json_file: str, index_dir: str = None):
+        self.json_file = json_file
+        self.index_dir = index_dir or json_file + ".index"
+        if not self._index_is_current():
+            self._build_index()
+        self._open_index()
+
+    def _source_stamp(self) -> Dict:
+        stat = os.stat(self.json_file)
+        return {"version": self.INDEX_VERSION, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def _index_is_current(self) -> bool:
+        meta_path = os.path.join(self.index_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f) == self._source_stamp()
+
+    # yields (context, qas) per paragraph; with ijson installed the file is streamed instead of loaded whole
+    def _iter_paragraphs(self) -> Iterator[Tuple[str, List[Dict]]]:
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+
+        with open(self.json_file, "rb") as f:
+            if ijson is not None:
+                paragraphs = ijson.items(f, "data.item.paragraphs.item", use_float=True)
+            else:
+                paragraphs = (p for article in json.load(f).get("data", []) for p in article.get("paragraphs", []))
+            for paragraph in paragraphs:
+                yield paragraph.get("context", ""), paragraph.get("qas", [])
+
+    # function to parse the dataset once into the on-disk index
+    def _build_index(self):
+        tmp_dir = self.index_dir + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        context_offsets, qa_offsets, context_qa_starts = [0], [0], []
+        qa_context, qa_impossible = [], []
+        with open(os.path.join(tmp_dir, "contexts.bin"), "wb") as contexts, open(os.path.join(tmp_dir, "qas.bin"), "wb") as qas_blob:
+            for row, (context, qas) in enumerate(self._iter_paragraphs()):
+                context_offsets.append(context_offsets[-1] + contexts.write(context.encode("utf-8")))
+                context_qa_starts.append(len(qa_context))
+                for qa in qas:
+                    qa_offsets.append(qa_offsets[-1] + qas_blob.write(json.dumps(qa).encode("utf-8")))
+                    qa_context.append(row)
+                    qa_impossible.append(bool(qa.get("is_impossible", False)))
+        context_qa_starts.append(len(qa_context))
+
+        qa_context = np.array(qa_context, dtype=np.int32)
+        qa_impossible = np.array(qa_impossible, dtype=bool)
+        num_contexts = len(context_offsets) - 1
+        answerable_qas = np.flatnonzero(~qa_impossible)
+        unanswerable_qas = np.flatnonzero(qa_impossible)
+
+        arrays = {
+            "context_offsets": np.array(context_offsets, dtype=np.int64),
+            "qa_offsets": np.array(qa_offsets, dtype=np.int64),
+            "context_qa_starts": np.array(context_qa_starts, dtype=np.int64),
+            "qa_context": qa_context,
+            "qa_impossible": qa_impossible,
+            "answerable_qas": answerable_qas,
+            "unanswerable_qas": unanswerable_qas,
+            "answerable_contexts": np.unique(qa_context[answerable_qas]),
+            "unanswerable_contexts": np.unique(qa_context[unanswerable_qas]),
+            "both_contexts": np.unique(qa_context) if len(qa_context) else np.zeros(0, dtype=np.int32)
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), array)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(self._source_stamp(), f)
+
+        if os.path.exists(self.index_dir):
+            shutil.rmtree(self.index_dir)
+        os.replace(tmp_dir, self.index_dir)
+        print(f"Indexed {num_contexts} contexts and {len(qa_context)} questions into {self.index_dir}")
+
+    def _open_index(self):
+        def load(name):
+            return np.load(os.path.join(self.index_dir, name + ".npy"), mmap_mode="r")
+
+        self.context_offsets = load("context_offsets")
+        self.qa_offsets = load("qa_offsets")
+        self.context_qa_starts = load("context_qa_starts")
+        self.qa_context = load("qa_context")
+        self.qa_impossible = load("qa_impossible")
+        self.populations = {
+            "answerable": load("answerable_contexts"),
+            "unanswerable": load("unanswerable_contexts"),
+            "both": load("both_contexts")
+        }
+        self.answerable_qas = load("answerable_qas")
+        self.unanswerable_qas = load("unanswerable_qas")
+        self._contexts = self._map_blob(os.path.join(self.index_dir, "contexts.bin"))
+        self._qas = self._map_blob(os.path.join(self.index_dir, "qas.bin"))
+
+    @staticmethod
+    def _map_blob(path: str) -> np.ndarray:
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode="r")
+
+    def __len__(self) -> int:
+        return len(self.context_offsets) - 1
+
+    @property
+    def num_questions(self) -> int:
+        return len(self.qa_context)
+
+    def get_context(self, row: int) -> str:
+        return bytes(self._contexts[self.context_offsets[row]:self.context_offsets[row + 1]]).decode("utf-8")
+
+    def get_qa(self, qa_row: int) -> Dict:
+        return json.loads(bytes(self._qas[self.qa_offsets[qa_row]:self.qa_offsets[qa_row + 1]]))
+
+    # function to decode one context with its qas, keeping only the ones that match filter_by
+    def get_pair(self, row: int, filter_by: str = "both") -> Tuple[str, List[Dict]]:
+        qa_rows = range(int(self.context_qa_starts[row]), int(self.context_qa_starts[row + 1]))
+        if filter_by != "both":
+            wanted = filter_by == "unanswerable"
+            qa_rows = [qa_row for qa_row in qa_rows if bool(self.qa_impossible[qa_row]) == wanted]
+        return self.get_context(row), [self.get_qa(qa_row) for qa_row in qa_rows]
+
+    # kept for code that iterated the old in-memory list; decodes the whole dataset
+    @property
+    def context_question_pairs(self) -> List[Tuple[str, List[Dict]]]:
+        return [self.get_pair(row) for row in range(len(self))]
+
+    @staticmethod
+    def _rng(seed: Optional[int]):
+        # without a seed, sampling follows the global random state like before
+        return random if seed is None else random.Random(seed)
 
     def get_random_pairs(
-        self, 
-        n: int = 10, 
-        filter_by: Optional[Literal["answerable", "unanswerable", "both"]] = "both"
+        self,
+        n: int = 10,
+        filter_by: Optional[Literal["answerable", "unanswerable", "both"]] = "both",
+        seed: Optional[int] = None
     ) -> List[Tuple[str, List[Dict]]]:
-        filtered_pairs = []
+        population = self.populations[filter_by or "both"]
+        # sampling positions from a range is O(n), and only the sampled contexts are decoded
+        positions = self._rng(seed).sample(range(len(population)), min(n, len(population)))
+        return [self.get_pair(int(population[i]), filter_by or "both") for i in positions]
 
-        for context, qas in self.context_question_pairs:
-            if filter_by == "answerable":
-                filtered_qas = [q for q in qas if not q.get("is_impossible", False)]
-            elif filter_by == "unanswerable":
-                filtered_qas = [q for q in qas if q.get("is_impossible", False)]
-            else:  # both
-                filtered_qas = qas
+    # function to sample individual questions with a fixed share of answerable ones; each item carries its context
+    def sample_questions(self, n: int = 100, answerable_fraction: float = 0.5, seed: Optional[int] = None) -> List[Dict]:
+        rng = self._rng(seed)
+        n_answerable = min(int(round(n * answerable_fraction)), len(self.answerable_qas))
+        n_unanswerable = min(n - n_answerable, len(self.unanswerable_qas))
 
-            if filtered_qas:
-                filtered_pairs.append((context, filtered_qas))
+        qa_rows = [int(self.answerable_qas[i]) for i in rng.sample(range(len(self.answerable_qas)), n_answerable)]
+        qa_rows += [int(self.unanswerable_qas[i]) for i in rng.sample(range(len(self.unanswerable_qas)), n_unanswerable)]
+        rng.shuffle(qa_rows)
+        return [dict(self.get_qa(qa_row), context=self.get_context(int(self.qa_context[qa_row]))) for qa_row in qa_rows]
 
-        return random.sample(filtered_pairs, min(n, len(filtered_pairs)))
+    # function to iterate over (context, qas) pairs in dataset order, batch_size contexts at a time
+    def iter_batches(
+        self,
+        batch_size: int = 64,
+        filter_by: Optional[Literal["answerable", "unanswerable", "both"]] = "both"
+    ) -> Iterator[List[Tuple[str, List[Dict]]]]:
+        population = self.populations[filter_by or "both"]
+        for start in range(0, len(population), batch_size):
+            yield [self.get_pair(int(row), filter_by or "both") for row in population[start:start + batch_size]]
 
 
 # # Load random question sets from SQuAD
 # from squad_parser import SquadParser
 
-# parser = SquadParser("train-v2.0.json")
-# random_pairs = parser.get_random_pairs(n=5)    # pass in "answerable", "unanswerable", or "both"
+# parser = SquadParser("train-v2.0.json")    # the first run writes train-v2.0.json.index/, later runs open it instantly
+# random_pairs = parser.get_random_pairs(n=5, seed=0)    # pass in "answerable", "unanswerable", or "both"
 
 # # retriever topk = 30
 # # final topk = 5
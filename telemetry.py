@@ -0,0 +1,213 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+
+# seconds; covers everything from a cached embedding lookup to a slow LLM call
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+# the span that is currently open in this thread or asyncio task
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class _NoopSpan:
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def set(self, key: str, value):
+    pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class Span:
+  __slots__ = ("telemetry", "name", "attributes", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "error", "_token")
+
+  def __init__(self, telemetry: "Telemetry", name: str, attributes: Dict):
+    self.telemetry = telemetry
+    self.name = name
+    self.attributes = attributes
+    self.error = None
+
+  def set(self, key: str, value):
+    self.attributes[key] = value
+
+  def __enter__(self):
+    parent = _current_span.get()
+    self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+    self.parent_id = parent.span_id if parent is not None else None
+    self.span_id = os.urandom(8).hex()
+    self._token = _current_span.set(self)
+    self.start_ns = time.time_ns()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self.end_ns = time.time_ns()
+    _current_span.reset(self._token)
+    if exc_type is not None:
+      self.error = f"{exc_type.__name__}: {exc}"
+    self.telemetry._finish(self)
+    return False
+
+class Telemetry:
+
+  def __init__(self, enabled: bool = False, max_spans: int = 10000, service_name: str = "doc-qa"):
+    self.enabled = enabled
+    self.service_name = service_name
+    self._lock = threading.Lock()
+    self.spans = deque(maxlen=max_spans)   # finished spans, oldest dropped first
+    self._counters = {}                    # (name, labels) -> value
+    self._histograms = {}                  # (name, labels) -> [bucket counts..., sum, count]
+    self._buckets = {}                     # name -> bucket bounds
+
+  def enable(self):
+    self.enabled = True
+
+  def disable(self):
+    self.enabled = False
+
+  def reset(self):
+    with self._lock:
+      self.spans.clear()
+      self._counters = {}
+      self._histograms = {}
+
+  # function to time a stage: `with telemetry.span("embed", batch_size=n) as span:`
+  # when disabled this returns a shared no-op object, so instrumented code pays for one attribute check and call
+  def span(self, name: str, **attributes):
+    if not self.enabled:
+      return _NOOP_SPAN
+    return Span(self, name, attributes)
+
+  def count(self, name: str, value: float = 1, **labels):
+    if not self.enabled:
+      return
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def observe(self, name: str, value: float, buckets=SIZE_BUCKETS, **labels):
+    if not self.enabled:
+      return
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      bounds = self._buckets.setdefault(name, buckets)
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = [0] * (len(bounds) + 2)
+      for i, bound in enumerate(bounds):
+        if value <= bound:
+          histogram[i] += 1
+          break
+      histogram[-2] += value
+      histogram[-1] += 1
+
+  def _finish(self, span: Span):
+    self.observe("stage_duration_seconds", (span.end_ns - span.start_ns) / 1e9, buckets=DURATION_BUCKETS, stage=span.name)
+    if span.error is not None:
+      self.count("stage_errors_total", stage=span.name)
+    with self._lock:
+      self.spans.append(span)
+
+  # function to render every metric in the Prometheus text exposition format
+  def export_prometheus(self, prefix: str = "docqa_") -> str:
+    def render_labels(labels, extra=()):
+      pairs = [f'{key}="{str(value)}"' for key, value in list(labels) + list(extra)]
+      return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    lines = []
+    with self._lock:
+      counters = sorted(self._counters.items())
+      histograms = sorted(self._histograms.items())
+
+    typed = set()
+    for (name, labels), value in counters:
+      if name not in typed:
+        lines.append(f"# TYPE {prefix}{name} counter")
+        typed.add(name)
+      lines.append(f"{prefix}{name}{render_labels(labels)} {value}")
+
+    for (name, labels), histogram in histograms:
+      if name not in typed:
+        lines.append(f"# TYPE {prefix}{name} histogram")
+        typed.add(name)
+      cumulative = 0
+      for bound, bucket_count in zip(self._buckets[name], histogram):
+        cumulative += bucket_count
+        lines.append(f"{prefix}{name}_bucket{render_labels(labels, [('le', bound)])} {cumulative}")
+      lines.append(f"{prefix}{name}_bucket{render_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+      lines.append(f"{prefix}{name}_sum{render_labels(labels)} {histogram[-2]}")
+      lines.append(f"{prefix}{name}_count{render_labels(labels)} {histogram[-1]}")
+    return "\n".join(lines) + "\n"
+
+  # function to export finished spans as OTLP/JSON, the format OpenTelemetry collectors accept on /v1/traces
+  def export_otlp(self, clear: bool = True) -> Dict:
+    with self._lock:
+      spans = list(self.spans)
+      if clear:
+        self.spans.clear()
+
+    def attribute(key, value):
+      if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+      if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+      if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+      return {"key": key, "value": {"stringValue": str(value)}}
+
+    otlp_spans = []
+    for span in spans:
+      record = {
+          "traceId": span.trace_id,
+          "spanId": span.span_id,
+          "name": span.name,
+          "kind": 1,
+          "startTimeUnixNano": str(span.start_ns),
+          "endTimeUnixNano": str(span.end_ns),
+          "attributes": [attribute(key, value) for key, value in span.attributes.items()],
+          "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+      }
+      if span.parent_id:
+        record["parentSpanId"] = span.parent_id
+      otlp_spans.append(record)
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": self.service_name}, "spans": otlp_spans}]
+        }]
+    }
+
+  # function to send finished spans to an OTLP/HTTP endpoint, e.g. http://localhost:4318/v1/traces
+  def push_otlp(self, endpoint: str, timeout: float = 10.0):
+    import requests
+    response = requests.post(endpoint, data=json.dumps(self.export_otlp()), headers={"Content-Type": "application/json"}, timeout=timeout)
+    response.raise_for_status()
+
+  # per-stage duration summary of the spans still held in memory
+  def summary(self) -> Dict[str, Dict[str, float]]:
+    with self._lock:
+      spans = list(self.spans)
+    durations = {}
+    for span in spans:
+      durations.setdefault(span.name, []).append((span.end_ns - span.start_ns) / 1e6)
+    return {
+        name: {"count": len(values), "total_ms": sum(values), "mean_ms": sum(values) / len(values)}
+        for name, values in durations.items()
+    }
+
+  def get_counters(self) -> List:
+    with self._lock:
+      return [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+
+
+# shared instance used by every component; set DOCQA_TELEMETRY=1 or call telemetry.enable() to turn it on
+telemetry = Telemetry(enabled=os.environ.get("DOCQA_TELEMETRY", "") == "1")
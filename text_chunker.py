@@ -1,41 +1,277 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from typing import List, Dict
+import argparse
+import time
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, compress, count, islice, repeat
+from operator import add, ge, sub
+from typing import List, Dict, Iterable, Iterator, Tuple
+import numpy as np
+from telemetry import telemetry
 
 class TextChunker:
 
   def __init__(self,
                chunk_size: int = 512,
                chunk_overlap: int = 128,
-               separators: List[str] = None):
-    
+               separators: List[str] = None,
+               tokenizer=None):
+    if chunk_overlap > chunk_size:
+      raise ValueError(f"chunk_overlap ({chunk_overlap}) must not be larger than chunk_size ({chunk_size})")
+
     self.chunk_size = chunk_size
     self.chunk_overlap = chunk_overlap
 
     self.separators = separators or ["\n\n", "\n", ". ", " ", ""]
 
-    self.splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
+    # with a (fast) huggingface tokenizer, chunk_size and chunk_overlap are counted in its tokens instead of characters
+    self.tokenizer = tokenizer
+
+  # function to size chunks in the embedder's own tokens, so no chunk is cut off at its max_seq_length
+  @classmethod
+  def for_embedder(cls, embedder, chunk_overlap: int = 64, separators: List[str] = None) -> "TextChunker":
+    model = embedder.model
+    # two positions go to the [CLS]/[SEP] style special tokens the model adds
+    return cls(
+        chunk_size=model.max_seq_length - 2,
         chunk_overlap=chunk_overlap,
-        separators=self.separators,
-        length_function=len,
-        is_separator_regex=False
+        separators=separators,
+        tokenizer=model.tokenizer
     )
-    # TODO
 
   # function to create chunks with metadata
   def chunk_text(self, text: str, metadata: dict) -> List[Dict]:
     if not text:
       return []
-    
-    documents = self.splitter.create_documents([text], [metadata])
-
-    chunks = []
-    for i, doc in enumerate(documents):
-      chunk_metadata = doc.metadata.copy()
-      chunk_metadata["chunk_index"] = i
-      chunks.append({
-          "text": doc.page_content,
-          "metadata": chunk_metadata
-      })
-    
-    return chunks
\ No newline at end of file
+
+    with telemetry.span("chunk", characters=len(text)) as span:
+      chunks = [
+          self._make_chunk(text[start:end], metadata, i, None, start, end)
+          for i, (start, end) in enumerate(self.split_spans(text))
+      ]
+      span.set("chunks", len(chunks))
+      telemetry.count("chunks_total", len(chunks))
+
+    return chunks
+
+  def split_text(self, text: str) -> List[str]:
+    return [text[start:end] for start, end in self.split_spans(text)]
+
+  # function to split text into (start, end) character spans, with the semantics of LangChain's
+  # RecursiveCharacterTextSplitter (keep_separator=True, strip_whitespace=True): the first separator found splits
+  # the text, every separator stays at the start of the piece after it, pieces shorter than chunk_size are merged
+  # with chunk_overlap, and longer pieces are split again with the remaining separators.
+  # pieces are kept as offsets into the one text, so nothing is copied until a chunk is emitted
+  def split_spans(self, text: str) -> List[Tuple[int, int]]:
+    spans = []
+    if text:
+      self._split(text, 0, len(text), self.separators, self._length_function(text), spans)
+    return spans
+
+  # returns a function giving the lengths of the pieces between consecutive bounds: characters, or tokens of the
+  # text tokenized once up front, counted for all pieces at once with a vectorized search over the token offsets
+  def _length_function(self, text: str):
+    if self.tokenizer is None:
+      return lambda bounds: list(map(sub, islice(bounds, 1, None), bounds))
+
+    if not getattr(self.tokenizer, "is_fast", False):
+      raise ValueError("Token-sized chunks need a fast tokenizer, since token offsets are used to measure spans")
+    offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)["offset_mapping"]
+    token_starts = np.array([start for start, _ in offsets], dtype=np.int64)
+    token_ends = np.array([end for _, end in offsets], dtype=np.int64)
+
+    # tokens that overlap [start, end): those starting before end, minus those already over by start
+    def count_tokens(bounds):
+      bounds = np.asarray(bounds, dtype=np.int64)
+      counts = np.searchsorted(token_starts, bounds[1:], side="left") - np.searchsorted(token_ends, bounds[:-1], side="right")
+      return counts.tolist()
+    return count_tokens
+
+  def _split(self, text: str, start: int, end: int, separators: List[str], length, spans: List[Tuple[int, int]]):
+    separator, remaining = separators[-1], []
+    for i, candidate in enumerate(separators):
+      if not candidate:
+        separator = candidate
+        break
+      if text.find(candidate, start, end) >= 0:
+        separator, remaining = candidate, separators[i + 1:]
+        break
+
+    bounds = self._bounds(text, start, end, separator)
+    lengths = length(bounds)
+
+    # runs of pieces shorter than chunk_size are merged; each longer piece is split further on its own
+    merged_from = 0
+    too_long = list(compress(count(), map(ge, lengths, repeat(self.chunk_size))))
+    for i in too_long + [len(lengths)]:
+      if i > merged_from:
+        self._merge(text, bounds, lengths, merged_from, i, spans)
+      if i == len(lengths):
+        break
+      if remaining:
+        self._split(text, bounds[i], bounds[i + 1], remaining, length, spans)
+      else:
+        spans.append((bounds[i], bounds[i + 1]))    # nothing left to split on; kept as it is, unstripped
+      merged_from = i + 1
+
+  # offsets where the pieces between occurrences of separator start, plus the end; each occurrence starts a new
+  # piece and an empty first piece is dropped. str.split and the itertools chain do all the work in C, so there
+  # is no python-level step per piece
+  @staticmethod
+  def _bounds(text: str, start: int, end: int, separator: str) -> List[int]:
+    if not separator:
+      return list(range(start, end + 1))
+
+    width = len(separator)
+    # every piece after the first is its part plus the separator in front of it
+    bounds = list(accumulate(map(add, map(len, text[start:end].split(separator)), repeat(width)), initial=start - width))
+    bounds[0] = start
+    if bounds[1] == start:
+      del bounds[0]
+    return bounds
+
+  # greedy merge of pieces into chunks of at most chunk_size, each new chunk starting with up to chunk_overlap of
+  # the previous one's tail. on the running total of piece lengths, both where a chunk has to end and how far the
+  # next one may reach back are binary searches, so the python work grows with the number of chunks, not pieces
+  def _merge(self, text: str, bounds: List[int], lengths: List[int], first: int, stop: int, spans: List[Tuple[int, int]]):
+    totals = list(accumulate(islice(lengths, first, stop), initial=0))
+    bounds = bounds if first == 0 else bounds[first:stop + 1]
+    pieces = stop - first
+    head = 0
+    while True:
+      # the first piece that no longer fits after the chunk starting at head
+      last = bisect_right(totals, totals[head] + self.chunk_size) - 1
+      if last >= pieces:
+        break
+      self._emit(text, bounds[head], bounds[last], spans)
+      # drop pieces from the front until what is left fits in chunk_overlap and leaves room for the next piece
+      keep_from = max(totals[last] - self.chunk_overlap, min(totals[last + 1] - self.chunk_size, totals[last]))
+      head = max(head, bisect_left(totals, keep_from))
+    self._emit(text, bounds[head], bounds[pieces], spans)
+
+  # a chunk is the span with surrounding whitespace dropped; whitespace-only spans are skipped
+  @staticmethod
+  def _emit(text: str, start: int, end: int, spans: List[Tuple[int, int]]):
+    if not text[start].isspace() and not text[end - 1].isspace():
+      spans.append((start, end))
+      return
+    piece = text[start:end]
+    stripped = piece.lstrip()
+    if not stripped:
+      return
+    start += len(piece) - len(stripped)
+    spans.append((start, start + len(stripped.rstrip())))
+
+  # streaming chunking over (page_number, text) pairs, e.g. from DocumentLoader.iter_pages
+  # the text from the start of each page's last chunk is held back and re-split with the next page, so at most one
+  # chunk of text is carried over. character offsets refer to the non-empty pages joined by a blank line
+  def chunk_pages(self, pages: Iterable[Tuple[int, str]], metadata: dict) -> Iterator[Dict]:
+    carry, carry_offset = "", 0    # held-back text and its offset in the document
+    last = None                    # (offset, text) of the held-back chunk
+    page_offsets, page_numbers = [], []
+    chunk_index = 0
+
+    for page_number, page_text in pages:
+      if not page_text:
+        continue
+      buffer = carry + "\n\n" + page_text if carry else page_text
+      page_offsets.append(carry_offset + len(buffer) - len(page_text))
+      page_numbers.append(page_number)
+
+      spans = self.split_spans(buffer)
+      if not spans:
+        carry = buffer
+        continue
+
+      for start, end in spans[:-1]:
+        yield self._page_chunk(buffer, carry_offset, start, end, metadata, chunk_index, page_offsets, page_numbers)
+        chunk_index += 1
+      telemetry.count("chunks_total", len(spans) - 1)
+
+      start, end = spans[-1]
+      last = (carry_offset + start, buffer[start:end])
+      carry, carry_offset = buffer[start:], carry_offset + start
+
+    if last is not None:
+      telemetry.count("chunks_total")
+      start, text = last
+      yield self._page_chunk(text, start, 0, len(text), metadata, chunk_index, page_offsets, page_numbers)
+
+  # a chunk belongs to the page it starts on; page_end is the page it ends on
+  def _page_chunk(self, buffer: str, buffer_offset: int, start: int, end: int, metadata: dict, chunk_index: int,
+                  page_offsets: List[int], page_numbers: List[int]) -> Dict:
+    page = page_numbers[bisect_right(page_offsets, buffer_offset + start) - 1]
+    page_end = page_numbers[bisect_right(page_offsets, buffer_offset + max(end - 1, start)) - 1]
+    chunk = self._make_chunk(buffer[start:end], metadata, chunk_index, page, buffer_offset + start, buffer_offset + end)
+    chunk["metadata"]["page_end"] = page_end
+    return chunk
+
+  @staticmethod
+  def _make_chunk(text: str, metadata: dict, chunk_index: int, page: int, start: int, end: int) -> Dict:
+    chunk_metadata = metadata.copy()
+    chunk_metadata["chunk_index"] = chunk_index
+    chunk_metadata["start_char"] = start
+    chunk_metadata["end_char"] = end
+    if page is not None:
+      chunk_metadata["page"] = page
+    return {
+        "text": text,
+        "metadata": chunk_metadata
+    }
+
+
+# function to check the built-in splitter against LangChain's RecursiveCharacterTextSplitter on a corpus
+# (character-sized chunks); langchain is only needed for this check
+def splitter_parity(chunker: TextChunker, texts: List[str], repeat: int = 3) -> Dict:
+  try:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+  except ImportError:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+  reference = RecursiveCharacterTextSplitter(
+      chunk_size=chunker.chunk_size,
+      chunk_overlap=chunker.chunk_overlap,
+      separators=chunker.separators,
+      length_function=len,
+      is_separator_regex=False
+  )
+
+  def timed(split):
+    best, output = float("inf"), None
+    for _ in range(repeat):
+      start = time.perf_counter()
+      output = [split(text) for text in texts]
+      best = min(best, time.perf_counter() - start)
+    return best, output
+
+  reference_seconds, expected = timed(lambda text: [doc.page_content for doc in reference.create_documents([text])])
+  builtin_seconds, actual = timed(chunker.split_text)
+
+  mismatched = [i for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+  return {
+      "texts": len(texts),
+      "chunks": sum(len(chunks) for chunks in expected),
+      "mismatched_texts": mismatched,
+      "identical": not mismatched,
+      "langchain_seconds": reference_seconds,
+      "builtin_seconds": builtin_seconds,
+      "speedup": reference_seconds / builtin_seconds if builtin_seconds > 0 else float("inf")
+  }
+
+
+def main():
+  from document_loader import DocumentLoader
+
+  parser = argparse.ArgumentParser(description="Check the built-in splitter against LangChain's on a set of PDFs")
+  parser.add_argument("pdfs", nargs="+", help="PDF files whose text is used as the corpus")
+  parser.add_argument("--chunk-size", type=int, default=512)
+  parser.add_argument("--chunk-overlap", type=int, default=128)
+  parser.add_argument("--repeat", type=int, default=3, help="timing runs per splitter; the best is kept")
+  args = parser.parse_args()
+
+  loader = DocumentLoader(workers=1)
+  texts = ["\n\n".join(text for _, text in loader.iter_pages(path) if text) for path in args.pdfs]
+  chunker = TextChunker(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+  print(splitter_parity(chunker, texts, repeat=args.repeat))
+
+
+if __name__ == "__main__":
+  main()
@@ -1,96 +1,916 @@
-import faiss
+import hashlib
+import json
 import pickle
 from typing import Tuple, List, Dict
 import numpy as np
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+from chunk_store import ChunkStore
+from bm25_index import BM25Index
+from metadata_index import MetadataIndex, SearchFilter
+from near_duplicates import NearDuplicateIndex
+from telemetry import telemetry, DURATION_BUCKETS
+from lazy_imports import lazy_module
+
+# faiss is imported on first use, so importing the store stays cheap for tasks that never touch an index
+faiss = lazy_module("faiss")
 
 class VectorStore:
 
-  def __init__(self, dimension: int, index_path: str = None):
+  INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+  GPU_MAX_K = 2048            # faiss gpu indexes reject searches for more neighbours than this
+
+  def __init__(self,
+               dimension: int,
+               index_path: str = None,
+               compaction_threshold: float = 0.1,
+               index_type: str = "flat",
+               nlist: int = None,
+               pq_m: int = 64,
+               hnsw_m: int = 32,
+               nprobe: int = 16,
+               ef_search: int = 64,
+               train_sample_size: int = 100000,
+               retrain_factor: float = 2.0,
+               exact_filter_size: int = 2048,
+               mmap: bool = False,
+               dedup_threshold: float = None):
+    if index_type not in self.INDEX_TYPES:
+      raise ValueError(f"Invalid index type. Choose from: {list(self.INDEX_TYPES)}")
+    if index_type == "ivf_pq" and dimension % pq_m != 0:
+      raise ValueError(f"pq_m ({pq_m}) must divide the embedding dimension ({dimension})")
+
     self.dimension = dimension
     self.index_path = index_path
-    self.metadata_store = []
+    self.compaction_threshold = compaction_threshold
 
-    self.index = faiss.IndexFlatIP(dimension)   # using inner product for index construction because it is faster and same as cosine similarity if vectors are normalized
+    # index factory settings; nprobe/ef_search are query-time defaults and can be overridden per search
+    self.index_type = index_type
+    self.nlist = nlist
+    self.pq_m = pq_m
+    self.hnsw_m = hnsw_m
+    self.nprobe = nprobe
+    self.ef_search = ef_search
+    self.train_sample_size = train_sample_size
+    # ivf indexes are trained once enough vectors are stored (until then chunks sit in an exact flat staging index)
+    # and retrained when the store outgrows them: when the list count the size calls for reaches retrain_factor
+    # times the trained one. auto_train=False defers both to an explicit train() or maybe_train() call
+    self.retrain_factor = retrain_factor
+    self.auto_train = True
+    self.trained_nlist = None
+    self.trained_nbits = None
+    self._retrain_noted = False
+    # filters matching at most this many chunks skip the approximate index and score those vectors exactly,
+    # since a filtered hnsw walk or ivf probe can miss most of a small selection
+    self.exact_filter_size = exact_filter_size
+    # open a saved index memory-mapped and read-only: the os pages vectors in on demand and shares them between
+    # worker processes on one host, so opening is fast whatever the index size; the store then refuses writes
+    self.mmap = mmap
+    self.read_only = False
+
+    self.chunk_store = ChunkStore()   # chunk texts and metadata, memory-mapped once saved
+    self.tombstones = set()     # ids deleted from the metadata but not yet removed from the index
+    self.bm25 = BM25Index()     # lexical index over the same chunk ids, for hybrid_search
+    self.filters = MetadataIndex()    # filterable chunk attributes, evaluated before scoring
+    # near-duplicate collapsing at ingest (off when None): a chunk whose estimated word-shingle Jaccard similarity
+    # to a stored chunk reaches dedup_threshold is neither embedded nor stored, only recorded as a back-reference
+    self.dedup_threshold = dedup_threshold
+    self.dedup = NearDuplicateIndex(dedup_threshold) if dedup_threshold else None
+    self._executor = None       # runs the lexical side of hybrid searches next to the dense one
 
     # if we want to store the index locally
-    if index_path and os.path.exists(index_path):
+    # otherwise start empty; IVF indexes need training data, so they start as a staging index
+    self.index = None
+    self._cpu_copy = None       # cpu copy of a gpu index for reconstruction, dropped whenever the index changes
+    if index_path and os.path.exists(index_path + ".index"):
       self.load_index(index_path)
+    elif self.needs_training:
+      self.index = self._build_staging_index()
+    else:
+      self.index = self._to_device(self._build_index())
+
+  @property
+  def needs_training(self) -> bool:
+    return self.index_type in ("ivf_flat", "ivf_pq")
+
+  # an ivf store whose index is not trained yet keeps its vectors in an exact flat index, which scans a few
+  # thousand vectors quickly; it stays on the cpu
+  @property
+  def is_staging(self) -> bool:
+    return self.needs_training and isinstance(self.index, faiss.IndexIDMap2)
+
+  def _build_staging_index(self) -> "faiss.Index":
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+
+  # vectors staged before the first training: ~39 training points per list, and 8-bit pq codes want ~39 * 256
+  @property
+  def min_train_size(self) -> int:
+    nlist = self.nlist or 256
+    if self.index_type == "ivf_pq":
+      nlist = max(nlist, 256)
+    return 39 * nlist
+
+  # rule of thumb: ~4*sqrt(n) lists, with at least 39 training points per list
+  def _target_nlist(self, num_vectors: int, train_size: int) -> int:
+    nlist = self.nlist or int(4 * np.sqrt(num_vectors))
+    return max(1, min(nlist, train_size // 39 or 1))
+
+  # index factory; flat and hnsw are wrapped in IDMap2 so chunk ids stay stable, ivf indexes store ids natively
+  # ivf lists are sized for num_vectors stored vectors and train_size training points (default: num_vectors)
+  def _build_index(self, num_vectors: int = 0, train_size: int = None) -> "faiss.Index":
+    # using inner product for index construction because it is faster and same as cosine similarity if vectors are normalized
+    if self.index_type == "flat":
+      base = faiss.IndexFlatIP(self.dimension)
+    elif self.index_type == "hnsw":
+      base = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    else:
+      train_size = num_vectors if train_size is None else train_size
+      nlist = self._target_nlist(num_vectors, train_size)
+      quantizer = faiss.IndexFlatIP(self.dimension)
+      if self.index_type == "ivf_flat":
+        base = faiss.IndexIVFFlat(quantizer, self.dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+      else:
+        # 8-bit codes want ~39 * 256 training points per sub-quantizer; use fewer bits for small corpora
+        nbits = int(min(8, max(1, np.floor(np.log2(max(train_size // 39, 2))))))
+        base = faiss.IndexIVFPQ(quantizer, self.dimension, nlist, self.pq_m, nbits, faiss.METRIC_INNER_PRODUCT)
+      # a hashtable direct map keeps remove_ids and reconstruct by chunk id working after adds
+      base.set_direct_map_type(faiss.DirectMap.Hashtable)
+      return base
+    return faiss.IndexIDMap2(base)
 
-    # gpu acceleration
-    if faiss.get_num_gpus() > 0:
+  # function to (re)train an IVF index: a new index sized for the stored vectors is trained on `sample` (default:
+  # a random sample of the stored vectors, at most train_sample_size) and every stored vector moves into it.
+  # a trained ivf_pq index only holds lossy codes, so retraining it needs the original embeddings as sample; stored
+  # chunks listed in sample_ids are then re-encoded from their original embedding instead of their decoded code
+  def train(self, sample: np.ndarray = None, sample_ids: np.ndarray = None):
+    if not self.needs_training:
+      raise ValueError("Only ivf_flat and ivf_pq indexes are trained")
+    if sample is None and self.index_type == "ivf_pq" and not self.is_staging:
+      raise ValueError("ivf_pq stores lossy codes; pass the original embeddings as sample to retrain it")
+    if sample_ids is not None and (sample is None or len(sample_ids) != len(sample)):
+      raise ValueError("sample_ids needs one id per sample row")
+    self._check_writable()
+    self.compact()
+
+    ids = self.chunk_store.ids()
+    vectors = self._reconstruct(ids)
+    if sample is None:
+      sample = vectors
+      if len(sample) > self.train_sample_size:
+        rows = np.random.default_rng(0).choice(len(sample), self.train_sample_size, replace=False)
+        sample = sample[np.sort(rows)]
+    else:
+      sample = np.array(sample, dtype=np.float32)
+      faiss.normalize_L2(sample)
+      if sample_ids is not None:
+        sample_rows = {int(chunk_id): row for row, chunk_id in enumerate(np.asarray(sample_ids).tolist())}
+        for row, chunk_id in enumerate(ids.tolist()):
+          if chunk_id in sample_rows:
+            vectors[row] = sample[sample_rows[chunk_id]]
+    if len(sample) == 0:
+      raise ValueError("Cannot train an index without vectors")
+
+    with telemetry.span("index_train", index_type=self.index_type, vectors=len(ids), sample=len(sample)):
+      index = self._build_index(len(ids), len(sample))
+      index.train(np.ascontiguousarray(sample))
+      if len(ids):
+        index.add_with_ids(vectors, ids)
+    self.index = self._to_device(index)
+    self._cpu_copy = None
+    self._read_trained_shape(index)
+    self._retrain_noted = False
+
+  # function to train a staging index once min_train_size vectors are stored, or retrain an ivf_flat index the store
+  # has outgrown; returns whether it did. both train from exact vectors. an outgrown ivf_pq index is only reported,
+  # since retraining it from its own lossy codes would degrade every stored vector; train(sample=...) retrains it
+  def maybe_train(self) -> bool:
+    if not self.needs_training or self.read_only:
+      return False
+    size = self.get_index_size()
+    if self.is_staging:
+      due = size >= self.min_train_size
+    else:
+      target = self._target_nlist(size, min(size, self.train_sample_size))
+      due = ((self.trained_nlist is not None and target >= self.retrain_factor * self.trained_nlist)
+             or (self.trained_nbits is not None and self.trained_nbits < 8 and size >= self.min_train_size))
+      if due and self.index_type == "ivf_pq":
+        if not self._retrain_noted:
+          print(f"ivf_pq index with {self.trained_nlist} lists and {self.trained_nbits}-bit codes now holds {size} vectors; "
+                f"retrain it with train(sample=<original embeddings>)")
+          self._retrain_noted = True
+        telemetry.count("retrain_due_total", index_type=self.index_type)
+        return False
+    if due:
+      self.train()
+    return due
+
+  def _auto_train(self):
+    if self.auto_train:
+      self.maybe_train()
+
+  # list count and pq code size of a trained cpu ivf index, which decide when it is retrained
+  def _read_trained_shape(self, index: "faiss.Index"):
+    self.trained_nlist, self.trained_nbits = None, None
+    if self.needs_training and not isinstance(index, faiss.IndexIDMap2):
+      ivf = faiss.extract_index_ivf(index)
+      self.trained_nlist = ivf.nlist
+      if self.index_type == "ivf_pq":
+        self.trained_nbits = faiss.downcast_index(ivf).pq.nbits
+
+  # gpu acceleration; faiss has no gpu hnsw, so that stays on the cpu, and neither does a staging index
+  def _to_device(self, index: "faiss.Index") -> "faiss.Index":
+    if self.needs_training and isinstance(index, faiss.IndexIDMap2):
+      return index
+    if faiss.get_num_gpus() > 0 and self.index_type != "hnsw" and 'Gpu' not in type(index).__name__:
       res = faiss.StandardGpuResources()
-      self.index = faiss.index_cpu_to_gpu(res, 0, self.index)
+      return faiss.index_cpu_to_gpu(res, 0, index)
+    return index
+
+  def _check_writable(self):
+    if self.read_only:
+      raise ValueError("Index was opened read-only (mmap=True); open it without mmap to add or delete chunks")
+
+  # selector restricts the search to some chunk ids; ids it rejects are never scored
+  def _search_params(self, nprobe: int = None, ef_search: int = None, selector=None):
+    if self.index_type == "hnsw":
+      return faiss.SearchParametersHNSW(efSearch=ef_search or self.ef_search, sel=selector)
+    if self.needs_training and not self.is_staging and 'Gpu' not in type(self.index).__name__:
+      return faiss.SearchParametersIVF(nprobe=nprobe or self.nprobe, sel=selector)
+    if selector is not None:
+      return faiss.SearchParameters(sel=selector)
+    return None
+
+  # live chunk ids matching the filter (doc_ids is shorthand for SearchFilter(doc_ids=...)), or None when the
+  # search is not restricted; plus, for stored chunks that only match through a near-duplicate collapsed into
+  # them, the id of that duplicate, so the hit can be reported as the document the filter asked for
+  def _filter_ids(self, search_filter: SearchFilter = None, doc_ids: Iterable[str] = None) -> Tuple[np.ndarray, Dict[int, int]]:
+    search_filter = SearchFilter.combine(search_filter, doc_ids)
+    if search_filter is None:
+      return None, {}
+    if not self.filters.redirected:
+      return self.filters.select(search_filter), {}
+
+    chunk_ids, vector_ids = self.filters.match(search_filter)
+    direct = set(chunk_ids[chunk_ids == vector_ids].tolist())
+    redirects = {}
+    for chunk_id, vector_id in zip(chunk_ids.tolist(), vector_ids.tolist()):
+      if vector_id not in direct:
+        redirects.setdefault(vector_id, chunk_id)
+    return np.unique(vector_ids), redirects
 
-  # function to add embedded chunks and metadata into vector store
-  def add_chunks(self, embeddings: np.ndarray, chunks: List[Dict]):
+  # a hit that matched the filter only through a collapsed duplicate is reported as that duplicate: its id, document
+  # and metadata with the stored copy's near-identical text; vector_id is the stored chunk that answered for it
+  def _redirect(self, all_results: List[List[Dict]], redirects: Dict[int, int]) -> List[List[Dict]]:
+    if redirects:
+      for results in all_results:
+        for result in results:
+          alias_id = redirects.get(result["id"])
+          if alias_id is not None:
+            _, doc_id, metadata = self.dedup.aliases[alias_id]
+            result.update(id=alias_id, vector_id=result["id"], doc_id=doc_id, metadata=dict(metadata))
+    return all_results
+
+  # stable 64-bit chunk id from the document id and chunk content, so unchanged chunks keep their id across re-ingests
+  @staticmethod
+  def make_chunk_id(doc_id: str, text: str, occurrence: int = 0) -> int:
+    digest = hashlib.blake2b(f"{doc_id}\0{occurrence}\0{text}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") & 0x7FFFFFFFFFFFFFFF    # faiss ids are signed and -1 means "no result"
+
+  # function to compute the ids of a document's chunks; repeated text within a document gets distinct ids
+  # pass the same `seen` dict for every batch when a document's chunks arrive in several batches
+  def chunk_ids(self, doc_id: str, chunks: List[Dict], seen: Dict[str, int] = None) -> List[int]:
+    seen = {} if seen is None else seen
+    ids = []
+    for chunk in chunks:
+      occurrence = seen.get(chunk["text"], 0)
+      seen[chunk["text"]] = occurrence + 1
+      ids.append(self.make_chunk_id(doc_id, chunk["text"], occurrence))
+    return ids
+
+  # function to add embedded chunks and metadata into vector store; chunks already stored are skipped
+  def add_chunks(self, embeddings: np.ndarray, chunks: List[Dict], doc_id: str = None):
+    if len(embeddings) != len(chunks):
+      raise ValueError("Mismatch between embeddings and chunks count")
+    self._check_writable()
+
+    doc_id = doc_id if doc_id is not None else ""
+    ids = self.chunk_ids(doc_id, chunks)
+    added = self._add(embeddings, chunks, ids, doc_id)
+    self._auto_train()
+    return added
+
+  # function to replace a document's chunks, only touching the chunks that changed
+  def upsert_document(self, doc_id: str, embeddings: np.ndarray, chunks: List[Dict]) -> Dict[str, int]:
     if len(embeddings) != len(chunks):
       raise ValueError("Mismatch between embeddings and chunks count")
+    self._check_writable()
+
+    ids = self.chunk_ids(doc_id, chunks)
+    new_ids = set(ids)
+    stale_ids = [chunk_id for chunk_id in self._document_chunk_ids(doc_id) if chunk_id not in new_ids]
+
+    self._remove(stale_ids)
+    collapsed = self._collapsed_count()
+    added = self._add(embeddings, chunks, ids, doc_id)
+    collapsed = self._collapsed_count() - collapsed
+    self._maybe_compact()
+    self._auto_train()
+
+    return {"added": added, "collapsed": collapsed, "removed": len(stale_ids), "unchanged": len(ids) - added - collapsed}
+
+  # streaming version of upsert_document: chunks arrive in batches and only chunks that are not stored yet are embedded
+  def upsert_document_stream(self,
+                             doc_id: str,
+                             chunk_batches: Iterable[List[Dict]],
+                             embed_fn: Callable[[List[str]], np.ndarray]) -> Dict[str, int]:
+    self._check_writable()
+    seen = {}
+    live_ids = set()
+    added = 0
+    collapsed = self._collapsed_count()
+
+    for chunks in chunk_batches:
+      ids = self.chunk_ids(doc_id, chunks, seen)
+      live_ids.update(ids)
+      new_rows = [i for i, chunk_id in enumerate(ids) if not self._stored(chunk_id)]
+      # duplicates are collapsed before embedding, so they cost no forward pass either
+      if self.dedup is not None:
+        new_rows = self._collapse_duplicates(new_rows, chunks, ids, doc_id)
+      if new_rows:
+        try:
+          embeddings = embed_fn([chunks[i]["text"] for i in new_rows])
+          added += self._add(embeddings, [chunks[i] for i in new_rows], [ids[i] for i in new_rows], doc_id)
+        except Exception:
+          if self.dedup is not None:
+            self._drop_unstored_canonicals([ids[i] for i in new_rows])
+          raise
+        self._auto_train()
+    collapsed = self._collapsed_count() - collapsed
 
+    stale_ids = [chunk_id for chunk_id in self._document_chunk_ids(doc_id) if chunk_id not in live_ids]
+    self._remove(stale_ids)
+    self._maybe_compact()
+
+    return {"added": added, "collapsed": collapsed, "removed": len(stale_ids), "unchanged": len(live_ids) - added - collapsed}
+
+  # function to delete every chunk of a document
+  def delete_document(self, doc_id: str) -> int:
+    self._check_writable()
+    chunk_ids = self._document_chunk_ids(doc_id)
+    removed = len(chunk_ids)
+    self._remove(chunk_ids)
+    self._maybe_compact()
+    return removed
+
+  # canonicals registered before embedding have no vector if the embedding or add fails; they are forgotten with the
+  # duplicates collapsed into them, so no later chunk is collapsed into text that was never stored
+  def _drop_unstored_canonicals(self, chunk_ids: List[int]):
+    for chunk_id in chunk_ids:
+      if chunk_id in self.chunk_store:
+        continue
+      for alias_id, _, _ in self.dedup.remove_canonical(chunk_id):
+        self.filters.remove(alias_id)
+        self.dedup.collapsed -= 1
+
+  # chunks collapsed into stored ones so far; upserts report the difference
+  def _collapsed_count(self) -> int:
+    return 0 if self.dedup is None else self.dedup.collapsed
+
+  # a chunk counts as stored once it has a vector or was collapsed into one
+  def _stored(self, chunk_id: int) -> bool:
+    return chunk_id in self.chunk_store or (self.dedup is not None and chunk_id in self.dedup)
+
+  def _document_chunk_ids(self, doc_id: str) -> List[int]:
+    chunk_ids = self.chunk_store.document_chunk_ids(doc_id)
+    if self.dedup is not None:
+      chunk_ids.extend(self.dedup.document_aliases(doc_id))
+    return chunk_ids
+
+  # near-duplicates of stored chunks, or of earlier chunks in the same batch, become aliases of them: they keep
+  # their own doc id and metadata for filters and back-references, but get no vector. returns the rows to add
+  def _collapse_duplicates(self, rows: List[int], chunks: List[Dict], ids: List[int], doc_id: str) -> List[int]:
+    keep = []
+    ingested_at = time.time()
+    with telemetry.span("dedup", chunks=len(rows)) as span:
+      for i in rows:
+        # already registered, e.g. by upsert_document_stream before embedding
+        if self.dedup.is_canonical(ids[i]):
+          keep.append(i)
+          continue
+        signature = self.dedup.signature(chunks[i]["text"])
+        canonical_id = None if signature is None else self.dedup.find(signature)
+        if canonical_id is None:
+          if signature is not None:
+            self.dedup.add_canonical(ids[i], signature)
+          keep.append(i)
+          continue
+        metadata = chunks[i]["metadata"]
+        if "ingested_at" not in metadata:
+          metadata = dict(metadata, ingested_at=ingested_at)
+        self.dedup.add_alias(ids[i], canonical_id, doc_id, metadata)
+        self.filters.add(ids[i], doc_id, metadata, vector_id=canonical_id)
+      span.set("collapsed", len(rows) - len(keep))
+    telemetry.count("chunks_collapsed_total", len(rows) - len(keep))
+    return keep
+
+  def _add(self, embeddings: np.ndarray, chunks: List[Dict], ids: List[int], doc_id: str) -> int:
+    keep = [i for i, chunk_id in enumerate(ids) if not self._stored(chunk_id)]
+    if self.dedup is not None:
+      keep = self._collapse_duplicates(keep, chunks, ids, doc_id)
+    if not keep:
+      return 0
+
+    embeddings = np.ascontiguousarray(embeddings[keep], dtype=np.float32)
     faiss.normalize_L2(embeddings)      # faster than cosine_similarity because of faiss's C++, SIMD, and GPU acceleration; cos(A, B) = A * B = IP for unit vectors
 
-    self.index.add(embeddings)
+    ingested_at = time.time()
+    with telemetry.span("index_add", chunks=len(keep), index_type=self.index_type):
+      new_ids = np.array([ids[i] for i in keep], dtype=np.int64)
+      # a re-added chunk that is still waiting for compaction has to leave the index first
+      revived = [chunk_id for chunk_id in new_ids.tolist() if chunk_id in self.tombstones]
+      if revived:
+        self._retire(revived)
+
+      self.index.add_with_ids(embeddings, new_ids)
+      self._cpu_copy = None
+
+      for i in keep:
+        metadata = chunks[i]["metadata"]
+        if "ingested_at" not in metadata:
+          metadata = dict(metadata, ingested_at=ingested_at)
+        self.chunk_store.add(ids[i], doc_id, chunks[i]["text"], metadata)
+        self.bm25.add(ids[i], chunks[i]["text"])
+        self.filters.add(ids[i], doc_id, metadata)
+    telemetry.count("chunks_indexed_total", len(keep))
+    return len(keep)
 
-    self.metadata_store.extend(chunks)
+  # deleted ids are only tombstoned here; the index entries are dropped in bulk by compact()
+  def _remove(self, chunk_ids: List[int]):
+    removing = set(chunk_ids)
+    orphaned = []
+    for chunk_id in chunk_ids:
+      if self.dedup is not None:
+        if self.dedup.remove_alias(chunk_id) is not None:
+          self.filters.remove(chunk_id)
+          continue
+        if self.dedup.has_duplicates(chunk_id):
+          text = self.chunk_store.get(chunk_id)["text"]
+          aliases = []
+          # duplicates deleted in the same call (e.g. within one document) are dropped with it
+          for alias in self.dedup.remove_canonical(chunk_id):
+            if alias[0] in removing:
+              self.filters.remove(alias[0])
+            else:
+              aliases.append(alias)
+          if aliases:
+            orphaned.append((chunk_id, text, aliases))
+        else:
+          self.dedup.remove_canonical(chunk_id)
+      if self.chunk_store.remove(chunk_id) is not None:
+        self.tombstones.add(chunk_id)
+        self.bm25.remove(chunk_id)
+        self.filters.remove(chunk_id)
+    if orphaned:
+      self._rehome(orphaned)
 
-  # similarity search function
-  def search(self, query_embedding: np.ndarray, k: int = 5) -> List[Dict]:
+  # the duplicates of a removed chunk lose their stored copy: the first takes over its vector and text, which are
+  # near-identical to its own, and the rest become aliases of it. tombstoned vectors stay readable until compaction
+  def _rehome(self, orphaned: List[Tuple[int, str, List[tuple]]]):
+    vectors = self._reconstruct(np.array([chunk_id for chunk_id, _, _ in orphaned], dtype=np.int64))
+    for (_, text, aliases), vector in zip(orphaned, vectors):
+      (new_id, doc_id, metadata), rest = aliases[0], aliases[1:]
+      for alias_id, _, _ in aliases:
+        self.filters.remove(alias_id)
+      self.dedup.add_canonical(new_id, self.dedup.signature(text))
+      self._add(vector[None], [{"text": text, "metadata": metadata}], [new_id], doc_id)
+      for alias_id, alias_doc_id, alias_metadata in rest:
+        self.dedup.add_alias(alias_id, new_id, alias_doc_id, alias_metadata)
+        self.filters.add(alias_id, alias_doc_id, alias_metadata, vector_id=new_id)
+
+  # frees the ids of tombstoned chunks that are being added again. an hnsw node cannot be dropped without rebuilding
+  # the graph, so it stays behind as a tombstone under a negative id, which searches skip like faiss's -1 padding,
+  # and compact() drops it with the rest
+  def _retire(self, chunk_ids: List[int]):
+    self.tombstones.difference_update(chunk_ids)
+    if self.index_type != "hnsw":
+      self._remove_from_index(chunk_ids)
+      return
+    id_map = faiss.vector_to_array(self.index.id_map)
+    rows = np.flatnonzero(np.isin(id_map, chunk_ids))
+    next_id = min([chunk_id for chunk_id in self.tombstones if chunk_id < 0], default=-1) - 1
+    id_map[rows] = np.arange(next_id, next_id - len(rows), -1, dtype=np.int64)
+    faiss.copy_array_to_vector(id_map, self.index.id_map)
+    self.index.construct_rev_map()
+    self.tombstones.update(id_map[rows].tolist())
+
+  def _maybe_compact(self):
+    if self.index is not None and self.tombstones and len(self.tombstones) > self.compaction_threshold * self.index.ntotal:
+      self.compact()
+
+  # function to physically remove tombstoned vectors from the index
+  def compact(self):
+    if not self.tombstones:
+      return 0
+    with telemetry.span("compact", tombstones=len(self.tombstones), index_type=self.index_type):
+      removed = self._remove_from_index(list(self.tombstones))
+    self.tombstones.clear()
+    return removed
+
+  def _remove_from_index(self, chunk_ids: List[int]) -> int:
+    # hnsw graphs cannot drop nodes, so rebuild from the live vectors instead
+    if self.index_type == "hnsw":
+      removed = len(chunk_ids)
+      drop = set(chunk_ids)
+      keep_ids = np.array([i for i in faiss.vector_to_array(self.index.id_map) if i not in drop], dtype=np.int64)
+      vectors = self._reconstruct(keep_ids)
+      self.index = self._build_index()
+      if len(keep_ids):
+        self.index.add_with_ids(vectors, keep_ids)
+      return removed
+
+    ids = np.array(chunk_ids, dtype=np.int64)
+    # the ivf hashtable direct map only accepts an explicit id array
+    selector = faiss.IDSelectorArray(ids) if self.needs_training and not self.is_staging else faiss.IDSelectorBatch(ids)
+    if 'Gpu' in type(self.index).__name__:
+      # gpu indexes do not support removal, so round-trip through the cpu
+      cpu_index = faiss.index_gpu_to_cpu(self.index)
+      removed = cpu_index.remove_ids(selector)
+      res = faiss.StandardGpuResources()
+      self.index = faiss.index_cpu_to_gpu(res, 0, cpu_index)
+      self._cpu_copy = cpu_index
+      return removed
+    return self.index.remove_ids(selector)
+
+  # similarity search function; nprobe (ivf) and ef_search (hnsw) trade recall for speed
+  # search_filter (doc ids, pages, author/title, ingest dates) or the doc_ids shorthand restrict which chunks are scored
+  def search(self, query_embedding: np.ndarray, k: int = 5, nprobe: int = None, ef_search: int = None,
+             search_filter: SearchFilter = None, doc_ids: Iterable[str] = None) -> List[Dict]:
     if query_embedding.ndim == 1:
       query_embedding = np.expand_dims(query_embedding, 0)
-    faiss.normalize_L2(query_embedding)
-
-    distances, indices = self.index.search(query_embedding, k)
-
-    results = []
-    for i in range(len(indices[0])):
-      idx = indices[0][i]
-      if idx >= 0:
-        results.append({
-            "chunk": self.metadata_store[idx]['text'],
-            "metadata": self.metadata_store[idx]['metadata'],
-            "similarity": float(distances[0][i])
-        })
+    return self.search_batch(query_embedding[:1], k=k, nprobe=nprobe, ef_search=ef_search, search_filter=search_filter, doc_ids=doc_ids)[0]
+
+  # batched similarity search: one faiss call for an (N, d) query matrix, one result list per row
+  def search_batch(self, query_embeddings: np.ndarray, k: int = 5, nprobe: int = None, ef_search: int = None,
+                   search_filter: SearchFilter = None, doc_ids: Iterable[str] = None) -> List[List[Dict]]:
+    query_embeddings = np.ascontiguousarray(np.atleast_2d(query_embeddings), dtype=np.float32)
+    faiss.normalize_L2(query_embeddings)
+    filter_ids, redirects = self._filter_ids(search_filter, doc_ids)
+    return self._redirect(self._search_batch(query_embeddings, k, nprobe, ef_search, filter_ids), redirects)
+
+  # dense search of normalized queries, restricted to filter_ids (vector ids) unless that is None
+  def _search_batch(self, query_embeddings: np.ndarray, k: int, nprobe: int, ef_search: int, filter_ids: np.ndarray) -> List[List[Dict]]:
+    if self.index is None:
+      return [[] for _ in range(len(query_embeddings))]
+
+    # over-fetch by the number of tombstones so dead entries cannot crowd out live ones; compaction keeps this bounded
+    fetch_k = min(k + len(self.tombstones), self.index.ntotal)
+    # a filter is applied inside faiss through an id selector, so only matching vectors are scored; small
+    # selections are scored exactly instead. gpu indexes take no selectors, so they filter a result list as deep
+    # as the gpu allows, and queries left with too few matches are scored exactly over the selection
+    is_gpu = 'Gpu' in type(self.index).__name__
+    selector, allowed, exact = None, None, False
+    if filter_ids is not None:
+      exact = self.index_type != "flat" and len(filter_ids) <= self.exact_filter_size
+      if is_gpu and not exact:
+        allowed, fetch_k = set(filter_ids.tolist()), self.index.ntotal
+      else:
+        fetch_k = min(k, len(filter_ids))
+        if not exact:
+          selector = faiss.IDSelectorBatch(filter_ids)
+      telemetry.observe("filter_selected", len(filter_ids))
+    if is_gpu:
+      fetch_k = min(fetch_k, self.GPU_MAX_K)
+    if fetch_k == 0:
+      return [[] for _ in range(len(query_embeddings))]
+    with telemetry.span("search", queries=len(query_embeddings), k=k, index_type=self.index_type, filtered=filter_ids is not None):
+      telemetry.observe("batch_size", len(query_embeddings), stage="search")
+      if exact:
+        distances, indices = self._exact_search(query_embeddings, filter_ids, fetch_k)
+      else:
+        distances, indices = self.index.search(query_embeddings, fetch_k, params=self._search_params(nprobe, ef_search, selector))
+      if allowed is not None and fetch_k < self.index.ntotal:
+        wanted = min(k, len(filter_ids))
+        short = [row for row in range(len(indices)) if sum(int(i) in allowed for i in indices[row]) < wanted]
+        if short:
+          exact_distances, exact_indices = self._exact_search(query_embeddings[short], filter_ids, min(fetch_k, len(filter_ids)))
+          distances[short], indices[short] = -np.inf, -1
+          distances[short, :exact_indices.shape[1]], indices[short, :exact_indices.shape[1]] = exact_distances, exact_indices
+          telemetry.count("gpu_filter_fallback_total", len(short))
+
+    # only the returned hits are decoded from the chunk store, once even if several queries share them
+    decoded = {}
+    all_results = []
+    for row in range(len(indices)):
+      results = []
+      for i in range(len(indices[row])):
+        chunk_id = int(indices[row][i])
+        if chunk_id < 0 or (allowed is not None and chunk_id not in allowed):
+          continue
+        if chunk_id not in decoded:
+          decoded[chunk_id] = self.chunk_store.get(chunk_id)
+        entry = decoded[chunk_id]
+        if entry is not None:
+          results.append(self._with_duplicates({
+              "id": chunk_id,
+              "doc_id": entry['doc_id'],
+              "chunk": entry['text'],
+              "metadata": dict(entry['metadata']),
+              "similarity": float(distances[row][i])
+          }))
+          if len(results) == k:
+            break
+      all_results.append(results)
+    return all_results
+
+  # a chunk that near-duplicates were collapsed into lists them under "duplicates": id, doc_id and page/chunk_index
+  def _with_duplicates(self, result: Dict) -> Dict:
+    if self.dedup is not None and self.dedup.has_duplicates(result["id"]):
+      result["duplicates"] = self.dedup.duplicates_of(result["id"])
+    return result
+
+  # hybrid search: dense and BM25 candidates are retrieved in parallel and merged with reciprocal-rank fusion
+  # exact-term queries (names, part numbers, acronyms) that embed poorly are still found by the lexical side
+  def hybrid_search(self, query_text: str, query_embedding: np.ndarray, k: int = 5, **kwargs) -> List[Dict]:
+    return self.hybrid_search_batch([query_text], np.atleast_2d(query_embedding)[:1], k=k, **kwargs)[0]
+
+  # candidate_k is how deep each ranking is read before fusion; rrf_k damps the weight of the top ranks
+  def hybrid_search_batch(self,
+                          query_texts: List[str],
+                          query_embeddings: np.ndarray,
+                          k: int = 5,
+                          candidate_k: int = None,
+                          rrf_k: int = 60,
+                          nprobe: int = None,
+                          ef_search: int = None,
+                          search_filter: SearchFilter = None,
+                          doc_ids: Iterable[str] = None) -> List[List[Dict]]:
+    candidate_k = candidate_k or 2 * k
+    query_embeddings = np.array(np.atleast_2d(query_embeddings), dtype=np.float32)
+    faiss.normalize_L2(query_embeddings)
+
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(max_workers=1)
+    # faiss releases the GIL while searching, so the lexical lookups overlap with it
+    with telemetry.span("hybrid_search", queries=len(query_texts), k=k):
+      filter_ids, redirects = self._filter_ids(search_filter, doc_ids)
+      lexical = self._executor.submit(self._timed_bm25, query_texts, candidate_k, filter_ids)
+      dense_lists = self._search_batch(query_embeddings, candidate_k, nprobe, ef_search, filter_ids)
+      lexical_lists = lexical.result()
+
+    all_results = []
+    for row, (dense, lexical_hits) in enumerate(zip(dense_lists, lexical_lists)):
+      fused = {}
+      for rank, result in enumerate(dense):
+        fused[result["id"]] = result
+        result["bm25"] = 0.0
+        result["rrf_score"] = 1.0 / (rrf_k + rank + 1)
+      for rank, (chunk_id, score) in enumerate(lexical_hits):
+        result = fused.get(chunk_id)
+        if result is None:
+          entry = self.chunk_store.get(chunk_id)
+          if entry is None:
+            continue
+          result = fused[chunk_id] = self._with_duplicates({
+              "id": chunk_id,
+              "doc_id": entry['doc_id'],
+              "chunk": entry['text'],
+              "metadata": dict(entry['metadata']),
+              "similarity": None,
+              "rrf_score": 0.0
+          })
+        result["bm25"] = score
+        result["rrf_score"] += 1.0 / (rrf_k + rank + 1)
+      all_results.append(sorted(fused.values(), key=lambda r: r["rrf_score"], reverse=True)[:k])
+
+    # lexical-only hits that made the cut get their real cosine similarity, so downstream code can keep relying on it
+    missing = [(row, result) for row, results in enumerate(all_results) for result in results if result["similarity"] is None]
+    if missing:
+      vectors = self._reconstruct(np.array([result["id"] for _, result in missing], dtype=np.int64))
+      for (row, result), vector in zip(missing, vectors):
+        result["similarity"] = float(vector @ query_embeddings[row])
+    return self._redirect(all_results, redirects)
+
+  # runs on the executor thread, which has no open span, so the lexical time is recorded as a metric
+  def _timed_bm25(self, query_texts: List[str], k: int, chunk_ids: np.ndarray = None) -> List:
+    start = time.perf_counter()
+    results = [self.bm25.search(text, k, chunk_ids=chunk_ids) for text in query_texts]
+    telemetry.observe("bm25_seconds", time.perf_counter() - start, buckets=DURATION_BUCKETS)
     return results
 
+  # brute-force inner products against a few chunks; same (distances, ids) layout as faiss, padded with -1
+  def _exact_search(self, queries: np.ndarray, chunk_ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    scores = queries @ self._reconstruct(chunk_ids).T
+    top = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(scores, top, axis=1), chunk_ids[top]
+
+  # gpu indexes are read through a cpu copy that is only made again after the index changes
+  def _reconstruct(self, chunk_ids: np.ndarray) -> np.ndarray:
+    chunk_ids = np.ascontiguousarray(chunk_ids, dtype=np.int64)
+    if len(chunk_ids) == 0:
+      return np.zeros((0, self.dimension), dtype=np.float32)
+    index = self.index
+    if 'Gpu' in type(index).__name__:
+      if self._cpu_copy is None:
+        self._cpu_copy = faiss.index_gpu_to_cpu(index)
+      index = self._cpu_copy
+    return index.reconstruct_batch(chunk_ids)
+
+  # function to measure recall@k of the current index against an exact flat search over the same vectors
+  # pq codes are lossy, so ivf_pq needs the original (reference_embeddings, reference_ids) for the baseline
+  def measure_recall(self,
+                     query_embeddings: np.ndarray,
+                     k: int = 10,
+                     nprobe: int = None,
+                     ef_search: int = None,
+                     reference_embeddings: np.ndarray = None,
+                     reference_ids: np.ndarray = None) -> Dict[str, float]:
+    if self.index is None or self.get_index_size() == 0:
+      raise ValueError("Cannot measure recall on an empty index")
+
+    queries = np.ascontiguousarray(np.atleast_2d(query_embeddings), dtype=np.float32)
+    faiss.normalize_L2(queries)
+
+    if reference_embeddings is None:
+      if self.index_type == "ivf_pq":
+        raise ValueError("ivf_pq stores lossy codes; pass reference_embeddings and reference_ids")
+      reference_ids = self.chunk_store.ids()
+      reference_embeddings = self._reconstruct(reference_ids)
+    else:
+      reference_embeddings = np.ascontiguousarray(reference_embeddings, dtype=np.float32)
+      reference_ids = np.asarray(reference_ids, dtype=np.int64)
+      faiss.normalize_L2(reference_embeddings)
+
+    exact = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+    exact.add_with_ids(reference_embeddings, reference_ids)
+
+    start = time.time()
+    _, truth = exact.search(queries, k)
+    exact_time = time.time() - start
+
+    self.compact()
+    start = time.time()
+    _, found = self.index.search(queries, k, params=self._search_params(nprobe, ef_search))
+    approx_time = time.time() - start
+
+    hits = sum(len(set(truth[i][truth[i] >= 0]) & set(found[i][found[i] >= 0])) for i in range(len(queries)))
+    expected = sum(int((truth[i] >= 0).sum()) for i in range(len(queries)))
+    return {
+        f"recall@{k}": hits / expected if expected else 0.0,
+        "exact_ms_per_query": 1000 * exact_time / len(queries),
+        "index_ms_per_query": 1000 * approx_time / len(queries)
+    }
+
   # function to save index and metadata to disk
   def save_index(self, path: str = None):
     path = path or self.index_path
     if not path:
       raise ValueError("No path specified for saving index")
+    if self.index is None:
+      raise ValueError("Index is empty; add chunks before saving")
+
+    self.compact()
 
     # handle gpu usage with index saving
     if 'Gpu' in type(self.index).__name__:
       cpu_index = faiss.index_gpu_to_cpu(self.index)
     else:
       cpu_index = self.index
-    
+
     faiss.write_index(cpu_index, path + ".index")
+    self.chunk_store.save(path + ".chunks")
+    self.bm25.save(path + ".bm25.npz")
+    self.filters.save(path + ".filters.npz")
+    if self.dedup is not None:
+      self.dedup.save(path + ".dedup.npz")
 
-    with open(path + ".meta", "wb") as f:
-      pickle.dump(self.metadata_store, f)
+    with open(path + ".meta", "w", encoding="utf-8") as f:
+      json.dump({
+          "format": "chunk_store",
+          "config": {
+              "index_type": self.index_type,
+              "nlist": self.nlist,
+              "pq_m": self.pq_m,
+              "hnsw_m": self.hnsw_m
+          }
+      }, f)
 
-    print(f"Index was loaded from {path}.index and {path}.meta")
+    print(f"Index was saved to {path}.index, {path}.chunks, {path}.bm25.npz, {path}.filters.npz and {path}.meta")
 
   # function to load in index and metadata from disk
-  def load_index(self, path: str = None):
+  # mmap (default: the constructor's setting) maps the index file read-only instead of reading it into memory
+  def load_index(self, path: str = None, mmap: bool = None):
     path = path or self.index_path
     if not path:
       raise ValueError("No path specified for loading index")
+    mmap = self.mmap if mmap is None else mmap
 
-    # handle index loading with gpu
-    cpu_index = faiss.read_index(path + ".index")
-    if faiss.get_num_gpus() > 0:
-      res = faiss.StandardGpuResources()
-      self.index = faiss.index_cpu_to_gpu(res, 0, cpu_index)
+    # the file is read once; it goes to the gpu after the stored config is applied, since that decides the device
+    with telemetry.span("index_open", mmap=mmap):
+      self.index = faiss.read_index(path + ".index", faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0)
+
+    self.tombstones = set()
+    self.read_only = False
+    if not os.path.isdir(path + ".chunks"):
+      self._load_legacy(path)
+      self._rebuild_bm25()
+      self._rebuild_filters()
+      self._finish_load(mmap)
+      print(f"Index loaded from {path}.index and {path}.meta")
+      return
+
+    # chunk texts and metadata are memory-mapped, not read, so opening stays fast for large corpora
+    self.chunk_store = ChunkStore(path + ".chunks")
+    with open(path + ".meta", "r", encoding="utf-8") as f:
+      stored = json.load(f)
+    # the saved index decides the type, whatever this instance was constructed with
+    for key, value in stored["config"].items():
+      setattr(self, key, value)
+
+    # indexes saved before the lexical index existed get one built from the stored chunk texts
+    if os.path.exists(path + ".bm25.npz"):
+      self.bm25 = BM25Index.load(path + ".bm25.npz")
+    else:
+      self._rebuild_bm25()
+    # likewise for the filter columns; chunks stored before ingest times were recorded never match a date range
+    if os.path.exists(path + ".filters.npz"):
+      self.filters = MetadataIndex.load(path + ".filters.npz")
     else:
-      self.index = cpu_index
-    
-    self.index = faiss.read_index(path + ".index")
+      self._rebuild_filters()
+    # a saved dedup index is always loaded, since the collapsed chunks only exist in it. when dedup is turned on for
+    # an index saved without it, every stored chunk becomes a canonical one and only new chunks are collapsed
+    if os.path.exists(path + ".dedup.npz"):
+      self.dedup = NearDuplicateIndex.load(path + ".dedup.npz")
+      self.dedup_threshold = self.dedup.threshold
+    elif self.dedup_threshold:
+      self._rebuild_dedup()
+
+    self._finish_load(mmap)
+    print(f"Index loaded from {path}.index and {path}.chunks")
+
+  # a memory-mapped index stays on the cpu, since copying it to the gpu would read the whole file after all
+  def _finish_load(self, mmap: bool):
+    self.read_only = mmap
+    self._cpu_copy = None
+    self._read_trained_shape(self.index)
+    if not mmap:
+      self.index = self._to_device(self.index)
+
+  # function to make the first real search as fast as the rest: one search touches the index (with mmap, the
+  # os pages the vectors in; a flat index is scanned completely), the chunk store and the hybrid-search thread
+  def warmup(self):
+    if self.get_index_size() == 0:
+      return
+    with telemetry.span("warmup", component="vector_store"):
+      self.hybrid_search_batch(["warmup"], np.ones((1, self.dimension), dtype=np.float32), k=1)
 
+  def _rebuild_bm25(self):
+    self.bm25 = BM25Index()
+    for chunk_id in self.chunk_store.ids().tolist():
+      self.bm25.add(chunk_id, self.chunk_store.get(chunk_id)["text"])
+
+  def _rebuild_filters(self):
+    self.filters = MetadataIndex()
+    for chunk_id in self.chunk_store.ids().tolist():
+      entry = self.chunk_store.get(chunk_id)
+      self.filters.add(chunk_id, entry["doc_id"], entry["metadata"])
+
+  def _rebuild_dedup(self):
+    self.dedup = NearDuplicateIndex(self.dedup_threshold)
+    for chunk_id in self.chunk_store.ids().tolist():
+      signature = self.dedup.signature(self.chunk_store.get(chunk_id)["text"])
+      if signature is not None:
+        self.dedup.add_canonical(chunk_id, signature)
+
+  # older indexes pickled all chunks into .meta; convert them into a chunk store
+  def _load_legacy(self, path: str):
     with open(path + ".meta", "rb") as f:
-      self.metadata_store = pickle.load(f)
+      stored = pickle.load(f)
+
+    self.chunk_store = ChunkStore()
+    if isinstance(stored, list):
+      # positional IndexFlatIP: re-key the vectors with stable ids
+      embeddings = self.index.reconstruct_n(0, self.index.ntotal)
+      self.index_type = "flat"
+      self.index = self._build_index()
+      self.add_chunks(embeddings, stored)
+      return
+
+    for key, value in stored.get("config", {}).items():
+      setattr(self, key, value)
+    for chunk_id, entry in stored["chunks"].items():
+      self.chunk_store.add(chunk_id, entry["doc_id"], entry["text"], entry["metadata"])
+    if self.dedup is not None:
+      self._rebuild_dedup()
 
-    print(f"Index loaded from {path}.index and {path}.meta")
+  # function to release the hybrid-search thread, e.g. before dropping a store that is no longer used
+  def close(self):
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+      self._executor = None
 
   def get_index_size(self) -> int:
-    return self.index.ntotal
\ No newline at end of file
+    if self.index is None:
+      return 0
+    return self.index.ntotal - len(self.tombstones)